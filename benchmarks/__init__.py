@@ -0,0 +1,7 @@
+# -*- coding: utf8 -*-
+"""
+Benchmarks of pystalkd, run from the root of the repository. They don't need a beanstalkd server:
+
+    python3 -m benchmarks                  # throughput and latency suite, see benchmarks.suite
+    python3 -m benchmarks.job_allocation   # memory and time of building Job objects
+"""
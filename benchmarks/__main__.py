@@ -0,0 +1,4 @@
+# -*- coding: utf8 -*-
+from .suite import main
+
+main()
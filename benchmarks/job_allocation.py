@@ -0,0 +1,74 @@
+# -*- coding: utf8 -*-
+"""
+Per-job memory and time of building Job objects from RESERVED responses, as Connection.reserve does.
+Compares the slotted, lazily decoded Job with an equivalent class with a __dict__ that decodes the body eagerly
+(what Job used to be). No server needed:
+
+    python3 -m benchmarks.job_allocation [jobs] [body size]
+"""
+import sys
+import tracemalloc
+from time import perf_counter
+
+from pystalkd.Job import decode_utf8
+from pystalkd.Protocol import Response
+from pystalkd.Beanstalkd import Connection
+
+
+class DictJob(object):
+    def __init__(self, connection, job_id, body, size, reserved=True):
+        self.size = size
+        self.body = body
+        self.reserved = reserved
+        self.job_id = job_id
+        self.connection = connection
+        self._stats = None
+        self._stats_time = None
+
+
+def eager(connection, response):
+    job_id, size = response.args[:2]
+    return DictJob(connection, int(job_id), str(response.body, "utf8"), int(size))
+
+
+def build_all(build, responses, touch):
+    jobs = [build(response) for response in responses]
+    if touch:
+        for job in jobs:
+            job.body
+    return jobs
+
+
+def measure(name, build, responses, touch):
+    # timed without tracemalloc, it slows allocations down a lot
+    start = perf_counter()
+    build_all(build, responses, touch)
+    elapsed = perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    jobs = build_all(build, responses, touch)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    count = len(jobs)
+    print("{:<32} {:>10.1f} bytes/job {:>10.3f} us/job".format(name, allocated / count, elapsed / count * 1e6))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    body = b"x" * size
+    # the jobs only need a connection to build, _parse_job doesn't do any IO
+    connection = Connection.__new__(Connection)
+    connection._codecs = {}
+    responses = [Response("RESERVED", [str(i).encode(), str(size).encode()], body) for i in range(count)]
+    print("{} jobs, {} bytes bodies".format(count, size))
+    measure("dict job, eager decoding", lambda response: eager(connection, response), responses, False)
+    measure("slotted job, body never read", lambda response: connection._parse_job(response), responses, False)
+    measure("slotted job, body read", lambda response: connection._parse_job(response), responses, True)
+    measure("slotted job, raw body", lambda response: connection._parse_job(response, True), responses, False)
+    assert decode_utf8(body) == connection._parse_job(responses[0]).body
+
+
+if __name__ == '__main__':
+    main()
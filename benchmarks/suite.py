@@ -0,0 +1,327 @@
+# -*- coding: utf8 -*-
+"""
+Throughput and latency of the client against pystalkd.Embedded.EngineServer, for payloads from 10 B to 10 MB:
+
+- put, put_many (pipelined) and AsyncConnection.put
+- reserve + delete, pipelined reserve + delete_many and the async reserve + delete
+- stats (status line, data chunk and YAML parsing)
+
+each in str and raw (bytes) mode where it applies. Every case runs a fixed number of operations (fewer for big
+payloads, see `count_for`) after a warm-up, on a fresh tube, so two runs on the same machine are comparable.
+Results are written as JSON, and a previous result file can be given to print the relative change of each case:
+
+    python3 -m benchmarks [--sizes 10,1000] [--output result.json] [--compare baseline.json] [--subprocess]
+
+The engine is a complete beanstalkd, so its own work (priorities, TTR, stats) is part of the numbers: compare results
+of the same server kind only
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+from itertools import count
+from time import perf_counter
+
+import pystalkd
+from pystalkd.AsyncBeanstalkd import AsyncConnection
+from pystalkd.Beanstalkd import Connection
+from pystalkd.Embedded import Engine, EngineServer
+from pystalkd.Job import Job
+
+DEFAULT_SIZES = (10, 1000, 100000, 10000000)
+# bytes moved per case, the number of operations is derived from it
+BYTES_PER_CASE = 64 * 1024 * 1024
+MIN_OPERATIONS = 10
+MAX_OPERATIONS = 5000
+BATCH = 100
+# max-job-size of the engine, above the biggest payload
+MAX_JOB_SIZE = 64 * 1024 * 1024
+
+_tubes = count()
+
+
+def count_for(size, scale=1.0):
+    """
+    Number of operations of a case with `size` bytes payloads
+    :rtype: int
+    """
+    operations = min(MAX_OPERATIONS, max(MIN_OPERATIONS, BYTES_PER_CASE // max(size, 1)))
+    return max(int(operations * scale), 1)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(name, mode, size, operations, elapsed, latencies, batch=1):
+    """
+    One result row. Latencies are per operation, or per batch when `batch` > 1
+    :rtype: dict
+    """
+    return {
+        "name": name,
+        "mode": mode,
+        "size": size,
+        "batch": batch,
+        "operations": operations,
+        "seconds": elapsed,
+        "ops_per_sec": operations / elapsed if elapsed else None,
+        "mb_per_sec": operations * size / elapsed / 1e6 if elapsed and size else None,
+        "p50_us": percentile(latencies, 0.5) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+    }
+
+
+def payload(size, mode):
+    body = b"x" * size
+    return body if mode == "raw" else body.decode("ascii")
+
+
+def fresh_connection(host, port):
+    conn = Connection(host, port)
+    tube = "bench-{}".format(next(_tubes))
+    conn.use(tube)
+    conn.watch(tube)
+    conn.ignore("default")
+    return conn
+
+
+def timed(operation, repeat):
+    latencies = []
+    start = perf_counter()
+    for _ in range(repeat):
+        before = perf_counter()
+        operation()
+        latencies.append(perf_counter() - before)
+    return perf_counter() - start, latencies
+
+
+def bench_put(host, port, size, mode, operations):
+    conn = fresh_connection(host, port)
+    body = payload(size, mode)
+    put = conn.put_bytes if mode == "raw" else conn.put
+    timed(lambda: put(body), min(operations, 10))
+    elapsed, latencies = timed(lambda: put(body), operations)
+    drain(conn, operations + min(operations, 10))
+    conn.close()
+    return summarize("put", mode, size, operations, elapsed, latencies)
+
+
+def bench_put_many(host, port, size, mode, operations):
+    conn = fresh_connection(host, port)
+    batch = [payload(size, mode)] * min(BATCH, operations)
+    batches = max(operations // len(batch), 1)
+    put_many = conn.put_bytes_many if mode == "raw" else conn.put_many
+    elapsed, latencies = timed(lambda: put_many(batch), batches)
+    drain(conn, batches * len(batch))
+    conn.close()
+    return summarize("put_many", mode, size, batches * len(batch), elapsed, latencies, len(batch))
+
+
+def bench_reserve_delete(host, port, size, mode, operations):
+    conn = fresh_connection(host, port)
+    conn.put_bytes_many([b"x" * size] * operations)
+    raw = mode == "raw"
+
+    def reserve_delete():
+        job = conn.reserve(0, raw)
+        # str mode pays for the decoding, as a consumer reading the body would
+        job.body
+        job.delete()
+
+    elapsed, latencies = timed(reserve_delete, operations)
+    conn.close()
+    return summarize("reserve_delete", mode, size, operations, elapsed, latencies)
+
+
+def bench_reserve_delete_many(host, port, size, mode, operations):
+    conn = fresh_connection(host, port)
+    conn.put_bytes_many([b"x" * size] * operations)
+    raw = mode == "raw"
+    batch = min(BATCH, operations)
+    batches = max(operations // batch, 1)
+
+    def reserve_delete_many():
+        pipeline = conn.pipeline()
+        for _ in range(batch):
+            pipeline.reserve(0, raw)
+        jobs = pipeline.execute(raise_on_error=True)
+        for job in jobs:
+            job.body
+        conn.delete_many(jobs)
+
+    elapsed, latencies = timed(reserve_delete_many, batches)
+    drain(conn, operations - batches * batch)
+    conn.close()
+    return summarize("reserve_delete_many", mode, size, batches * batch, elapsed, latencies, batch)
+
+
+def bench_stats(host, port, operations):
+    conn = Connection(host, port)
+    timed(conn.stats, min(operations, 10))
+    elapsed, latencies = timed(conn.stats, operations)
+    conn.close()
+    return summarize("stats", "str", 0, operations, elapsed, latencies)
+
+
+def bench_async(host, port, size, mode, operations):
+    """
+    AsyncConnection put then reserve + delete of the same jobs
+    :rtype: list of dict
+    """
+    body = payload(size, mode)
+    raw = mode == "raw"
+
+    async def run():
+        async with AsyncConnection(host, port) as conn:
+            tube = "bench-{}".format(next(_tubes))
+            await conn.use(tube)
+            await conn.watch(tube)
+            await conn.ignore("default")
+            put = conn.put_bytes if raw else conn.put
+            put_latencies = []
+            start = perf_counter()
+            for _ in range(operations):
+                before = perf_counter()
+                await put(body)
+                put_latencies.append(perf_counter() - before)
+            put_elapsed = perf_counter() - start
+
+            reserve_latencies = []
+            start = perf_counter()
+            for _ in range(operations):
+                before = perf_counter()
+                job = await conn.reserve(0, raw)
+                job.body
+                await job.delete()
+                reserve_latencies.append(perf_counter() - before)
+            reserve_elapsed = perf_counter() - start
+        return [summarize("async_put", mode, size, operations, put_elapsed, put_latencies),
+                summarize("async_reserve_delete", mode, size, operations, reserve_elapsed, reserve_latencies)]
+
+    return asyncio.run(run())
+
+
+def drain(conn, jobs):
+    """Delete the jobs a case left in its tube"""
+    for _ in range(jobs // BATCH + 1):
+        pipeline = conn.pipeline()
+        for _ in range(BATCH):
+            pipeline.reserve(0, True)
+        found = [job for job in pipeline.execute() if isinstance(job, Job)]
+        if not found:
+            return
+        conn.delete_many(found)
+
+
+def run(host, port, sizes, scale=1.0, log=None):
+    """
+    Run every case
+    :param scale: multiplies the number of operations of every case
+    :type scale: float
+    :param log: called with each result as soon as it's known
+    :type log: callable
+    :rtype: list of dict
+    """
+    results = []
+
+    def record(result):
+        results.append(result)
+        if log is not None:
+            log(result)
+
+    record(bench_stats(host, port, count_for(0, scale)))
+    for size in sizes:
+        operations = count_for(size, scale)
+        for mode in ("str", "raw"):
+            record(bench_put(host, port, size, mode, operations))
+            record(bench_put_many(host, port, size, mode, operations))
+            record(bench_reserve_delete(host, port, size, mode, operations))
+            record(bench_reserve_delete_many(host, port, size, mode, operations))
+            for result in bench_async(host, port, size, mode, operations):
+                record(result)
+    return results
+
+
+def serve(port=0):
+    """Serve an engine on `port` until killed, the port is printed on the first line. Used by --subprocess"""
+    server = EngineServer(Engine(MAX_JOB_SIZE), port=port)
+    print(server.port, flush=True)
+    server.serve_forever()
+
+
+def key(result):
+    return result["name"], result["mode"], result["size"]
+
+
+def print_result(result, baseline=None):
+    line = "{name:<22} {mode:<4} {size:>9} B {ops_per_sec:>12.1f} ops/s {p50_us:>10.1f} us p50 {p99_us:>10.1f} us p99"
+    text = line.format(**result)
+    if baseline is not None and key(result) in baseline and baseline[key(result)]["ops_per_sec"]:
+        change = result["ops_per_sec"] / baseline[key(result)]["ops_per_sec"] - 1
+        text += " {:>+7.1%}".format(change)
+    print(text, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m benchmarks", description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated payload sizes in bytes")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the number of operations")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run, to print the change of each case")
+    parser.add_argument("--subprocess", action="store_true",
+                        help="run the engine in its own process instead of a thread")
+    parser.add_argument("--server", help="host:port of a server to use instead of the engine (i.e. beanstalkd, "
+                                         "with sizes below its max-job-size)")
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as results:
+            baseline = {key(result): result for result in json.load(results)["results"]}
+
+    process = server = None
+    if args.server:
+        host, port = args.server.rsplit(":", 1)
+        port = int(port)
+        kind = "external"
+    elif args.subprocess:
+        process = subprocess.Popen([sys.executable, "-c", "from benchmarks.suite import serve; serve()"],
+                                   stdout=subprocess.PIPE)
+        host, port = "127.0.0.1", int(process.stdout.readline())
+        kind = "subprocess"
+    else:
+        server = Engine(MAX_JOB_SIZE).serve()
+        host, port = server.host, server.port
+        kind = "thread"
+
+    try:
+        results = run(host, port, sizes, args.scale, lambda result: print_result(result, baseline))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if server is not None:
+            server.close()
+
+    if args.output:
+        report = {
+            "meta": {
+                "pystalkd": pystalkd.__version__,
+                "python": platform.python_version(),
+                "implementation": platform.python_implementation(),
+                "platform": platform.platform(),
+                "server": kind,
+                "scale": args.scale,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
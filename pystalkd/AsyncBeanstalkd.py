@@ -0,0 +1,329 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import asyncio
+from contextlib import asynccontextmanager
+from functools import partial
+
+from .Beanstalkd import (BLOB_THRESHOLD, DEFAULT_HOST, DEFAULT_PORT, RECV_SIZE, BeanstalkdException, Commands,
+                         Connection, Request, SocketError, UnexpectedResponse, _split_key, _status_pair)
+from .Job import AsyncJob, decode_utf8
+from .Protocol import ResponseParser, ProtocolError
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+
+class AsyncConnection(Commands):
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, parse_yaml=True, connect_timeout=None,
+                 yaml_fallback=False, codec=None, blob_store=None, blob_threshold=BLOB_THRESHOLD,
+                 metrics=None, idempotency_keys=False):
+        """
+        asyncio version of pystalkd.Beanstalkd.Connection. Every command is a coroutine and jobs are AsyncJob.
+        Nothing is done until `connect` is awaited, or use it with `async with`:
+
+            async with AsyncConnection("localhost", 11300) as conn:
+                await conn.put("hey!")
+                job = await conn.reserve(0)
+                await job.delete()
+
+        Commands from coroutines sharing a connection are executed one at a time. Cancelling a command waiting for
+        its response (i.e. a reserve without timeout) closes the socket, since beanstalkd would only read the next
+        command after answering it. The next command reconnects and restores the used tube and the watch list
+        :param host: beanstalkd host
+        :type host: str
+        :param port: beanstalkd port
+        :type port: int
+        :param connect_timeout: seconds to wait for the connection, None waits forever
+        :type connect_timeout: float
+        :param yaml_fallback: parse with PyYaml the stats and lists the built-in parser doesn't fully understand
+        :type yaml_fallback: bool
+        :param codec: default codec of put and of reserved jobs, see Connection.set_codec
+        :type codec: pystalkd.Codec.Codec
+        :param blob_store: claim-check store of the bodies bigger than `blob_threshold` bytes, see Connection
+        :type blob_store: pystalkd.ClaimCheck.BlobStore
+        :type blob_threshold: int
+        :param metrics: records every command, see pystalkd.Metrics.Metrics
+        :type metrics: pystalkd.Metrics.Metrics
+        :param idempotency_keys: read the idempotency key of the jobs, see Connection
+        :type idempotency_keys: bool
+        """
+        self.port = port
+        self.host = host
+        self.parse_yaml = parse_yaml
+        self.yaml_fallback = yaml_fallback
+        self._codecs = {}
+        self._accept = None
+        if codec is not None:
+            self.set_codec(codec)
+        self._blob_store = blob_store
+        self._blob_threshold = blob_threshold
+        self.metrics = metrics
+        self.idempotency_keys = idempotency_keys
+
+        self.server_errors = ["OUT_OF_MEMORY", "INTERNAL_ERROR", "BAD_FORMAT", "UNKNOWN_COMMAND"]
+
+        self._connect_timeout = connect_timeout
+        self._reader = None
+        self._writer = None
+        self._parser = None
+        self._lock = asyncio.Lock()
+        self._using = "default"
+        self._watching = ["default"]
+
+    async def __aenter__(self):
+        if self._writer is None:
+            await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def connect(self):
+        """Connect to beanstalkd server."""
+        try:
+            self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                                self._connect_timeout)
+        except (OSError, asyncio.TimeoutError) as err:
+            raise SocketError(err)
+        self._parser = ResponseParser(RECV_SIZE)
+
+    async def _restore(self):
+        """
+        Connect again and replay the tube state of the lost connection
+        """
+        await self.connect()
+        requests = []
+        if self._using != "default":
+            requests.append(Request("use", self._using, ok_status=["USING"]))
+        for name in self._watching:
+            if name != "default":
+                requests.append(Request("watch", name, ok_status=["WATCHING"]))
+        if "default" not in self._watching:
+            requests.append(Request("ignore", "default", ok_status=["WATCHING"]))
+        for request in requests:
+            request.result(self, await self._send(request))
+
+    def _drop(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def close(self):
+        """close connection and send exit to beanstalkd server"""
+        if self._writer is None:
+            return
+        writer = self._writer
+        try:
+            writer.write(b"quit\r\n")
+            writer.close()
+            await writer.wait_closed()
+        except OSError:
+            pass
+        finally:
+            self._reader = self._writer = None
+
+    async def reconnect(self):
+        await self.close()
+        self._using = "default"
+        self._watching = ["default"]
+        await self.connect()
+
+    async def _recv(self):
+        parser = self._parser
+        while True:
+            try:
+                response = parser.next_response()
+            except ProtocolError as err:
+                raise UnexpectedResponse(str(err))
+            if response is not None:
+                return response
+
+            try:
+                data = await self._reader.read(max(RECV_SIZE, parser.bytes_needed()))
+            except OSError as err:
+                raise SocketError(err)
+            if not data:
+                raise SocketError("connection closed by beanstalkd")
+            parser.feed(data)
+
+    async def _send(self, request):
+        metrics = self.metrics
+        if metrics is None:
+            return await self._exchange(request)
+        start = metrics.start(request)
+        try:
+            response = await self._exchange(request)
+        except (asyncio.CancelledError, BeanstalkdException) as err:
+            metrics.fail(request, err, start)
+            raise
+        metrics.finish(request, response, start)
+        return response
+
+    async def _exchange(self, request):
+        try:
+            self._writer.writelines(request.buffers)
+            await self._writer.drain()
+        except OSError as err:
+            raise SocketError(err)
+        return await self._recv()
+
+    async def _call(self, request):
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._restore()
+                response = await self._send(request)
+            except (asyncio.CancelledError, SocketError):
+                # the response will never be read, so the connection can't be used anymore
+                self._drop()
+                raise
+        return request.result(self, response)
+
+    async def send_command(self, command, *args, ok_status=None, error_status=None):
+        """
+        Send the `command` to beanstalkd server and validate the response based on `ok_status` and `error_status`
+        :param command: command to be sent
+        :type command: str
+        :param ok_status: status that indicate a successful request
+        :type ok_status: list of str
+        :param error_status: status that indicate an error
+        :type error_status: list of str
+        :return: status and the rest of the response, as Connection.send_command
+        :rtype: (str, bytes)
+        """
+        return _status_pair(await self._call(Request(command, *args, ok_status=ok_status, error_status=error_status)))
+
+    async def using(self):
+        """
+        Return the tube currently being used, from the local tube cache: no round trip
+        :rtype: str
+        """
+        return self._using
+
+    async def use(self, name):
+        """
+        Use a `name` tube. Nothing is sent if it's already the tube in use
+        :type name: str
+        :rtype: str
+        """
+        if name == self._using:
+            return name
+        return await super(AsyncConnection, self).use(name)
+
+    async def watch(self, name):
+        """
+        Watch a given tube. Nothing is sent if it's already watched
+        :type name: str
+        :rtype: int
+        """
+        self._check_name_size(name)
+        if name in self._watching:
+            return len(self._watching)
+        return await super(AsyncConnection, self).watch(name)
+
+    async def ignore(self, name):
+        """
+        Stop watching a given tube. Nothing is sent if it's not watched
+        :type name: str
+        :rtype: int
+        """
+        self._check_name_size(name)
+        if name not in self._watching:
+            return len(self._watching)
+        return await super(AsyncConnection, self).ignore(name)
+
+    async def watching(self):
+        """
+        Return the tubes being watched, from the local tube cache: no round trip
+        :rtype: list of str | str
+        """
+        return Connection.watching(self)
+
+    async def reserve(self, timeout=None, raw=False, metadata=False):
+        """
+        Same as Connection.reserve: with `metadata` the stats-job of the job is asked right away and cached
+        :type timeout: int | timedelta
+        :type raw: bool
+        :type metadata: bool
+        :rtype: AsyncJob
+        """
+        job = await super(AsyncConnection, self).reserve(timeout, raw)
+        if metadata and job is not None:
+            job._remember(await self._job_stats(job.job_id))
+        return job
+
+    def _parse_job(self, response, raw=False, decode=True):
+        """
+        Build an AsyncJob from a RESERVED or FOUND response
+        :param response: parsed response
+        :type response: pystalkd.Protocol.Response
+        :param raw: If True then the job body is kept as bytes and not decoded to str
+        :type raw: bool
+        :param decode: decode bodies encoded by a codec, lazily
+        :type decode: bool
+        :rtype: AsyncJob
+        """
+        job_id, job_body_size = response.args[:2]
+        key, body, size = None, response.body, int(job_body_size)
+        if self.idempotency_keys or self.dedup is not None:
+            key, body, size = _split_key(body, size)
+        body, size, blob, error = self._check_out(int(job_id), body, size)
+        if self._codecs and decode:
+            return AsyncJob(self, int(job_id), body, size, decoder=partial(self._decode, raw), blob=blob,
+                            idempotency_key=key, error=error)
+        decoder = None if raw else decode_utf8
+        return AsyncJob(self, int(job_id), body, size, decoder=decoder, blob=blob, idempotency_key=key,
+                        error=error)
+
+    _parse_yaml = Connection._parse_yaml
+    set_codec = Connection.set_codec
+    _codec = Connection._codec
+    _decode = Connection._decode
+    _check_out = Connection._check_out
+
+    @asynccontextmanager
+    async def temporary_use(self, name):
+        """
+        Use a `name` tube temporarily and then go back to the previous one. To be used in async with statements.
+        :param name: name of the tube
+        :type name: str
+        """
+        old = self._using
+        await self.use(name)
+        yield
+        await self.use(old)
+
+    @asynccontextmanager
+    async def temporary_watch(self, name):
+        """
+        Watch a given tube and then ignores it. To be used in async with statements.
+        :param name: name of tube
+        :type name: str
+        """
+        await self.watch(name)
+        yield
+        await self.ignore(name)
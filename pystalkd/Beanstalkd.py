@@ -2,9 +2,15 @@
 
 """pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
 from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+from time import monotonic
 import socket
+import threading
+import weakref
 from datetime import timedelta
-from .Job import Job
+from .Job import Job, decode_utf8
+from .Protocol import Response, ResponseParser, ProtocolError, UnsupportedYaml, parse_yaml
 
 __license__ = '''
 Copyright (C) 2008-2014 Andreas Bolka
@@ -36,6 +42,20 @@ DEFAULT_HOST = 'localhost'
 DEFAULT_PORT = 11300
 DEFAULT_PRIORITY = 2 ** 31
 DEFAULT_TTR = 120
+RECV_SIZE = 65536
+# replies of a window must fit in the socket buffers, or the server stops reading while we are still writing
+PIPELINE_WINDOW = 1000
+# smaller bodies are copied after the command line, bigger ones are sent from their own buffer with sendmsg
+SCATTER_GATHER_SIZE = 16384
+# buffers per sendmsg call, below IOV_MAX of every supported platform
+MAX_IOV = 512
+# bodies bigger than this go to the blob store of the connection, if any. Default max-job-size of beanstalkd
+BLOB_THRESHOLD = 65535
+# start of the body of jobs whose payload is in a blob store, followed by the key of the blob
+CLAIM_CHECK = b"\xffCC"
+# start of the body of jobs put with an idempotency key, followed by the length of the key (1 byte), the key and the
+# body. Outside of the codec and claim-check envelopes
+IDEMPOTENCY_KEY = b"\xffIK"
 
 
 class BeanstalkdException(Exception):
@@ -80,137 +100,372 @@ def total_seconds(td):
     return int(((td.seconds + td.days * 24 * 3600) * 10 ** 6) / 10 ** 6)
 
 
-class Connection(object):
-    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, parse_yaml=True,
-                 connect_timeout=socket.getdefaulttimeout()):
-        self.port = port
-        self.host = host
-        if parse_yaml:
-            try:
-                import yaml
-            except ImportError:
-                parse_yaml = False
+def encode_command(command, *args):
+    """
+    Encode a beanstalkd command line. Arguments that are not bytes are converted with `str`
+    :param command: beanstalkd command i.e "put"
+    :type command: str
+    :return: command ready to be sent, terminated by '\r\n'
+    :rtype: bytes
+    """
+    args = [bytes(str(s), 'utf8') if not isinstance(s, bytes) else s for s in args]
 
-        self.parse_yaml = parse_yaml
+    # from here args is list of bytes
+    """:type args: list of bytes"""
 
-        self.server_errors = ["OUT_OF_MEMORY", "INTERNAL_ERROR", "BAD_FORMAT", "UNKNOWN_COMMAND"]
+    tokens = [command.encode('utf8')] + args
+    return b" ".join(tokens) + b'\r\n'
 
-        self._connect_timeout = connect_timeout
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connect()
 
-    def connect(self):
-        """Connect to beanstalkd server."""
-        if not self._socket:
-            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.settimeout(self._connect_timeout)
-        SocketError.wrap(self._socket.connect, (self.host, self.port))
+def sendmsg_all(sock, buffers):
+    """
+    Send all `buffers`, in order, with scatter-gather IO: the kernel reads them where they are, nothing is
+    concatenated. Falls back to one sendall per buffer where sendmsg is not available (i.e. Windows)
+    :type sock: socket.socket
+    :param buffers: objects supporting the buffer protocol, in byte format
+    :type buffers: list of (bytes | bytearray | memoryview)
+    """
+    if not hasattr(sock, "sendmsg"):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    views = [memoryview(buffer) for buffer in buffers]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + MAX_IOV])
+        # skip what was sent, a partial send leaves the rest of a buffer for the next call
+        while sent:
+            size = views[first].nbytes
+            if sent >= size:
+                sent -= size
+                first += 1
+            else:
+                views[first] = views[first][sent:]
+                sent = 0
+        while first < len(views) and not views[first].nbytes:
+            first += 1
+
+
+class Request(object):
+    def __init__(self, command, *args, body=None, ok_status=None, error_status=None, handler=None, on_failure=None):
+        """
+        A command waiting to be sent together with what is needed to interpret its response.
+        Requests don't do any IO, so the same request can be executed by a Connection or queued in a Pipeline
+        :param command: command to be sent
+        :type command: str
+        :param args: arguments to the command
+        :type args: list of str | list of bytes
+        :param body: data sent after the command line (i.e. the job body of put). Bodies of at least
+        SCATTER_GATHER_SIZE bytes are not copied, they are sent from their own buffer
+        :type body: bytes | bytearray | memoryview
+        :param ok_status: status that indicate a successful request
+        :type ok_status: list of str
+        :param error_status: status that indicate an error
+        :type error_status: list of str
+        :param handler: called as handler(connection, response) to convert a successful response to the result of
+        the command. If None the response itself is the result
+        :type handler: callable
+        :param on_failure: called with the status when the response is not an ok status (i.e. to undo work done
+        before sending the command)
+        :type on_failure: callable
+        """
+        self.command = command
+        self.args = args
+        self.data = encode_command(command, *args)
+        self.body = None
+        if body is not None:
+            if len(body) < SCATTER_GATHER_SIZE:
+                self.data = b"".join((self.data, body, b"\r\n"))
+            else:
+                self.body = body
+        # the data chunk of the response can be a view over the receive buffer (see Connection.reserve_view)
+        self.view = False
+        self.ok_status = ok_status or []
+        self.error_status = error_status or []
+        self.handler = handler
+        self.on_failure = on_failure
+
+    @property
+    def buffers(self):
+        """
+        What has to be sent, in order: the command line and the body when it's not copied after it
+        :rtype: list of (bytes | bytearray | memoryview)
+        """
+        if self.body is None:
+            return [self.data]
+        return [self.data, self.body, b"\r\n"]
 
-    def close(self):
-        """close connection and send exit to beanstalkd server"""
-        command = b"quit\r\n"
+    def result(self, connection, response):
+        """
+        Validate `response` based on `ok_status` and `error_status` and convert it using `handler`
+        :param connection: connection that executed the request
+        :type connection: Connection
+        :type response: pystalkd.Protocol.Response
+        :return: result of the command
+        """
+        status = response.status
+        if status in self.ok_status:
+            if self.handler is None:
+                return response
+            return self.handler(connection, response)
+        if self.on_failure is not None:
+            self.on_failure(status)
+        if status in self.error_status:
+            raise CommandFailed(status)
+        elif status in connection.server_errors:
+            raise BeanstalkdException(status)
+        else:
+            raise UnexpectedResponse(status)
+
+
+def _put_request(body, priority, delay, ttr, raw, codec=None, store=None, threshold=BLOB_THRESHOLD, key=None,
+                 dedup=None):
+    if codec is not None and not raw:
+        body = codec.encode(body)
+        raw = True
+    if raw:
         try:
-            self._socket.sendall(command)
-            self._socket.close()
-        except socket.error:
-            pass
+            body = memoryview(body)
+        except TypeError:
+            raise AssertionError('Job body must be a bytes-like object')
+        if body.format != "B" or body.ndim != 1:
+            body = body.cast("B")
+    else:
+        assert isinstance(body, str), 'Job body must be a str instance'
+        body = body.encode("utf8")
+
+    on_failure = None
+    if store is not None and len(body) > threshold:
+        blob_key = store.put(body)
+        body = CLAIM_CHECK + blob_key.encode("ascii")
+        # a buried job still exists, so does its blob
+        on_failure = partial(_discard_blob, store, blob_key)
+
+    handler = _first_int
+    if key is not None:
+        encoded_key = key.encode("utf8")
+        assert len(encoded_key) < 256, "idempotency keys are at most 255 bytes"
+        body = b"".join((IDEMPOTENCY_KEY, bytes((len(encoded_key),)), encoded_key, body))
+        if dedup is not None:
+            handler = partial(_inserted, dedup, key)
+
+    if isinstance(ttr, timedelta):
+        ttr = total_seconds(ttr)
+    if isinstance(delay, timedelta):
+        delay = total_seconds(delay)
+    ok_status = ['INSERTED']
+    error_status = ['JOB_TOO_BIG', 'BURIED', 'DRAINING', 'EXPECTED_CRLF']
+
+    return Request("put", priority, delay, ttr, len(body), body=body,
+                   ok_status=ok_status,
+                   error_status=error_status,
+                   handler=handler,
+                   on_failure=on_failure)
+
+
+def _inserted(dedup, key, connection, response):
+    job_id = int(response.args[0])
+    dedup.add(key, job_id)
+    return job_id
+
+
+def _split_key(body, size):
+    """
+    Separate the idempotency key from the body of a job put with one. A body that doesn't hold a whole envelope
+    with a utf8 key is returned as it is
+    :return: key or None, body and its size
+    :rtype: tuple
+    """
+    start = len(IDEMPOTENCY_KEY) + 1
+    if size < start or body[:len(IDEMPOTENCY_KEY)] != IDEMPOTENCY_KEY:
+        return None, body, size
+    end = start + body[len(IDEMPOTENCY_KEY)]
+    if end > size:
+        return None, body, size
+    try:
+        key = str(body[start:end], "utf8")
+    except UnicodeDecodeError:
+        return None, body, size
+    return key, body[end:], size - end
+
+
+def _status_pair(response):
+    """
+    (status, rest) of `response`, as send and send_command always returned them: the reply stripped of its
+    surrounding whitespace, without the status. That's the rest of the status line, then CRLF and the data chunk for
+    the replies that have one (i.e. b"12 5\r\nhello" for RESERVED, see `parse_job`), or the status itself when
+    nothing follows it
+    :type response: pystalkd.Protocol.Response
+    :rtype: (str, bytes)
+    """
+    status = response.status.encode("utf8")
+    reply = b" ".join([status] + list(response.args))
+    if response.body is not None:
+        reply = b"".join((reply, b"\r\n", response.body))
+    words = reply.strip().split(maxsplit=1)
+    return response.status, words[-1]
 
-    def reconnect(self):
-        self.close()
-        self._socket = None
-        self.connect()
 
-    def _recv(self):
-        """
-        Return response from beanstalkd
-        **WARNING**: if your data has '\r\n' your data my come corrupted, since \r\n is the final delimiter for
-         beanstalkd. Encode your data.
-        :return: response
-        :rtype: bytes
+def _discard_blob(store, key, status):
+    if status != "BURIED":
+        store.delete(key)
 
-        """
-        buffer_size = 4096
-        recvbuff = bytearray(buffer_size)
-        byte_list = []
-        mem_view = memoryview(recvbuff)
 
-        while True:
+def _reserve_request(timeout, handler):
+    if isinstance(timeout, timedelta):
+        timeout = total_seconds(timeout)
 
-            n_bytes = SocketError.wrap(self._socket.recv_into, mem_view)
+    if timeout is None:
+        command = "reserve"
+        args = []
+    else:
+        command = "reserve-with-timeout"
+        args = [timeout, ]
+    ok_status = ["RESERVED", "DEADLINE_SOON", "TIMED_OUT"]
+    return Request(command, *args, ok_status=ok_status, handler=handler)
 
-            mem_view = mem_view[0:n_bytes]
-            byte_list.append(mem_view.tobytes())
-            test_protocol_end = mem_view[-2:]
-            if test_protocol_end == b'\r\n' or len(test_protocol_end) < 2:
-                break
 
-        return b''.join(byte_list)
+def _job_id(job):
+    return job.job_id if isinstance(job, Job) else job
 
-    def send(self, command, *args):
-        """
-        Low-level send command. It sends the `command` string with the arguments present in `args`
-        :param command: beanstalkd command i.e "put"
-        :type command: str
-        :return: string with beanstalkd return
-        :rtype: (str, bytearray)
-        """
 
-        args = [bytes(str(s), 'utf8') if not isinstance(s, bytes) else s for s in args]
+def _first_int(connection, response):
+    return int(response.args[0])
 
-        # from here args is list of bytes
-        """:type args: list of bytes"""
 
-        tokens = [command.encode('utf8')] + args
-        command = b" ".join(tokens) + b'\r\n'
-        SocketError.wrap(self._socket.sendall, command)
+def _used(connection, response):
+    connection._using = str(response.args[0], "utf8")
+    return connection._using
 
-        response = self._recv()
-        response = response.strip().split(maxsplit=1)
-        if len(response) == 1:
-            status, rest = response[0], response[0]
-        else:
-            status, rest = response
 
-        status = status.decode("utf8")
-        if status in self.server_errors:
-            raise BeanstalkdException(status)
-        return status, rest
+def _watched(name, connection, response):
+    if name not in connection._watching:
+        connection._watching.append(name)
+    return int(response.args[0])
 
-    def send_command(self, command, *args, ok_status=None, error_status=None):
+
+def _ignored(name, connection, response):
+    if name in connection._watching:
+        connection._watching.remove(name)
+    return int(response.args[0])
+
+
+def _job(connection, response):
+    if response.status == "NOT_FOUND":
+        return None
+    return connection._parse_job(response)
+
+
+def _job_bytes(connection, response):
+    return connection._parse_job(response, True)
+
+
+def _reserved_job(connection, response):
+    if response.status == "TIMED_OUT":
+        return None
+    elif response.status == "DEADLINE_SOON":
+        raise DeadlineSoon(response.status)
+    return connection._parse_job(response)
+
+
+def _reserved_job_bytes(connection, response):
+    if response.status == "TIMED_OUT":
+        return None
+    elif response.status == "DEADLINE_SOON":
+        raise DeadlineSoon(response.status)
+    return connection._parse_job(response, True)
+
+
+def _reserved_job_view(connection, response):
+    if response.status == "TIMED_OUT":
+        return None
+    elif response.status == "DEADLINE_SOON":
+        raise DeadlineSoon(response.status)
+    job = connection._parse_job(response, True, decode=False)
+    if not isinstance(job.body, memoryview):
+        # the body was copied (i.e. in a pipeline), same type anyway
+        job.body = memoryview(job.body)
+    return job
+
+
+def _yaml(connection, response):
+    return connection._parse_yaml(response)
+
+
+def _tube_list(connection, response):
+    try:
+        return parse_yaml(response.body, plain=True)
+    except UnsupportedYaml as err:
+        raise UnexpectedResponse(str(err))
+
+
+def _job_stats(connection, response):
+    try:
+        return parse_yaml(response.body, as_str=("tube", "state"))
+    except UnsupportedYaml as err:
+        raise UnexpectedResponse(str(err))
+
+
+def _kicked(job_id, connection, response):
+    return job_id
+
+
+def _nothing(connection, response):
+    return None
+
+
+class Commands(object):
+    """
+    All beanstalkd commands that take a single request/response.
+    Subclasses decide what executing a command means by implementing `_call`: Connection sends it and waits for the
+    response, Pipeline queues it to be sent later together with other commands
+    """
+
+    def _call(self, request):
         """
-        Send the `command` to beanstalkd server and validate the response based on `ok_status` and `error_status`
-        :param command: command to be sent
-        :type command: str
-        :param args: arguments to the command. Type depends on the `raw` argument
-        :type args: list of str | list of bytes
-        :param ok_status: status that indicate a successful request
-        :type ok_status: list of str
-        :param error_status: status that indicate an error
-        :type error_status: list of str
-        :param raw: If true then `args` is a list bytes instead of list of str
-        :type raw: bool
-        :rtype: (str, bytearray)
+        Execute `request`
+        :type request: Request
         """
-        status, command_body = self.send(command, *args)
+        raise NotImplementedError()
 
-        if not ok_status:
-            ok_status = []
-        if not error_status:
-            error_status = []
+    # claim-check store of the bodies of put bigger than _blob_threshold, see Connection
+    _blob_store = None
+    _blob_threshold = BLOB_THRESHOLD
+    # index of the idempotency keys of the jobs put, see Connection
+    dedup = None
+    idempotency_keys = False
 
-        if status in ok_status:
-            return status, command_body
-        elif status in error_status:
-            raise CommandFailed(status)
-        else:
-            raise UnexpectedResponse(status)
+    def _codec(self):
+        """
+        Codec encoding the body of put, None to send it as is
+        :rtype: pystalkd.Codec.Codec | None
+        """
+        return None
 
-    def put(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR, raw=False):
+    def parse_job(self, body, raw=False):
+        """
+        Build a Job from the rest of a RESERVED or FOUND reply returned by `send` or `send_command`
+        (b"<id> <size>\r\n<data>")
+        :type body: bytes
+        :param raw: If True then the job body is kept as bytes and not decoded to str
+        :type raw: bool
+        :rtype: pystalkd.Job.Job
+        """
+        line, _, data = bytes(body).partition(b"\r\n")
+        job_id, size = line.split()[:2]
+        return self._parse_job(Response("RESERVED", [job_id, size], data[:int(size)]), raw)
+
+    def put(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR, raw=False, idempotency_key=None):
         """
         Put a job into the current tube. Returns job id.
         See https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#put-command for full info.
-        :param body: body of job
-        :type body: str | bytes
+        With an `idempotency_key` the job isn't put again if the `dedup` index of the connection knows the key, the
+        id of the first job is returned instead. The key also travels with the job (Job.idempotency_key, read by
+        connections with `idempotency_keys` or a `dedup` index), so consumers can skip the duplicates left by retries
+        whose INSERTED reply was lost
+        :param body: body of job. With `raw` any bytes-like object (bytearray, memoryview, mmap...), big bodies are
+        sent from where they are without being copied
+        :type body: str | bytes | bytearray | memoryview
         :param priority: priority of the job. Defaults to 2**31
         :type priority: long
         :param delay: number of seconds to wait before putting the job in the ready queue
@@ -219,60 +474,38 @@ class Connection(object):
         :type ttr: int | timedelta
         :param raw: If true then send body as bytes and not str
         :type raw: bool
+        :param idempotency_key: up to 255 bytes of utf8
+        :type idempotency_key: str
         :return: job id
         :rtype: int
 
         """
-        if raw:
-            assert isinstance(body, bytes), 'Job body must be a bytes instance'
-        else:
-            assert isinstance(body, str), 'Job body must be a str instance'
-
-        if isinstance(ttr, timedelta):
-            ttr = total_seconds(ttr)
-        if isinstance(delay, timedelta):
-            delay = total_seconds(delay)
-        ok_status = ['INSERTED']
-        error_status = ['JOB_TOO_BIG', 'BURIED', 'DRAINING', 'EXPECTED_CRLF']
-        if raw:
-            body_len = bytes(str(len(body)), "utf8") + b"\r\n"
-        else:
-
-            body_len = str(len(body.encode("utf8"))) + "\r\n"
-
-        status, job = self.send_command("put", priority, delay, ttr, body_len + body,
-                                        ok_status=ok_status,
-                                        error_status=error_status)
-
-        return int(job)
-
-    def put_bytes(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR):
+        dedup = self.dedup
+        if idempotency_key is not None and dedup is not None:
+            job_id = dedup.get(idempotency_key)
+            if job_id is not None:
+                return job_id
+        return self._call(_put_request(body, priority, delay, ttr, raw, self._codec(), self._blob_store,
+                                       self._blob_threshold, idempotency_key, dedup))
+
+    def put_bytes(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR, idempotency_key=None):
         """
         Put a job into the current tube. Returns job id.
         See https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#put-command for full info.
-        :param body: body of job
-        :type body: bytes
+        :param body: body of job, any bytes-like object
+        :type body: bytes | bytearray | memoryview
         :param priority: priority of the job. Defaults to 2**31
         :type priority: long
         :param delay: number of seconds to wait before putting the job in the ready queue
         :type delay: int | timedelta
         :param ttr:  number of seconds to allow a worker to run this job
         :type ttr: int | timedelta
+        :param idempotency_key: see `put`
+        :type idempotency_key: str
         :return: job id
         :rtype: int
         """
-        return self.put(body, priority, delay, ttr, True)
-
-    def parse_job(self, body):
-        job_id, body_rest = body.split(maxsplit=1)
-        try:
-            job_body_size, job_body = body_rest.split(maxsplit=1)
-        except ValueError:
-            job_body_size = "0"
-            job_body = ""
-        job_body = job_body
-        job_body_size = job_body_size
-        return Job(self, int(job_id), job_body, int(job_body_size))
+        return self.put(body, priority, delay, ttr, True, idempotency_key)
 
     def reserve(self, timeout=None, raw=False):
         """
@@ -285,28 +518,26 @@ class Connection(object):
         :return: will return a newly-reserved job
         :rtype: Job
         """
-        if isinstance(timeout, timedelta):
-            timeout = total_seconds(timeout)
-
-        if timeout is None:
-            command = "reserve"
-            args = []
-        else:
-            command = "reserve-with-timeout"
-            args = [timeout, ]
-        ok_status = ["RESERVED", "DEADLINE_SOON", "TIMED_OUT"]
-        status, body = self.send_command(command, *args, ok_status=ok_status)
-        if status == "TIMED_OUT":
-            return None
-        elif status == "DEADLINE_SOON":
-            raise DeadlineSoon(body)
-
-        body = str(body, "utf8") if not raw else body
-        return self.parse_job(body)
+        handler = _reserved_job_bytes if raw else _reserved_job
+        return self._call(_reserve_request(timeout, handler))
 
     def reserve_bytes(self, timeout=None):
         return self.reserve(timeout, True)
 
+    def reserve_view(self, timeout=None):
+        """
+        Same as `reserve_bytes` but the body of the job is a memoryview over the receive buffer of the connection,
+        so big bodies are never copied. The view is only valid until the next command sent through the connection:
+        call `bytes(job.body)` to keep it longer.
+        In pipelines and with AsyncConnection the body is copied anyway, since other responses may be read before
+        the job is used
+        :type timeout: int | timedelta
+        :rtype: Job
+        """
+        request = _reserve_request(timeout, _reserved_job_view)
+        request.view = True
+        return self._call(request)
+
     def kick(self, bound=1):
         """Kick at most bound jobs into the ready queue.
         If there are any buried jobs, it will only kick buried jobs.
@@ -315,8 +546,7 @@ class Connection(object):
         :return: count of kicked jobs
         :rtype: int
         """
-        _, body = self.send_command("kick", bound, ok_status=["KICKED", ])
-        return int(body)
+        return self._call(Request("kick", bound, ok_status=["KICKED", ], handler=_first_int))
 
     def kick_job(self, job_id):
         """If the given `job_id` exists and is in a buried or
@@ -327,8 +557,8 @@ class Connection(object):
         :return: job_id
         :rtype: int
         """
-        _, body = self.send_command("kick-job", job_id, ok_status=["KICKED"],
-                                    error_status=["NOT_FOUND"])
+        return self._call(Request("kick-job", job_id, ok_status=["KICKED"],
+                                  error_status=["NOT_FOUND"], handler=partial(_kicked, job_id)))
 
     def delete(self, job_id):
         """
@@ -338,7 +568,8 @@ class Connection(object):
         :type job_id: int
         """
 
-        self.send_command("delete", job_id, ok_status=["DELETED", ], error_status=["NOT_FOUND", ])
+        return self._call(Request("delete", job_id, ok_status=["DELETED", ], error_status=["NOT_FOUND", ],
+                                  handler=_nothing))
 
     def peek(self, job_id):
         """Peek at job `job_id`
@@ -349,12 +580,7 @@ class Connection(object):
         :rtype: Job | None
         """
 
-        status, body = self.send_command('peek', job_id, ok_status=["NOT_FOUND", "FOUND"])
-
-        if status == "NOT_FOUND":
-            return None
-
-        return self.parse_job(str(body, "utf8"))
+        return self._call(Request('peek', job_id, ok_status=["NOT_FOUND", "FOUND"], handler=_job))
 
     def _peek_state(self, state):
         """
@@ -364,11 +590,7 @@ class Connection(object):
         :return:
         """
         command = "peek" + "-" + state
-        status, body = self.send_command(command, ok_status=["NOT_FOUND", "FOUND"])
-        if status == "NOT_FOUND":
-            return None
-
-        return self.parse_job(str(body, "utf8"))
+        return self._call(Request(command, ok_status=["NOT_FOUND", "FOUND"], handler=_job))
 
     def peek_ready(self):
         """Peek at next ready job. Returns a Job, or None.
@@ -394,27 +616,15 @@ class Connection(object):
         """
         return self._peek_state('buried')
 
-    def _parse_yaml(self, body):
-
-        body_size, body = body.split(maxsplit=1)
-        body = str(body, "utf8")
-        if not self.parse_yaml:
-            return body
-
-        import yaml
-
-        return yaml.load(body, Loader=yaml.FullLoader)
-
     def tubes(self):
         """Return a list of all existing tubes.
         See https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#list-tubes-command for full info.
-        if `parse_yaml` is True and pyyaml extension is installed it will parse the yaml an return a list else it will
+        if `parse_yaml` is True it will parse the yaml and return a list else it will
         return the yaml string
         :return: list of all tubes
         :rtype: list of str | str
         """
-        _, body = self.send_command("list-tubes", ok_status=["OK"])
-        return self._parse_yaml(body)
+        return self._call(Request("list-tubes", ok_status=["OK"], handler=_yaml))
 
     def using(self):
         """Return the tube currently being used.
@@ -422,8 +632,7 @@ class Connection(object):
         :return: current tube being used
         :rtype: str
         """
-        _, body = self.send_command("list-tube-used", ok_status=["USING"])
-        return str(body, "utf8")
+        return self._call(Request("list-tube-used", ok_status=["USING"], handler=_used))
 
     def use(self, name):
         """Use a `name` tube.
@@ -433,20 +642,7 @@ class Connection(object):
         :return: current tube
         :rtype: str
         """
-        _, body = self.send_command("use", name, ok_status=["USING"])
-        return str(body, "utf8")
-
-    @contextmanager
-    def temporary_use(self, name):
-        """
-        Use a `name` tube temporarily and then go back to the previous one
-        :param name: name of the tube
-        :type name: str
-        """
-        old = self.using()
-        self.use(name)
-        yield
-        self.use(old)
+        return self._call(Request("use", name, ok_status=["USING"], handler=_used))
 
     def _check_name_size(self, name):
         """
@@ -468,30 +664,17 @@ class Connection(object):
         """
         self._check_name_size(name)
 
-        _, body = self.send_command("watch", name, ok_status=["WATCHING"])
-        return int(body)
-
-    @contextmanager
-    def temporary_watch(self, name):
-        """
-        Watch a given tube and then ignores it. To be used in with statements.
-        :param name: name of tube
-        :type name: str
-        """
-        self.watch(name)
-        yield
-        self.ignore(name)
+        return self._call(Request("watch", name, ok_status=["WATCHING"], handler=partial(_watched, name)))
 
     def watching(self):
         """Return a list of all tubes being watched.
         See https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#list-tubes-watched-command for full info.
-        if `parse_yaml` is True and pyyaml extension is installed it will parse the yaml an return a list else it will
+        if `parse_yaml` is True it will parse the yaml and return a list else it will
         return the yaml string
         :return: all tubes being watched
         :rtype: list of str | str
         """
-        _, body = self.send_command("list-tubes-watched", ok_status=["OK"])
-        return self._parse_yaml(body)
+        return self._call(Request("list-tubes-watched", ok_status=["OK"], handler=_yaml))
 
     def ignore(self, name):
         """Stop watching a given tube.
@@ -503,25 +686,23 @@ class Connection(object):
         """
         self._check_name_size(name)
 
-        _, body = self.send_command("ignore", name, ok_status=["WATCHING"], error_status=["NOT_IGNORED"])
-
-        return int(body)
+        return self._call(Request("ignore", name, ok_status=["WATCHING"], error_status=["NOT_IGNORED"],
+                                  handler=partial(_ignored, name)))
 
     def stats(self):
         """Return a dict of beanstalkd statistics.
         See https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#stats-command for full info.
-        if `parse_yaml` is True and PyYaml extension is installed it will parse the yaml an return a dict else it will
+        if `parse_yaml` is True it will parse the yaml and return a dict else it will
         return the yaml string
         :return:  beanstalkd statistics
         :rtype: dict | str
         """
-        _, body = self.send_command("stats", ok_status=["OK"])
-        return self._parse_yaml(body)
+        return self._call(Request("stats", ok_status=["OK"], handler=_yaml))
 
     def stats_tube(self, name):
         """Return a dict of stats about a given tube.
         See https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#stats-tube-command for full info.
-         if `parse_yaml` is True and PyYaml extension is installed it will parse the yaml an return a dict else it will
+         if `parse_yaml` is True it will parse the yaml and return a dict else it will
         return the yaml string
         :param name: tube
         :type name: str
@@ -530,8 +711,7 @@ class Connection(object):
 
         """
         self._check_name_size(name)
-        _, body = self.send_command("stats-tube", name, ok_status=["OK"], error_status=["NOT_FOUND"])
-        return self._parse_yaml(body)
+        return self._call(Request("stats-tube", name, ok_status=["OK"], error_status=["NOT_FOUND"], handler=_yaml))
 
     def pause_tube(self, name, delay):
         """Pause a tube for a given delay time, in seconds.
@@ -545,7 +725,8 @@ class Connection(object):
         if isinstance(delay, timedelta):
             delay = total_seconds(delay)
 
-        self.send_command("pause-tube", name, delay, ok_status=["PAUSED"], error_status=["NOT_FOUND"])
+        return self._call(Request("pause-tube", name, delay, ok_status=["PAUSED"], error_status=["NOT_FOUND"],
+                                  handler=_nothing))
 
     def release(self, job_id, priority=DEFAULT_PRIORITY, delay=0):
         """Release a reserved job back into the ready queue.
@@ -562,8 +743,8 @@ class Connection(object):
         if isinstance(delay, timedelta):
             delay = total_seconds(delay)
         # BURIED is considered an error because, acording to the protocol, "BURIED\r\n if the server ran out of memory trying to grow the priority queue data structure."
-        self.send_command("release", job_id, priority, delay, ok_status=["RELEASED"],
-                          error_status=["BURIED", "NOT_FOUND"])
+        return self._call(Request("release", job_id, priority, delay, ok_status=["RELEASED"],
+                                  error_status=["BURIED", "NOT_FOUND"], handler=_nothing))
 
     def bury(self, job_id, priority=DEFAULT_PRIORITY):
         """Bury a job, by job id.
@@ -574,7 +755,8 @@ class Connection(object):
         :type priority: int
 
         """
-        self.send_command("bury", job_id, priority, ok_status=["BURIED"], error_status=["NOT_FOUND"])
+        return self._call(Request("bury", job_id, priority, ok_status=["BURIED"], error_status=["NOT_FOUND"],
+                                  handler=_nothing))
 
     def touch(self, job_id):
         """Touch a job, by `job_id`, requesting more time to work on a reserved
@@ -583,12 +765,13 @@ class Connection(object):
         :param job_id: job id
         :type job_id: int
         """
-        self.send_command("touch", job_id, ok_status=["TOUCHED"], error_status=["NOT_FOUND"])
+        return self._call(Request("touch", job_id, ok_status=["TOUCHED"], error_status=["NOT_FOUND"],
+                                  handler=_nothing))
 
     def stats_job(self, job_id):
         """Return a dict of stats about a job, by job id.
         See https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#stats-job-command for full info.
-        if `parse_yaml` is True and PyYaml extension is installed it will parse the yaml an return a dict else it will
+        if `parse_yaml` is True it will parse the yaml and return a dict else it will
         return the yaml string
         :param job_id: job id
         :type job_id: int
@@ -596,5 +779,840 @@ class Connection(object):
         :rtype: dict | str
 
         """
-        _, body = self.send_command("stats-job", job_id, ok_status=["OK"], error_status=["NOT_FOUND"])
-        return self._parse_yaml(body)
+        return self._call(Request("stats-job", job_id, ok_status=["OK"], error_status=["NOT_FOUND"], handler=_yaml))
+
+    def _job_stats(self, job_id):
+        """
+        stats-job always parsed to a dict, whatever `parse_yaml` is. Used for the metadata of Job
+        :type job_id: int
+        :rtype: dict
+        """
+        return self._call(Request("stats-job", job_id, ok_status=["OK"], error_status=["NOT_FOUND"],
+                                  handler=_job_stats))
+
+
+class Connection(Commands):
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, parse_yaml=True,
+                 connect_timeout=socket.getdefaulttimeout(), yaml_fallback=False, codec=None, blob_store=None,
+                 blob_threshold=BLOB_THRESHOLD, metrics=None, dedup=None, idempotency_keys=False):
+        self.port = port
+        self.host = host
+        # stats and lists are parsed by pystalkd.Protocol.parse_yaml, PyYaml is only imported by the fallback
+        self.parse_yaml = parse_yaml
+        self.yaml_fallback = yaml_fallback
+        # codec by tube name, None is the default one. See set_codec
+        self._codecs = {}
+        self._accept = None
+        if codec is not None:
+            self.set_codec(codec)
+        self._blob_store = blob_store
+        self._blob_threshold = blob_threshold
+        # pystalkd.Metrics.Metrics recording every command, None to record nothing. Can be changed at any time
+        self.metrics = metrics
+        # pystalkd.Dedup index of the idempotency keys of put, None to put every job. Can be changed at any time
+        self.dedup = dedup
+        # read the idempotency key of reserved and peeked jobs (Job.idempotency_key), always done with a dedup index.
+        # Off by default: bodies put without a key are returned as they are, whatever their first bytes
+        self.idempotency_keys = idempotency_keys
+
+        self.server_errors = ["OUT_OF_MEMORY", "INTERNAL_ERROR", "BAD_FORMAT", "UNKNOWN_COMMAND"]
+
+        self._connect_timeout = connect_timeout
+        # created by connect
+        self._socket = None
+        self._parser = None
+        # a command and its response are one exchange, so helper threads (i.e. LeaseKeeper) can share the connection
+        self._lock = threading.RLock()
+        # DeferredAcks of the connection, their pending acks go out with the next reserve
+        self._deferred_acks = weakref.WeakSet()
+        self.connect()
+
+    def connect(self):
+        """Connect to beanstalkd server."""
+        if not self._socket:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # leftovers from a previous connection are meaningless on a new one
+        self._parser = ResponseParser(RECV_SIZE)
+        # client-side copy of the tube state, kept current from USING and WATCHING responses so using(), watching()
+        # and redundant use/watch/ignore don't need a round trip. A new connection starts with the server defaults
+        self._using = "default"
+        self._watching = ["default"]
+        self._socket.settimeout(self._connect_timeout)
+        SocketError.wrap(self._socket.connect, (self.host, self.port))
+
+    def close(self):
+        """close connection and send exit to beanstalkd server"""
+        command = b"quit\r\n"
+        try:
+            self._socket.sendall(command)
+            self._socket.close()
+        except socket.error:
+            pass
+
+    def reconnect(self):
+        self.close()
+        self._socket = None
+        self.connect()
+
+    def _recv(self, copy=True):
+        """
+        Return the next response from beanstalkd.
+        Reads go straight into the persistent buffer of the protocol parser, which knows exactly how many bytes of
+        data follow RESERVED, FOUND and OK replies, so job bodies are never cut short (even if they contain '\r\n')
+        and bytes belonging to the next response are kept for the next call.
+        :param copy: if False the data chunk is a view over the receive buffer, valid until the next read
+        :type copy: bool
+        :return: response
+        :rtype: pystalkd.Protocol.Response
+
+        """
+        parser = self._parser
+        while True:
+            try:
+                response = parser.next_response(copy)
+            except ProtocolError as err:
+                raise UnexpectedResponse(str(err))
+            if response is not None:
+                return response
+
+            n_bytes = SocketError.wrap(self._socket.recv_into, parser.get_buffer(RECV_SIZE))
+            if not n_bytes:
+                raise SocketError("connection closed by beanstalkd")
+            parser.buffer_updated(n_bytes)
+
+    def send(self, command, *args):
+        """
+        Low-level send command. It sends the `command` string with the arguments present in `args`
+        :param command: beanstalkd command i.e "put"
+        :type command: str
+        :return: status and the rest of the response, see `_status_pair`
+        :rtype: (str, bytes)
+        """
+        if self.metrics is not None:
+            request = Request(command, *args)
+            response = self._exchange(request, lambda status: status in self.server_errors)
+        else:
+            with self._lock:
+                self._send_buffers([encode_command(command, *args)])
+                response = self._recv()
+        if response.status in self.server_errors:
+            raise BeanstalkdException(response.status)
+        self._track(command, args, response)
+        return _status_pair(response)
+
+    def send_command(self, command, *args, ok_status=None, error_status=None):
+        """
+        Send the `command` to beanstalkd server and validate the response based on `ok_status` and `error_status`
+        :param command: command to be sent
+        :type command: str
+        :param args: arguments to the command. Type depends on the `raw` argument
+        :type args: list of str | list of bytes
+        :param ok_status: status that indicate a successful request
+        :type ok_status: list of str
+        :param error_status: status that indicate an error
+        :type error_status: list of str
+        :return: status and the rest of the response, see `_status_pair`
+        :rtype: (str, bytes)
+        """
+        response = self._call(Request(command, *args, ok_status=ok_status, error_status=error_status))
+        self._track(command, args, response)
+        return _status_pair(response)
+
+    def _track(self, command, args, response):
+        """
+        Keep the tube cache right when use, watch or ignore are sent with `send` or `send_command`
+        """
+        if response.status == "USING":
+            _used(self, response)
+        elif response.status == "WATCHING" and command in ("watch", "ignore") and args:
+            name = args[0] if isinstance(args[0], str) else str(args[0], "utf8")
+            (_watched if command == "watch" else _ignored)(name, self, response)
+
+    def using(self):
+        """
+        Return the tube currently being used, from the local tube cache: no round trip.
+        :rtype: str
+        """
+        return self._using
+
+    def use(self, name):
+        """
+        Use a `name` tube. Nothing is sent if it's already the tube in use
+        :param name: name of the tube
+        :type name: str
+        :return: current tube
+        :rtype: str
+        """
+        if name == self._using:
+            return name
+        return super(Connection, self).use(name)
+
+    def watch(self, name):
+        """
+        Watch a given tube. Nothing is sent if it's already watched
+        :param name: name of the tube
+        :type name: str
+        :return: number of tubes currently in the watch list.
+        :rtype: int
+        """
+        self._check_name_size(name)
+        if name in self._watching:
+            return len(self._watching)
+        return super(Connection, self).watch(name)
+
+    def ignore(self, name):
+        """
+        Stop watching a given tube. Nothing is sent if it's not watched
+        :param name: name of tube
+        :type name: str
+        :return: number of tubes currently in the watch list.
+        :rtype: int
+        """
+        self._check_name_size(name)
+        if name not in self._watching:
+            return len(self._watching)
+        return super(Connection, self).ignore(name)
+
+    def watching(self):
+        """
+        Return the tubes being watched, from the local tube cache: no round trip.
+        If `parse_yaml` is False it returns the yaml string, as the server would
+        :rtype: list of str | str
+        """
+        if not self.parse_yaml:
+            return "---\n" + "".join("- {}\n".format(name) for name in self._watching)
+        return list(self._watching)
+
+    def refresh_tubes(self):
+        """
+        Rebuild the tube cache from the server with pipelined list-tube-used and list-tubes-watched. Only needed
+        if the tube state was changed behind the back of the connection
+        :return: used tube and watched tubes
+        :rtype: (str, list of str)
+        """
+        pipeline = self.pipeline()
+        pipeline._call(Request("list-tube-used", ok_status=["USING"], handler=_used))
+        pipeline._call(Request("list-tubes-watched", ok_status=["OK"], handler=_tube_list))
+        _, watching = pipeline.execute(raise_on_error=True)
+        self._watching = watching
+        return self._using, list(watching)
+
+    def _send_buffers(self, buffers):
+        if len(buffers) == 1:
+            SocketError.wrap(self._socket.sendall, buffers[0])
+        else:
+            SocketError.wrap(sendmsg_all, self._socket, buffers)
+
+    def _send_requests(self, requests, buffers):
+        """
+        Send `buffers`, the encoded `requests`. Called holding the lock, the requests let subclasses adapt the socket
+        to the batch being sent
+        :type requests: list of Request
+        :type buffers: list of bytes
+        """
+        self._send_buffers(buffers)
+
+    def _call(self, request):
+        if request.command in ("reserve", "reserve-with-timeout"):
+            pending = [acks for acks in self._deferred_acks if acks]
+            if pending:
+                for acks in pending[1:]:
+                    acks.flush()
+                return pending[0]._flush_with(request)
+        if self.metrics is not None:
+            return request.result(self, self._exchange(request))
+        with self._lock:
+            self._send_requests([request], request.buffers)
+            response = self._recv(not request.view)
+        return request.result(self, response)
+
+    def _exchange(self, request, failed=None):
+        """
+        Send `request` and read its response, recording both in `metrics`
+        :param failed: tells from the status whether the response is a failure, see Metrics.finish
+        :type failed: callable
+        :rtype: pystalkd.Protocol.Response
+        """
+        metrics = self.metrics
+        start = metrics.start(request)
+        try:
+            with self._lock:
+                self._send_requests([request], request.buffers)
+                response = self._recv(not request.view)
+        except BeanstalkdException as err:
+            metrics.fail(request, err, start)
+            raise
+        metrics.finish(request, response, start, None if failed is None else failed(response.status))
+        return response
+
+    def _call_many(self, requests, window=PIPELINE_WINDOW):
+        """
+        Execute `requests` pipelined: up to `window` requests are written with a single send (bodies too big to be
+        copied are sent in place with scatter-gather IO) and then their responses are read in order. Failed commands
+        don't stop the others, their exception is yielded in place of the result.
+        Socket and protocol errors are raised since after them the state of the connection is unknown
+        :param requests: requests to be executed. Can be a generator, it's consumed one window at a time
+        :type requests: collections.Iterable[Request]
+        :param window: maximum number of requests waiting for a response
+        :type window: int
+        :return: result or exception of each request, in the same order as `requests`
+        :rtype: collections.Iterator
+        """
+        requests = iter(requests)
+        while True:
+            batch = list(islice(requests, window))
+            if not batch:
+                return
+            buffers = []
+            small = []
+            for request in batch:
+                small.append(request.data)
+                if request.body is not None:
+                    buffers.append(b"".join(small))
+                    buffers.append(request.body)
+                    small = [b"\r\n"]
+            buffers.append(b"".join(small))
+            metrics = self.metrics
+            if metrics is not None:
+                responses = self._exchange_many(batch, buffers, metrics)
+            else:
+                with self._lock:
+                    self._send_requests(batch, buffers)
+                    responses = [self._recv() for _ in batch]
+            # every response of the batch has to be read to keep the connection usable, so errors are collected
+            results = []
+            for request, response in zip(batch, responses):
+                try:
+                    results.append(request.result(self, response))
+                except BeanstalkdException as err:
+                    results.append(err)
+            for result in results:
+                yield result
+
+    def _exchange_many(self, batch, buffers, metrics):
+        """
+        Send a batch of pipelined requests and read their responses, recording each of them in `metrics`
+        :rtype: list of pystalkd.Protocol.Response
+        """
+        starts = [metrics.start(request) for request in batch]
+        responses = []
+        with self._lock:
+            try:
+                self._send_requests(batch, buffers)
+                for request, start in zip(batch, starts):
+                    response = self._recv()
+                    metrics.finish(request, response, start)
+                    responses.append(response)
+            except BeanstalkdException as err:
+                for request, start in zip(batch[len(responses):], starts[len(responses):]):
+                    metrics.fail(request, err, start)
+                raise
+        return responses
+
+    def put_many(self, bodies, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR, raw=False,
+                 window=PIPELINE_WINDOW):
+        """
+        Put many jobs into the current tube, pipelined in windows of `window` jobs.
+        Items of `bodies` are either a job body or a dict with a "body" key and any of "priority", "delay" and "ttr"
+        to override the defaults for that job, and "idempotency_key" (see `put`: jobs whose key is known
+        to the `dedup` index or repeated in `bodies` aren't put, the id of the first job is returned). `bodies` can
+        be a generator, it's consumed one window at a time.
+        A failed put (i.e. JOB_TOO_BIG or DRAINING) doesn't abort the batch, its CommandFailed exception is returned
+        in place of the job id
+        :param bodies: bodies of the jobs
+        :type bodies: collections.Iterable[str | bytes | dict]
+        :param priority: default priority of the jobs
+        :type priority: long
+        :param delay: default delay of the jobs
+        :type delay: int | timedelta
+        :param ttr: default ttr of the jobs
+        :type ttr: int | timedelta
+        :param raw: If true then bodies are bytes and not str
+        :type raw: bool
+        :param window: maximum number of puts waiting for a response
+        :type window: int
+        :return: job id or exception of each job, in the same order as `bodies`
+        :rtype: list of (int | BeanstalkdException)
+        """
+        if isinstance(ttr, timedelta):
+            ttr = total_seconds(ttr)
+        if isinstance(delay, timedelta):
+            delay = total_seconds(delay)
+        codec = self._codec()
+        dedup = self.dedup
+        # index -> job id of the items whose key is already known
+        known = {}
+        # index -> index of the first item with the same key, for the keys repeated in `bodies`
+        repeats = {}
+        firsts = {}
+
+        def requests():
+            for index, item in enumerate(bodies):
+                if isinstance(item, dict):
+                    key = item.get("idempotency_key")
+                    if key is not None and dedup is not None:
+                        job_id = dedup.get(key)
+                        if job_id is not None:
+                            known[index] = job_id
+                            continue
+                        if key in firsts:
+                            repeats[index] = firsts[key]
+                            continue
+                        firsts[key] = index
+                    yield _put_request(item["body"], item.get("priority", priority), item.get("delay", delay),
+                                       item.get("ttr", ttr), raw, codec, self._blob_store, self._blob_threshold,
+                                       key, dedup)
+                else:
+                    yield _put_request(item, priority, delay, ttr, raw, codec, self._blob_store,
+                                       self._blob_threshold)
+
+        results = list(self._call_many(requests(), window))
+        if not known and not repeats:
+            return results
+        sent = iter(results)
+        ids = []
+        for index in range(len(results) + len(known) + len(repeats)):
+            if index in known:
+                ids.append(known[index])
+            elif index in repeats:
+                ids.append(ids[repeats[index]])
+            else:
+                ids.append(next(sent))
+        return ids
+
+    def put_bytes_many(self, bodies, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR, window=PIPELINE_WINDOW):
+        """
+        Same as `put_many` but the bodies are bytes
+        :type bodies: collections.Iterable[bytes | bytearray | memoryview | dict]
+        :rtype: list of (int | BeanstalkdException)
+        """
+        return self.put_many(bodies, priority, delay, ttr, True, window)
+
+    def load_metadata(self, jobs, refresh=False, window=PIPELINE_WINDOW):
+        """
+        Fill the metadata cache (see Job.metadata) of `jobs` with pipelined stats-job commands, so reading
+        job.priority, job.ttr... or releasing them without a priority doesn't cost a round trip per job.
+        Jobs already cached are skipped unless `refresh` is True
+        :type jobs: list of Job
+        :type refresh: bool
+        :param window: maximum number of commands waiting for a response
+        :type window: int
+        :return: stats or exception (i.e. CommandFailed('NOT_FOUND')) of each job, in the same order as `jobs`
+        :rtype: list of (dict | BeanstalkdException)
+        """
+        missing = [job for job in jobs if refresh or job._stats is None]
+        pipeline = self.pipeline()
+        for job in missing:
+            pipeline._job_stats(job.job_id)
+        errors = {}
+        for job, stats in zip(missing, pipeline.execute(window=window)):
+            if isinstance(stats, dict):
+                job._remember(stats)
+            else:
+                errors[id(job)] = stats
+        return [errors.get(id(job), job._stats) for job in jobs]
+
+    def reserve(self, timeout=None, raw=False, metadata=False):
+        """
+        Same as Commands.reserve. With `metadata` the stats-job of the job is asked right away and cached in the
+        job (see Job.metadata)
+        :type timeout: int | timedelta
+        :type raw: bool
+        :type metadata: bool
+        :rtype: Job
+        """
+        job = super(Connection, self).reserve(timeout, raw)
+        if metadata and job is not None:
+            job._remember(self._job_stats(job.job_id))
+        return job
+
+    def _ack_many(self, acks, window=PIPELINE_WINDOW, then=None):
+        """
+        Pipeline delete, release, bury and touch commands.
+        Release and bury of Job objects without an explicit priority keep the current priority of the job, as
+        Job.release does: from the metadata cache, the jobs not cached are asked with a single pipelined batch.
+        `reserved` of Job objects is cleared when a delete, release or bury succeeds
+        :param acks: tuples of (job, command, priority, delay). `job` is a job id or a Job
+        :type acks: list of tuple
+        :param then: request sent after the acks with the same pipeline, its result is the last one returned
+        :type then: Request
+        :return: None or exception of each command, in the same order as `acks`
+        :rtype: list of (None | BeanstalkdException)
+        """
+        unknown = [job for job, command, priority, _ in acks
+                   if command in ("release", "bury") and priority is None and isinstance(job, Job)]
+        if unknown:
+            self.load_metadata(unknown, window=window)
+
+        pipeline = self.pipeline()
+        for job, command, priority, delay in acks:
+            job_id = _job_id(job)
+            if priority is None:
+                priority = job._stats["pri"] if isinstance(job, Job) and job._stats else DEFAULT_PRIORITY
+            if command == "release":
+                pipeline.release(job_id, priority, delay)
+            elif command == "bury":
+                pipeline.bury(job_id, priority)
+            elif command == "delete":
+                pipeline.delete(job_id)
+            else:
+                pipeline.touch(job_id)
+        if then is not None:
+            pipeline._call(then)
+
+        results = pipeline.execute(window=window)
+        for (job, command, _, _), result in zip(acks, results):
+            if isinstance(job, Job) and not isinstance(result, BeanstalkdException):
+                if command == "touch":
+                    job._touched()
+                else:
+                    job._done()
+                if command == "delete":
+                    job._collect()
+        return results
+
+    def delete_many(self, jobs, window=PIPELINE_WINDOW):
+        """
+        Delete many jobs with pipelined commands.
+        :param jobs: job ids or Job objects
+        :type jobs: collections.Iterable[int | Job]
+        :param window: maximum number of commands waiting for a response
+        :type window: int
+        :return: None or exception (i.e. CommandFailed('NOT_FOUND')) of each job, in the same order as `jobs`
+        :rtype: list of (None | BeanstalkdException)
+        """
+        return self._ack_many([(job, "delete", None, 0) for job in jobs], window)
+
+    def release_many(self, jobs, priority=None, delay=0, window=PIPELINE_WINDOW):
+        """
+        Release many reserved jobs with pipelined commands.
+        :param jobs: job ids or Job objects
+        :type jobs: collections.Iterable[int | Job]
+        :param priority: new priority of the jobs. If None Job objects keep their priority and job ids get
+        DEFAULT_PRIORITY
+        :type priority: int
+        :param delay: number of seconds to wait before putting the jobs in the ready queue
+        :type delay: int | timedelta
+        :param window: maximum number of commands waiting for a response
+        :type window: int
+        :return: None or exception of each job, in the same order as `jobs`
+        :rtype: list of (None | BeanstalkdException)
+        """
+        if isinstance(delay, timedelta):
+            delay = total_seconds(delay)
+        return self._ack_many([(job, "release", priority, delay) for job in jobs], window)
+
+    def bury_many(self, jobs, priority=None, window=PIPELINE_WINDOW):
+        """
+        Bury many reserved jobs with pipelined commands.
+        :param jobs: job ids or Job objects
+        :type jobs: collections.Iterable[int | Job]
+        :param priority: new priority of the jobs. If None Job objects keep their priority and job ids get
+        DEFAULT_PRIORITY
+        :type priority: int
+        :param window: maximum number of commands waiting for a response
+        :type window: int
+        :return: None or exception of each job, in the same order as `jobs`
+        :rtype: list of (None | BeanstalkdException)
+        """
+        return self._ack_many([(job, "bury", priority, 0) for job in jobs], window)
+
+    def touch_many(self, jobs, window=PIPELINE_WINDOW):
+        """
+        Touch many reserved jobs with pipelined commands.
+        :param jobs: job ids or Job objects
+        :type jobs: collections.Iterable[int | Job]
+        :param window: maximum number of commands waiting for a response
+        :type window: int
+        :return: None or exception of each job, in the same order as `jobs`
+        :rtype: list of (None | BeanstalkdException)
+        """
+        return self._ack_many([(job, "touch", None, 0) for job in jobs], window)
+
+    def deferred_acks(self, max_size=100, max_delay=1.0):
+        """
+        Return a DeferredAcks to coalesce delete, release and bury of jobs.
+        Can be used in with statements, pending acks are flushed on exit
+        :param max_size: flush when this many acks are pending
+        :type max_size: int
+        :param max_delay: flush when the oldest pending ack is this old, in seconds
+        :type max_delay: float
+        :rtype: DeferredAcks
+        """
+        return DeferredAcks(self, max_size, max_delay)
+
+    def pipeline(self):
+        """
+        Return a Pipeline to queue commands and execute them with a single round trip.
+        Can be used in with statements, the queued commands are executed on exit
+        :rtype: Pipeline
+        """
+        return Pipeline(self)
+
+    def _parse_job(self, response, raw=False, decode=True):
+        """
+        Build a Job from a RESERVED or FOUND response
+        :param response: parsed response
+        :type response: pystalkd.Protocol.Response
+        :param raw: If True then the job body is kept as bytes and not decoded to str
+        :type raw: bool
+        :param decode: decode bodies encoded by a codec (see `set_codec`), lazily
+        :type decode: bool
+        :rtype: Job
+        """
+        job_id, job_body_size = response.args[:2]
+        key, body, size = None, response.body, int(job_body_size)
+        if self.idempotency_keys or self.dedup is not None:
+            key, body, size = _split_key(body, size)
+        body, size, blob, error = self._check_out(int(job_id), body, size)
+        if self._codecs and decode:
+            return Job(self, int(job_id), body, size, decoder=partial(self._decode, raw), blob=blob,
+                       idempotency_key=key, error=error)
+        decoder = None if raw else decode_utf8
+        return Job(self, int(job_id), body, size, decoder=decoder, blob=blob, idempotency_key=key,
+                   error=error)
+
+    def _check_out(self, job_id, body, size):
+        """
+        Fetch the payload of claim-check jobs from the blob store.
+        A payload that can't be fetched doesn't fail the reserve, since the job is reserved anyway: the error is
+        returned for the Job to raise on access to its body
+        :return: body, its size, the (store, key) of the blob or None and the error or None
+        :rtype: tuple
+        """
+        if self._blob_store is None or body[:len(CLAIM_CHECK)] != CLAIM_CHECK:
+            return body, size, None, None
+        key = bytes(body[len(CLAIM_CHECK):])
+        try:
+            key = str(key, "ascii")
+            payload = self._blob_store.get(key)
+        except ValueError as err:
+            # not ascii or refused by the store: nothing to remove when the job is deleted
+            return body, size, None, BeanstalkdException("job {} has an invalid blob key {!r}: {}".format(
+                job_id, key, err))
+        except OSError as err:
+            return body, size, (self._blob_store, key), BeanstalkdException(
+                "blob {} of job {} can't be read: {}".format(key, job_id, err))
+        return payload, len(payload), (self._blob_store, key), None
+
+    def set_codec(self, codec, tube=None):
+        """
+        Encode the bodies given to put (and put_many) with `codec` while `tube` is used, or for every tube without
+        a codec of its own if `tube` is None. put_bytes is never encoded.
+        Once a codec is set, reserved jobs carrying a codec header are decoded on first access to job.body, with any
+        serializer set on the connection (plus "text" and "bytes"). Other bodies are left as reserve returns them
+        :type codec: pystalkd.Codec.Codec
+        :param tube: name of the tube, None for the default codec
+        :type tube: str
+        """
+        self._codecs[tube] = codec
+        self._accept = {"text", "bytes"} | {codec.serializer for codec in self._codecs.values()}
+
+    def _codec(self, tube=None):
+        if not self._codecs:
+            return None
+        return self._codecs.get(self._using if tube is None else tube, self._codecs.get(None))
+
+    def _decode(self, raw, data):
+        codec = next(iter(self._codecs.values()))
+        if codec.is_encoded(data):
+            return codec.decode(data, self._accept)
+        return data if raw else str(data, "utf8")
+
+    def _parse_yaml(self, response):
+        """
+        Parse the YAML data chunk of stats and list replies with the built-in parser. With `yaml_fallback` the
+        documents it doesn't fully understand (i.e. tube names like "0x1f" that YAML would turn into numbers) are
+        parsed by PyYaml instead, otherwise such scalars are kept as str
+        :type response: pystalkd.Protocol.Response
+        :rtype: dict | list | str
+        """
+        if not self.parse_yaml:
+            return str(response.body, "utf8")
+        try:
+            return parse_yaml(response.body, strict=self.yaml_fallback)
+        except UnsupportedYaml as err:
+            if not self.yaml_fallback:
+                raise UnexpectedResponse(str(err))
+
+        import yaml
+
+        return yaml.load(str(response.body, "utf8"), Loader=yaml.FullLoader)
+
+    @contextmanager
+    def temporary_use(self, name):
+        """
+        Use a `name` tube temporarily and then go back to the previous one
+        :param name: name of the tube
+        :type name: str
+        """
+        old = self._using
+        self.use(name)
+        yield
+        self.use(old)
+
+    @contextmanager
+    def temporary_watch(self, name):
+        """
+        Watch a given tube and then ignores it. To be used in with statements.
+        :param name: name of tube
+        :type name: str
+        """
+        self.watch(name)
+        yield
+        self.ignore(name)
+
+
+class Pipeline(Commands):
+    def __init__(self, connection):
+        """
+        Queue of commands executed with a single round trip to the server.
+        Every command of Connection can be queued, they return the pipeline itself so calls can be chained:
+        `pipeline.use("tube").put("hey!").put("ho!")`. `execute` sends everything and returns the results in order,
+        a failed command gives its exception (i.e. CommandFailed('NOT_FOUND')) in place of the result.
+        When used in a with statement the commands are executed on exit and the results stored in `results`
+        :param connection: connection used to execute the commands
+        :type connection: Connection
+        """
+        self.connection = connection
+        self.results = None
+        self._requests = []
+        # tube used when the queued commands will run, to pick the codec of put
+        self._using = connection._using
+        self._blob_store = connection._blob_store
+        self._blob_threshold = connection._blob_threshold
+
+    def __len__(self):
+        return len(self._requests)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.results = self.execute()
+        else:
+            self._requests = []
+
+    def _call(self, request):
+        self._requests.append(request)
+        return self
+
+    def _codec(self):
+        return self.connection._codec(self._using)
+
+    def use(self, name):
+        self._using = name
+        return super(Pipeline, self).use(name)
+
+    def execute(self, raise_on_error=False, window=PIPELINE_WINDOW):
+        """
+        Send all queued commands and read their responses
+        :param raise_on_error: If True raise the first failure after all responses were read
+        :type raise_on_error: bool
+        :param window: maximum number of commands waiting for a response
+        :type window: int
+        :return: result or exception of each command, in the order they were queued
+        :rtype: list
+        """
+        requests, self._requests = self._requests, []
+        results = list(self.connection._call_many(requests, window))
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, BeanstalkdException):
+                    raise result
+        return results
+
+
+class DeferredAcks(object):
+    def __init__(self, connection, max_size=100, max_delay=1.0):
+        """
+        Coalesce acks (delete, release and bury) of jobs and send them pipelined.
+        Acks are flushed when `max_size` acks are pending, when an ack is added and the oldest pending one is older
+        than `max_delay` seconds, and by the next reserve of the connection, which sends them in the same write
+        before the reserve: a worker never blocks waiting for a job with its acks unsent.
+        Failed acks are appended to `failed` as (job, exception) tuples
+        :param connection: connection used to send the acks
+        :type connection: Connection
+        :param max_size: flush when this many acks are pending
+        :type max_size: int
+        :param max_delay: flush when the oldest pending ack is this old, in seconds
+        :type max_delay: float
+        """
+        self.connection = connection
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.failed = []
+        self._pending = []
+        self._oldest = None
+        connection._deferred_acks.add(self)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def _add(self, job, command, priority=None, delay=0):
+        if not self._pending:
+            self._oldest = monotonic()
+        self._pending.append((job, command, priority, delay))
+        if len(self._pending) >= self.max_size or monotonic() - self._oldest >= self.max_delay:
+            self.flush()
+
+    def delete(self, job):
+        """
+        Delete `job` on the next flush
+        :type job: int | Job
+        """
+        self._add(job, "delete")
+
+    def release(self, job, priority=None, delay=0):
+        """
+        Release `job` on the next flush
+        :type job: int | Job
+        :type priority: int
+        :type delay: int | timedelta
+        """
+        if isinstance(delay, timedelta):
+            delay = total_seconds(delay)
+        self._add(job, "release", priority, delay)
+
+    def bury(self, job, priority=None):
+        """
+        Bury `job` on the next flush
+        :type job: int | Job
+        :type priority: int
+        """
+        self._add(job, "bury", priority)
+
+    def flush(self):
+        """
+        Send all pending acks
+        :return: None or exception of each ack, in the order they were added
+        :rtype: list of (None | BeanstalkdException)
+        """
+        acks, self._pending = self._pending, []
+        if not acks:
+            return []
+        results = self.connection._ack_many(acks)
+        self._failed(acks, results)
+        return results
+
+    def _flush_with(self, request):
+        """Send all pending acks and then `request` with one pipeline, return the result of `request`"""
+        acks, self._pending = self._pending, []
+        results = self.connection._ack_many(acks, then=request)
+        result = results.pop()
+        self._failed(acks, results)
+        if isinstance(result, BeanstalkdException):
+            raise result
+        return result
+
+    def _failed(self, acks, results):
+        for (job, _, _, _), result in zip(acks, results):
+            if isinstance(result, BeanstalkdException):
+                self.failed.append((job, result))
@@ -0,0 +1,288 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import sys
+from functools import partial
+from time import monotonic
+
+from .Beanstalkd import DEFAULT_HOST, DEFAULT_PORT, PIPELINE_WINDOW, BeanstalkdException, Connection, Request
+from .Protocol import parse_stats
+from .Top import _duration
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+# stats-job fields that aren't ints
+_TEXT_FIELDS = frozenset(["tube", "state"])
+
+
+def _buried_stats(tubes, connection, response):
+    """stats-job of a buried job of `tubes` (any tube if None), None for other jobs"""
+    stats = parse_stats(response.body, as_str=_TEXT_FIELDS)
+    if stats.get("state") != "buried" or (tubes is not None and stats.get("tube") not in tubes):
+        return None
+    return stats
+
+
+class ScanReport(object):
+    __slots__ = ("first_id", "last_id", "scanned", "buried", "matched", "kicked", "deleted", "failed", "_started",
+                 "elapsed")
+
+    def __init__(self, first_id, last_id):
+        """
+        Progress of a BuriedScanner: counts so far and throughput
+        :param first_id: first job id scanned
+        :param last_id: last job id to scan
+        """
+        self.first_id = first_id
+        self.last_id = last_id
+        # job ids looked at
+        self.scanned = 0
+        self.buried = 0
+        self.matched = 0
+        self.kicked = 0
+        self.deleted = 0
+        # kicks and deletes that failed, i.e. the job was kicked or deleted by someone else meanwhile
+        self.failed = 0
+        self._started = monotonic()
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return ("ScanReport(scanned={0.scanned}/{1}, buried={0.buried}, matched={0.matched}, kicked={0.kicked}, "
+                "deleted={0.deleted}, failed={0.failed}, {2:.0f} ids/s)").format(
+            self, self.last_id - self.first_id + 1, self.rate)
+
+    def _tick(self):
+        self.elapsed = monotonic() - self._started
+
+    @property
+    def rate(self):
+        """job ids scanned per second"""
+        return self.scanned / self.elapsed if self.elapsed else 0.0
+
+
+class BuriedScanner(object):
+    def __init__(self, connection, tubes=None, window=PIPELINE_WINDOW, first_id=1, last_id=None, raw=False,
+                 progress=None):
+        """
+        Walk the buried jobs of a server, to inspect them or to kick or delete the ones matching a predicate.
+        beanstalkd only shows the first buried job of each tube (peek-buried), so the scanner goes through the job
+        ids instead: a window of ids is asked with pipelined stats-job commands, then the bodies of the buried ones
+        with pipelined peeks, and the kicks or deletes of the matching ones are pipelined too. Ids of deleted jobs
+        cost a few bytes each, so the scan runs at thousands of ids per round trip.
+        Ids go from `first_id` to `last_id`, by default the highest id the server gave out (see `find_last_id`)
+        :param connection: connection used by the scanner, its used tube is restored after `find_last_id`
+        :type connection: pystalkd.Beanstalkd.Connection
+        :param tubes: names of the tubes to scan, None for all of them
+        :type tubes: collections.Iterable[str]
+        :param window: job ids per pipeline
+        :type window: int
+        :type first_id: int
+        :type last_id: int
+        :param raw: keep the bodies as bytes
+        :type raw: bool
+        :param progress: called with the ScanReport after each window
+        :type progress: callable
+        """
+        self.connection = connection
+        self.tubes = None if tubes is None else frozenset(tubes)
+        self.window = window
+        self.first_id = first_id
+        self.last_id = last_id
+        self.raw = raw
+        self.progress = progress
+        self.report = None
+
+    def find_last_id(self):
+        """
+        Highest job id given out by the server, as far as the protocol tells: total-jobs of stats (exact unless the
+        server restarted from a binlog) or the id of the first buried job of a tube, if higher
+        :rtype: int
+        """
+        conn = self.connection
+        names = conn.tubes() if self.tubes is None else sorted(self.tubes)
+        pipeline = conn.pipeline()
+        pipeline.stats()
+        for name in names:
+            pipeline.use(name).peek_buried()
+        pipeline.use(conn.using())
+        results = pipeline.execute()
+        for result in results:
+            if isinstance(result, BeanstalkdException):
+                raise result
+        heads = [job.job_id for job in results[2:-1:2] if job is not None]
+        return max([results[0]["total-jobs"]] + heads)
+
+    def __iter__(self):
+        return self.scan()
+
+    def scan(self):
+        """
+        Buried jobs, in id order, a window at a time. The jobs aren't reserved, their stats-job is cached (see
+        Job.metadata)
+        :rtype: collections.Iterator[list of pystalkd.Job.Job]
+        """
+        last_id = self.find_last_id() if self.last_id is None else self.last_id
+        self.report = report = ScanReport(self.first_id, last_id)
+        conn = self.connection
+        for start in range(self.first_id, last_id + 1, self.window):
+            ids = range(start, min(start + self.window, last_id + 1))
+            pipeline = conn.pipeline()
+            handler = partial(_buried_stats, self.tubes)
+            for job_id in ids:
+                pipeline._call(Request("stats-job", job_id, ok_status=["OK"], error_status=["NOT_FOUND"],
+                                       handler=handler))
+            buried = [stats for stats in pipeline.execute(window=self.window) if isinstance(stats, dict)]
+            report.scanned += len(ids)
+            jobs = []
+            if buried:
+                pipeline = conn.pipeline()
+                handler = self._peeked
+                for stats in buried:
+                    pipeline._call(Request("peek", stats["id"], ok_status=["FOUND"], error_status=["NOT_FOUND"],
+                                           handler=handler))
+                for stats, job in zip(buried, pipeline.execute(window=self.window)):
+                    # kicked or deleted since the stats-job
+                    if isinstance(job, BeanstalkdException):
+                        continue
+                    job.reserved = False
+                    job._remember(stats)
+                    jobs.append(job)
+            report.buried += len(jobs)
+            report._tick()
+            yield jobs
+            if self.progress is not None:
+                self.progress(report)
+
+    def _peeked(self, connection, response):
+        return connection._parse_job(response, self.raw)
+
+    def jobs(self):
+        """
+        Buried jobs, in id order, one at a time
+        :rtype: collections.Iterator[pystalkd.Job.Job]
+        """
+        for jobs in self.scan():
+            for job in jobs:
+                yield job
+
+    def _apply(self, predicate, command):
+        conn = self.connection
+        for jobs in self.scan():
+            report = self.report
+            matching = [job for job in jobs if predicate is None or predicate(job)]
+            report.matched += len(matching)
+            if not matching:
+                continue
+            pipeline = conn.pipeline()
+            for job in matching:
+                if command == "kick":
+                    pipeline.kick_job(job.job_id)
+                else:
+                    pipeline.delete(job.job_id)
+            failed = sum(isinstance(result, BeanstalkdException) for result in pipeline.execute(window=self.window))
+            report.failed += failed
+            if command == "kick":
+                report.kicked += len(matching) - failed
+            else:
+                report.deleted += len(matching) - failed
+            report._tick()
+        return self.report
+
+    def kick(self, predicate=None):
+        """
+        Kick the buried jobs for which `predicate(job)` is true (all of them if None) with pipelined kick-job
+        :type predicate: callable
+        :rtype: ScanReport
+        """
+        return self._apply(predicate, "kick")
+
+    def delete(self, predicate=None):
+        """
+        Delete the buried jobs for which `predicate(job)` is true (all of them if None) with pipelined deletes
+        :type predicate: callable
+        :rtype: ScanReport
+        """
+        return self._apply(predicate, "delete")
+
+
+def add_arguments(parser):
+    """
+    Options of the buried command, for the command line of python3 -m pystalkd
+    :type parser: argparse.ArgumentParser
+    """
+    parser.add_argument("-s", "--server", default="{}:{}".format(DEFAULT_HOST, DEFAULT_PORT),
+                        help="host[:port] (default %(default)s)")
+    parser.add_argument("-t", "--tube", action="append", help="tube to scan, can be repeated (default: all)")
+    parser.add_argument("--contains", help="only the jobs whose body contains this text")
+    parser.add_argument("--older-than", type=int, help="only the jobs put at least this many seconds ago")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--kick", action="store_true", help="kick the matching jobs instead of listing them")
+    action.add_argument("--delete", action="store_true", help="delete the matching jobs instead of listing them")
+    parser.add_argument("--first-id", type=int, default=1)
+    parser.add_argument("--last-id", type=int, help="default: the highest id given out by the server")
+    parser.add_argument("-w", "--window", type=int, default=PIPELINE_WINDOW, help="job ids per pipeline")
+    parser.set_defaults(run=run)
+
+
+def _progress(report):
+    sys.stderr.write("\r{} of {} ids, {} buried, {} matched, {} kicked, {} deleted, {:.0f} ids/s".format(
+        report.scanned, report.last_id - report.first_id + 1, report.buried, report.matched, report.kicked,
+        report.deleted, report.rate))
+    sys.stderr.flush()
+
+
+def run(args):
+    contains = None if args.contains is None else args.contains.encode("utf8")
+
+    def predicate(job):
+        if contains is not None and contains not in job.raw_body:
+            return False
+        return args.older_than is None or job.metadata()["age"] >= args.older_than
+
+    host, _, port = args.server.partition(":")
+    conn = Connection(host, int(port or DEFAULT_PORT))
+    scanner = BuriedScanner(conn, args.tube, args.window, args.first_id, args.last_id, raw=True,
+                            progress=_progress if args.kick or args.delete else None)
+    try:
+        if args.kick:
+            report = scanner.kick(predicate)
+        elif args.delete:
+            report = scanner.delete(predicate)
+        else:
+            for job in scanner.jobs():
+                if predicate(job):
+                    scanner.report.matched += 1
+                    stats = job.metadata()
+                    preview = bytes(job.raw_body[:60]).decode("utf8", "replace").replace("\n", " ")
+                    print("{:>10} {:<24} {:>8} {:>3} buries {:>3} kicks  {}".format(
+                        job.job_id, stats["tube"], _duration(stats["age"]), stats["buries"], stats["kicks"], preview))
+            report = scanner.report
+    finally:
+        conn.close()
+    sys.stderr.write("\n{!r}\n".format(report))
+    return 0
+
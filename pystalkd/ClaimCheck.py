@@ -0,0 +1,118 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import mmap
+import os
+import tempfile
+from uuid import uuid4
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+
+class BlobStore(object):
+    """
+    Where the bodies too big for beanstalkd go (claim check pattern). Given to a Connection as `blob_store`, a put
+    whose body is bigger than the `blob_threshold` of the connection stores the body with `put` and sends the key
+    instead; reserve gives back the body read with `get`, and deleting the job removes it with `delete`.
+    Producers and consumers must share the store (i.e. a directory on a shared volume)
+    """
+
+    def put(self, data):
+        """
+        Store `data` under a new key
+        :type data: bytes | memoryview
+        :return: the key, an ascii str
+        :rtype: str
+        """
+        raise NotImplementedError()
+
+    def get(self, key):
+        """
+        Data stored under `key`. Raise OSError if it can't be read
+        :type key: str
+        :rtype: bytes | memoryview
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """
+        Remove the data stored under `key`, if still there
+        :type key: str
+        """
+        raise NotImplementedError()
+
+
+class DirectoryStore(BlobStore):
+    def __init__(self, path):
+        """
+        Blob store keeping each body in a file of `path`, created if needed
+        :type path: str
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        if not key.isalnum():
+            raise ValueError("invalid blob key {!r}".format(key))
+        return os.path.join(self.path, key)
+
+    def put(self, data):
+        key = uuid4().hex
+        # written aside and renamed, so a consumer never sees half a body
+        fd, temporary = tempfile.mkstemp(dir=self.path, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as blob:
+                blob.write(data)
+            os.replace(temporary, self._file(key))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        return key
+
+    def get(self, key):
+        with open(self._file(key), "rb") as blob:
+            return blob.read()
+
+    def delete(self, key):
+        try:
+            os.unlink(self._file(key))
+        except FileNotFoundError:
+            pass
+
+
+class MmapStore(DirectoryStore):
+    """
+    DirectoryStore that maps the files in memory instead of reading them: a reserved body is a read-only memoryview
+    whose pages are only loaded when touched. Meant for raw jobs (i.e. reserve(raw=True) and job.raw_body)
+    """
+
+    def get(self, key):
+        with open(self._file(key), "rb") as blob:
+            if not os.fstat(blob.fileno()).st_size:
+                # empty files can't be mapped
+                return b""
+            return memoryview(mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ))
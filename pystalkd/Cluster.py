@@ -0,0 +1,503 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import select
+from bisect import bisect
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+from hashlib import md5
+from itertools import count
+from math import ceil
+from time import monotonic
+
+from .Beanstalkd import (DEFAULT_PORT, DEFAULT_PRIORITY, DEFAULT_TTR, PIPELINE_WINDOW, BeanstalkdException,
+                         CommandFailed, Connection, DeadlineSoon, SocketError, UnexpectedResponse, encode_command,
+                         total_seconds)
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+# longest reserve-with-timeout sent to a node while multiplexing, a command to a node waiting for a reserve
+# response may have to wait this long
+RESERVE_SLICE = 1
+
+# stats that describe the server and not its load, taken from the first node instead of summed
+NODE_STATS = {"pid", "version", "hostname", "id", "uptime", "max-job-size", "os", "platform", "draining",
+              "binlog-oldest-index", "binlog-current-index", "binlog-max-size", "name", "pause", "pause-time-left"}
+
+
+class ClusterNode(Connection):
+    def __init__(self, host, port=DEFAULT_PORT, **kwargs):
+        """
+        Connection to one server of a ClusterConnection.
+        While the cluster multiplexes a reserve the node may be waiting for a reserve response, it's read before any
+        other command is sent. Jobs reserved this way are kept until the cluster hands them out
+        :param host: beanstalkd host
+        :type host: str
+        :param port: beanstalkd port
+        :type port: int
+        :param kwargs: passed to Connection
+        """
+        self._pending_reserve = False
+        # when the pending reserve was sent
+        self._reserve_sent = None
+        # (RESERVED response, when its reserve was sent)
+        self._reserved = deque()
+        self._deadline_soon = False
+        super(ClusterNode, self).__init__(host, port, **kwargs)
+
+    def __repr__(self):
+        return "ClusterNode({!r}, {!r})".format(self.host, self.port)
+
+    def connect(self):
+        super(ClusterNode, self).connect()
+        self._pending_reserve = False
+        self._reserved.clear()
+        self._deadline_soon = False
+
+    def _begin_reserve(self, timeout):
+        SocketError.wrap(self._socket.sendall, encode_command("reserve-with-timeout", timeout))
+        self._pending_reserve = True
+        self._reserve_sent = monotonic()
+
+    def _finish_reserve(self):
+        self._pending_reserve = False
+        response = self._recv()
+        if response.status == "RESERVED":
+            self._reserved.append((response, self._reserve_sent))
+        elif response.status == "DEADLINE_SOON":
+            self._deadline_soon = True
+        elif response.status in self.server_errors:
+            raise BeanstalkdException(response.status)
+        elif response.status != "TIMED_OUT":
+            raise UnexpectedResponse(response.status)
+
+    def _call(self, request):
+        if self._pending_reserve:
+            self._finish_reserve()
+        return super(ClusterNode, self)._call(request)
+
+    def _call_many(self, requests, window=PIPELINE_WINDOW):
+        if self._pending_reserve:
+            self._finish_reserve()
+        return super(ClusterNode, self)._call_many(requests, window)
+
+
+class HashRing(object):
+    def __init__(self, nodes, replicas=160):
+        """
+        Consistent hash of keys to nodes. Each node gets `replicas` points on the ring so keys are spread evenly and
+        adding or removing a node only moves the keys of that node
+        :param nodes: nodes of the ring, their `str` is hashed
+        :type nodes: list
+        :param replicas: points of each node on the ring
+        :type replicas: int
+        """
+        points = []
+        for node in nodes:
+            for replica in range(replicas):
+                points.append((self._hash("{}-{}".format(node, replica)), node))
+        points.sort(key=lambda point: point[0])
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    @staticmethod
+    def _hash(key):
+        if not isinstance(key, bytes):
+            key = str(key).encode("utf8")
+        return int.from_bytes(md5(key).digest()[:8], "big")
+
+    def get(self, key):
+        """
+        Return the node responsible for `key`
+        :type key: str | bytes
+        """
+        index = bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def _merge_stats(all_stats):
+    merged = {}
+    for stats in all_stats:
+        for key, value in stats.items():
+            if key not in merged:
+                merged[key] = value
+            elif key not in NODE_STATS and isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] += value
+    return merged
+
+
+class ClusterConnection(object):
+    def __init__(self, servers, replicas=160, **kwargs):
+        """
+        Connection to many beanstalkd servers used as one.
+        `put` goes to the node given by a consistent hash of its `key`, or round-robin if there is no key.
+        `use`, `watch` and `ignore` apply to every node and `reserve` multiplexes a reserve on all of them, handing
+        out jobs fairly. Jobs remember their node (`job.connection`), so delete, release, bury and touch of a Job go
+        to the right server. Job ids are only unique per server, that's why the job commands of the cluster take Job
+        objects. `stats` and `stats_tube` sum the counters of all nodes
+        :param servers: "host:port" strings or (host, port) tuples
+        :type servers: list of (str | tuple)
+        :param replicas: points of each node on the hash ring
+        :type replicas: int
+        :param kwargs: passed to each ClusterNode (i.e. parse_yaml, connect_timeout)
+        """
+        assert servers, "at least one server is needed"
+        self.nodes = []
+        try:
+            for server in servers:
+                if isinstance(server, str):
+                    host, _, port = server.partition(":")
+                    server = (host, int(port or DEFAULT_PORT))
+                self.nodes.append(ClusterNode(server[0], server[1], **kwargs))
+        except BeanstalkdException:
+            self.close()
+            raise
+        self.parse_yaml = self.nodes[0].parse_yaml
+        self._ring = HashRing(["{}:{}".format(node.host, node.port) for node in self.nodes], replicas)
+        self._by_name = {"{}:{}".format(node.host, node.port): node for node in self.nodes}
+        self._round_robin = count()
+        self._next_reserve = 0
+
+    def close(self):
+        """close connection to all nodes"""
+        for node in self.nodes:
+            node.close()
+
+    def node_for(self, key):
+        """
+        Return the node where jobs put with `key` go
+        :type key: str | bytes
+        :rtype: ClusterNode
+        """
+        return self._by_name[self._ring.get(key)]
+
+    def _node(self, key):
+        if key is None:
+            return self.nodes[next(self._round_robin) % len(self.nodes)]
+        return self.node_for(key)
+
+    def put(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR, raw=False, key=None,
+            idempotency_key=None):
+        """
+        Put a job into the current tube of the node chosen by `key`. Returns job id.
+        See Connection.put for the other arguments
+        :param key: jobs with the same key go to the same node. If None the `idempotency_key` is used, so the retries
+        of a put go to the same node, and without either nodes are used round-robin
+        :type key: str | bytes
+        :return: job id, unique only in its node (see `node_for`)
+        :rtype: int
+        """
+        if key is None:
+            key = idempotency_key
+        return self._node(key).put(body, priority, delay, ttr, raw, idempotency_key)
+
+    def put_bytes(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR, key=None, idempotency_key=None):
+        return self.put(body, priority, delay, ttr, True, key, idempotency_key)
+
+    def set_codec(self, codec, tube=None):
+        """
+        Set `codec` on every node, see Connection.set_codec
+        :type codec: pystalkd.Codec.Codec
+        :type tube: str
+        """
+        for node in self.nodes:
+            node.set_codec(codec, tube)
+
+    def _take(self, raw, since):
+        """
+        Hand out a job already reserved by a multiplexed reserve, rotating the first node looked at.
+        Jobs whose reserve was sent before `since` may have been kept past their TTR, and be ready again or reserved
+        by another worker: they're touched first, for a whole TTR, and dropped if they aren't reserved by this client
+        anymore
+        :type since: float
+        :rtype: pystalkd.Job.Job | None
+        """
+        size = len(self.nodes)
+        offset = 0
+        while offset < size:
+            index = (self._next_reserve + offset) % size
+            node = self.nodes[index]
+            if not node._reserved:
+                offset += 1
+                continue
+            response, sent = node._reserved.popleft()
+            if sent < since:
+                try:
+                    node.touch(int(response.args[0]))
+                except CommandFailed:
+                    continue
+            self._next_reserve = (index + 1) % size
+            return node._parse_job(response, raw)
+        return None
+
+    def reserve(self, timeout=None, raw=False):
+        """
+        Reserve a job from one of the watched tubes of any node, with optional timeout in seconds.
+        Returns a Job object, or None if the request times out.
+        A reserve-with-timeout is sent to every node at once and the first job to arrive is returned. Other nodes may
+        answer with jobs too, they stay reserved and are returned by the next calls if they're still reserved by this
+        client, touched so they get a whole TTR (see `_take`)
+        :type timeout: int | timedelta
+        :param raw: If True then the body is bytes and not str
+        :type raw: bool
+        :rtype: pystalkd.Job.Job | None
+        """
+        if isinstance(timeout, timedelta):
+            timeout = total_seconds(timeout)
+        start = monotonic()
+        deadline = None if timeout is None else start + timeout
+
+        while True:
+            for node in self.nodes:
+                if node._deadline_soon:
+                    node._deadline_soon = False
+                    raise DeadlineSoon("DEADLINE_SOON")
+            job = self._take(raw, start)
+            if job is not None:
+                return job
+
+            if deadline is None:
+                slice_ = RESERVE_SLICE
+            else:
+                slice_ = min(RESERVE_SLICE, max(0, int(ceil(deadline - monotonic()))))
+            for node in self.nodes:
+                if not node._pending_reserve:
+                    node._begin_reserve(slice_)
+
+            # nodes answer within `slice_` seconds, so waiting without a timeout is bounded
+            pending = [node for node in self.nodes if node._pending_reserve]
+            while pending and not any(node._reserved or node._deadline_soon for node in self.nodes):
+                readable, _, _ = SocketError.wrap(select.select, [node._socket for node in pending], [], [])
+                for node in pending:
+                    if node._socket in readable:
+                        node._finish_reserve()
+                pending = [node for node in pending if node._pending_reserve]
+
+            if any(node._reserved or node._deadline_soon for node in self.nodes):
+                continue
+            if deadline is not None and monotonic() >= deadline:
+                return None
+
+    def reserve_bytes(self, timeout=None):
+        return self.reserve(timeout, True)
+
+    def use(self, name):
+        """
+        Use a `name` tube on every node
+        :rtype: str
+        """
+        for node in self.nodes:
+            node.use(name)
+        return name
+
+    def using(self):
+        """
+        Return the tube currently being used
+        :rtype: str
+        """
+        return self.nodes[0].using()
+
+    @contextmanager
+    def temporary_use(self, name):
+        """
+        Use a `name` tube temporarily and then go back to the previous one
+        :param name: name of the tube
+        :type name: str
+        """
+        old = self.using()
+        self.use(name)
+        yield
+        self.use(old)
+
+    def watch(self, name):
+        """
+        Watch a given tube on every node
+        :return: number of tubes currently in the watch list.
+        :rtype: int
+        """
+        return [node.watch(name) for node in self.nodes][0]
+
+    def ignore(self, name):
+        """
+        Stop watching a given tube on every node
+        :return: number of tubes currently in the watch list.
+        :rtype: int
+        """
+        return [node.ignore(name) for node in self.nodes][0]
+
+    def watching(self):
+        """
+        Return a list of all tubes being watched
+        :rtype: list of str | str
+        """
+        return self.nodes[0].watching()
+
+    @contextmanager
+    def temporary_watch(self, name):
+        """
+        Watch a given tube and then ignores it. To be used in with statements.
+        :param name: name of tube
+        :type name: str
+        """
+        self.watch(name)
+        yield
+        self.ignore(name)
+
+    def tubes(self):
+        """
+        Return a list of the tubes existing in any node
+        :rtype: list of str | list of str
+        """
+        if not self.parse_yaml:
+            return [node.tubes() for node in self.nodes]
+        tubes = []
+        for node in self.nodes:
+            tubes.extend(tube for tube in node.tubes() if tube not in tubes)
+        return tubes
+
+    def stats(self):
+        """
+        Return a dict of beanstalkd statistics, counters summed over all nodes.
+        if `parse_yaml` is False returns the yaml string of each node
+        :rtype: dict | list of str
+        """
+        all_stats = [node.stats() for node in self.nodes]
+        if not self.parse_yaml:
+            return all_stats
+        return _merge_stats(all_stats)
+
+    def stats_tube(self, name):
+        """
+        Return a dict of stats about a given tube, counters summed over the nodes where it exists.
+        if `parse_yaml` is False returns the yaml string of each node
+        :rtype: dict | list of str
+        """
+        all_stats = []
+        for node in self.nodes:
+            try:
+                all_stats.append(node.stats_tube(name))
+            except CommandFailed:
+                pass
+        if not all_stats:
+            raise CommandFailed("NOT_FOUND")
+        if not self.parse_yaml:
+            return all_stats
+        return _merge_stats(all_stats)
+
+    def pause_tube(self, name, delay):
+        """
+        Pause a tube in every node where it exists
+        :type name: str
+        :type delay: int | timedelta
+        """
+        found = False
+        for node in self.nodes:
+            try:
+                node.pause_tube(name, delay)
+                found = True
+            except CommandFailed:
+                pass
+        if not found:
+            raise CommandFailed("NOT_FOUND")
+
+    def kick(self, bound=1):
+        """
+        Kick at most bound jobs into the ready queue, visiting the nodes in order
+        :return: count of kicked jobs
+        :rtype: int
+        """
+        kicked = 0
+        for node in self.nodes:
+            if kicked >= bound:
+                break
+            kicked += node.kick(bound - kicked)
+        return kicked
+
+    def _peek_state(self, state):
+        for node in self.nodes:
+            job = node._peek_state(state)
+            if job is not None:
+                return job
+        return None
+
+    def peek_ready(self):
+        """Peek at the next ready job of the first node that has one. Returns a Job, or None."""
+        return self._peek_state("ready")
+
+    def peek_delayed(self):
+        """Peek at the next delayed job of the first node that has one. Returns a Job, or None."""
+        return self._peek_state("delayed")
+
+    def peek_buried(self):
+        """Peek at the next buried job of the first node that has one. Returns a Job, or None."""
+        return self._peek_state("buried")
+
+    def delete(self, job):
+        """
+        Delete a job in the node it came from
+        :type job: pystalkd.Job.Job
+        """
+        job.connection.delete(job.job_id)
+
+    def release(self, job, priority=DEFAULT_PRIORITY, delay=0):
+        """
+        Release a reserved job in the node it came from
+        :type job: pystalkd.Job.Job
+        """
+        job.connection.release(job.job_id, priority, delay)
+
+    def bury(self, job, priority=DEFAULT_PRIORITY):
+        """
+        Bury a job in the node it came from
+        :type job: pystalkd.Job.Job
+        """
+        job.connection.bury(job.job_id, priority)
+
+    def touch(self, job):
+        """
+        Touch a reserved job in the node it came from
+        :type job: pystalkd.Job.Job
+        """
+        job.connection.touch(job.job_id)
+
+    def kick_job(self, job):
+        """
+        Kick a buried or delayed job in the node it came from
+        :type job: pystalkd.Job.Job
+        :return: job_id
+        :rtype: int
+        """
+        return job.connection.kick_job(job.job_id)
+
+    def stats_job(self, job):
+        """
+        Return a dict of stats about a job, asked to the node it came from
+        :type job: pystalkd.Job.Job
+        :rtype: dict | str
+        """
+        return job.connection.stats_job(job.job_id)
@@ -0,0 +1,193 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import json
+import pickle
+import zlib
+
+from .Beanstalkd import BeanstalkdException
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+# first bytes of an encoded body, 0xff never appears in utf-8 text so plain str bodies are never mistaken for it
+MAGIC = b"\xffPS"
+# MAGIC, serializer code, compression code
+HEADER_SIZE = len(MAGIC) + 2
+
+
+class CodecError(BeanstalkdException):
+    pass
+
+
+def _load_msgpack():
+    import msgpack
+    return msgpack.packb, lambda data: msgpack.unpackb(data, raw=False)
+
+
+def _load_bz2():
+    import bz2
+    return lambda data, level: bz2.compress(data, 9 if level is None else level), bz2.decompress
+
+
+def _load_lzma():
+    import lzma
+    return lambda data, level: lzma.compress(data, preset=level), lzma.decompress
+
+
+# name -> (code, loader returning (dumps, loads)). Loaders import optional modules on first use
+_SERIALIZERS = {
+    "bytes": (0, lambda: (bytes, bytes)),
+    "text": (1, lambda: (lambda text: text.encode("utf8"), lambda data: str(data, "utf8"))),
+    "json": (2, lambda: (lambda obj: json.dumps(obj, separators=(",", ":")).encode("utf8"),
+                         lambda data: json.loads(str(data, "utf8")))),
+    "pickle": (3, lambda: (lambda obj: pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), pickle.loads)),
+    "msgpack": (4, _load_msgpack),
+}
+
+# name -> (code, loader returning (compress(data, level), decompress))
+_COMPRESSIONS = {
+    "zlib": (1, lambda: (lambda data, level: zlib.compress(data, -1 if level is None else level), zlib.decompress)),
+    "bz2": (2, _load_bz2),
+    "lzma": (3, _load_lzma),
+}
+
+_loaded = {}
+
+
+def register_serializer(name, code, dumps, loads):
+    """
+    Make a custom serializer available to Codec, under `name`.
+    `code` is written in the header of every body it encodes, so it must be the same in producers and consumers:
+    codes below 128 are reserved to pystalkd
+    :type name: str
+    :param code: 128 to 255
+    :type code: int
+    :param dumps: object to bytes
+    :type dumps: callable
+    :param loads: bytes to object
+    :type loads: callable
+    """
+    assert 128 <= code <= 255, "custom serializer codes go from 128 to 255"
+    _SERIALIZERS[name] = (code, lambda: (dumps, loads))
+    _loaded.pop(("serializer", code), None)
+
+
+def _lookup(kind, table, code):
+    key = (kind, code)
+    if key not in _loaded:
+        for name, (known, loader) in table.items():
+            if known == code:
+                _loaded[key] = (name,) + tuple(loader())
+                break
+        else:
+            raise CodecError("unknown {} {}".format(kind, code))
+    return _loaded[key]
+
+
+def is_encoded(data):
+    """
+    :param data: job body
+    :type data: bytes | memoryview
+    :return: True if `data` starts with a codec header
+    :rtype: bool
+    """
+    return data[:len(MAGIC)] == MAGIC and len(data) >= HEADER_SIZE
+
+
+class Codec(object):
+    def __init__(self, serializer="json", compression=None, threshold=1024, level=None):
+        """
+        Turns objects into job bodies and back: `serializer`, then `compression` when the serialized data is at
+        least `threshold` bytes (and compressing it actually saves space), then a small header naming both so any
+        Codec decodes what any other one encoded.
+        Set it on a connection with Connection(codec=...) or Connection.set_codec(codec, tube): put then encodes
+        what it is given, and reserved jobs are decoded on first access to job.body
+        :param serializer: "json", "pickle", "msgpack" (needs msgpack), "text", "bytes" or a registered name
+        :type serializer: str
+        :param compression: None, "zlib", "bz2" or "lzma"
+        :type compression: str
+        :param threshold: smallest serialized size that is compressed, in bytes
+        :type threshold: int
+        :param level: compression level, None for the default of the algorithm
+        :type level: int
+        """
+        if serializer not in _SERIALIZERS:
+            raise CodecError("unknown serializer {}".format(serializer))
+        if compression is not None and compression not in _COMPRESSIONS:
+            raise CodecError("unknown compression {}".format(compression))
+        self.serializer = serializer
+        self.compression = compression
+        self.threshold = threshold
+        self.level = level
+
+    def __repr__(self):
+        return "Codec({!r}, {!r}, {!r})".format(self.serializer, self.compression, self.threshold)
+
+    def encode(self, obj):
+        """
+        :param obj: anything the serializer accepts
+        :return: job body, header included
+        :rtype: bytes
+        """
+        code = _SERIALIZERS[self.serializer][0]
+        _, dumps, _ = _lookup("serializer", _SERIALIZERS, code)
+        data = dumps(obj)
+        compression_code = 0
+        if self.compression is not None and len(data) >= self.threshold:
+            compression_code = _COMPRESSIONS[self.compression][0]
+            _, compress, _ = _lookup("compression", _COMPRESSIONS, compression_code)
+            compressed = compress(data, self.level)
+            if len(compressed) < len(data):
+                data = compressed
+            else:
+                compression_code = 0
+        return b"".join((MAGIC, bytes((code, compression_code)), data))
+
+    is_encoded = staticmethod(is_encoded)
+
+    @staticmethod
+    def decode(data, accept=None):
+        """
+        Decode a body encoded by any Codec
+        :param data: job body, header included
+        :type data: bytes | memoryview
+        :param accept: names of the serializers allowed, None allows all. Consumers should not accept "pickle"
+        unless they trust every producer of the tube
+        :type accept: collections.Container[str]
+        :rtype: object
+        """
+        if not is_encoded(data):
+            raise CodecError("body has no codec header")
+        code, compression_code = data[len(MAGIC)], data[len(MAGIC) + 1]
+        name, _, loads = _lookup("serializer", _SERIALIZERS, code)
+        if accept is not None and name not in accept:
+            raise CodecError("serializer {} is not accepted".format(name))
+        payload = data[HEADER_SIZE:]
+        if compression_code:
+            _, _, decompress = _lookup("compression", _COMPRESSIONS, compression_code)
+            payload = decompress(payload)
+        return loads(bytes(payload))
@@ -0,0 +1,272 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import math
+import sqlite3
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+from time import monotonic, time
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+# id of the keys added without one (i.e. by consumers), or whose id the index can't tell
+UNKNOWN_ID = 0
+
+
+class DedupIndex(object):
+    """
+    Bounded index of the idempotency keys of the jobs put. Given to a Connection as `dedup`, a put with a key the
+    index knows isn't sent, and the key of every job inserted is added with `add`.
+    Consumers can use one too: `seen` tells if a key was already processed (see Job.idempotency_key), for the
+    duplicates left by puts retried after their INSERTED reply was lost
+    """
+
+    def get(self, key):
+        """
+        Id of the job put with `key`, UNKNOWN_ID if the key is known without its id, None if unknown
+        :type key: str
+        :rtype: int | None
+        """
+        raise NotImplementedError()
+
+    def add(self, key, job_id=UNKNOWN_ID):
+        """
+        Remember `key`, put as job `job_id`
+        :type key: str
+        :type job_id: int
+        """
+        raise NotImplementedError()
+
+    def seen(self, key):
+        """
+        Whether `key` was already added, adding it if not. Atomic, unlike a `get` followed by an `add`
+        :type key: str
+        :rtype: bool
+        """
+        raise NotImplementedError()
+
+
+class MemoryIndex(DedupIndex):
+    def __init__(self, max_size=100000, ttl=3600.0):
+        """
+        Index in the memory of the process: the `max_size` keys used last, each for `ttl` seconds
+        :type max_size: int
+        :param ttl: seconds a key is remembered, None for as long as it fits
+        :type ttl: float | None
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (job id, expiry), least recently used first
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _get(self, key):
+        entry = self._keys.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= monotonic():
+            del self._keys[key]
+            return None
+        self._keys.move_to_end(key)
+        return entry[0]
+
+    def _add(self, key, job_id):
+        keys = self._keys
+        keys[key] = (job_id, None if self.ttl is None else monotonic() + self.ttl)
+        keys.move_to_end(key)
+        while len(keys) > self.max_size:
+            keys.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def add(self, key, job_id=UNKNOWN_ID):
+        with self._lock:
+            self._add(key, job_id)
+
+    def seen(self, key):
+        with self._lock:
+            if self._get(key) is not None:
+                return True
+            self._add(key, UNKNOWN_ID)
+            return False
+
+
+class BloomIndex(DedupIndex):
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        """
+        Index in a few bits per key: two Bloom filters of `capacity` keys each, the older one dropped when the newer
+        one is full, so the last `capacity` keys at least are remembered. Job ids aren't kept, `get` gives UNKNOWN_ID
+        for known keys, and about `error_rate` of the unknown keys are taken for known ones (their put is skipped)
+        :type capacity: int
+        :type error_rate: float
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self._hashes = max(int(round(self._bits / capacity * math.log(2))), 1)
+        self._current = bytearray((self._bits + 7) // 8)
+        self._previous = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        digest = blake2b(key.encode("utf8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        bits = self._bits
+        return [(first + i * step) % bits for i in range(self._hashes)]
+
+    @staticmethod
+    def _contains(bits, positions):
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def _known(self, positions):
+        if self._contains(self._current, positions):
+            return True
+        return self._previous is not None and self._contains(self._previous, positions)
+
+    def _add(self, positions):
+        if self._count >= self.capacity:
+            self._previous = self._current
+            self._current = bytearray(len(self._current))
+            self._count = 0
+        bits = self._current
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def get(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            return UNKNOWN_ID if self._known(positions) else None
+
+    def add(self, key, job_id=UNKNOWN_ID):
+        positions = self._positions(key)
+        with self._lock:
+            if not self._contains(self._current, positions):
+                self._add(positions)
+
+    def seen(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            if self._known(positions):
+                return True
+            self._add(positions)
+            return False
+
+
+class SqliteIndex(DedupIndex):
+    # adds between two removals of the expired and excess keys
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, ttl=86400.0, max_size=None, timeout=10.0):
+        """
+        Index in a SQLite database, shared by the processes (producers or consumers) opening the same file on the
+        same host. Keys are remembered for `ttl` seconds, and the oldest ones are removed above `max_size` keys
+        :param path: database file, created if needed
+        :type path: str
+        :param ttl: seconds a key is remembered, None forever
+        :type ttl: float | None
+        :param max_size: keys kept, None for no limit
+        :type max_size: int | None
+        :param timeout: seconds to wait for a lock held by another process
+        :type timeout: float
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self._adds = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, job_id INTEGER NOT NULL, "
+                         "added REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS dedup_added ON dedup (added)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM dedup").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _oldest(self):
+        """Time before which keys are expired"""
+        return float("-inf") if self.ttl is None else time() - self.ttl
+
+    def _added(self):
+        self._adds += 1
+        if self._adds % self.PRUNE_EVERY:
+            return
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM dedup WHERE added < ?", (self._oldest(),))
+        if self.max_size is not None:
+            self._db.execute("DELETE FROM dedup WHERE key IN (SELECT key FROM dedup ORDER BY added DESC "
+                             "LIMIT -1 OFFSET ?)", (self.max_size,))
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT job_id FROM dedup WHERE key = ? AND added >= ?",
+                                   (key, self._oldest())).fetchone()
+        return None if row is None else row[0]
+
+    def add(self, key, job_id=UNKNOWN_ID):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO dedup (key, job_id, added) VALUES (?, ?, ?)",
+                             (key, job_id, time()))
+            self._added()
+
+    def seen(self, key):
+        with self._lock:
+            db = self._db
+            # the insert only happens if no other process has the key, in the same write transaction
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("DELETE FROM dedup WHERE key = ? AND added < ?", (key, self._oldest()))
+                inserted = db.execute("INSERT OR IGNORE INTO dedup (key, job_id, added) VALUES (?, ?, ?)",
+                                      (key, UNKNOWN_ID, time())).rowcount
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            if inserted:
+                self._added()
+            return not inserted
@@ -0,0 +1,860 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import os
+import platform
+import re
+import socket
+import threading
+from collections import OrderedDict, deque
+from heapq import heappop, heappush
+from itertools import count
+from time import monotonic
+from uuid import uuid4
+
+from .Beanstalkd import BLOB_THRESHOLD, Connection, SocketError
+from .Protocol import Response
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+# default max-job-size of beanstalkd
+MAX_JOB_SIZE = 65535
+# a reserve gives DEADLINE_SOON instead of waiting when a job reserved by the same client expires this soon (seconds)
+SAFETY_MARGIN = 1.0
+# ready jobs with a priority below this are urgent
+URGENT_PRIORITY = 1024
+# longest command line accepted, CRLF included
+LINE_SIZE = 224
+RECV_SIZE = 65536
+VERSION = "1.12"
+
+CRLF = b"\r\n"
+_TUBE_NAME = re.compile(r"[A-Za-z0-9+/;.$_()][A-Za-z0-9\-+/;.$_()]{0,199}\Z")
+
+READY = "ready"
+RESERVED = "reserved"
+DELAYED = "delayed"
+BURIED = "buried"
+
+# commands counted in the cmd-* fields of stats, in the order beanstalkd prints them
+_COUNTED = ("put", "peek", "peek-ready", "peek-delayed", "peek-buried", "reserve", "reserve-with-timeout", "delete",
+            "release", "use", "watch", "ignore", "bury", "kick", "touch", "stats", "stats-job", "stats-tube",
+            "list-tubes", "list-tube-used", "list-tubes-watched", "pause-tube")
+
+
+def _response(status, *args, body=None):
+    return Response(status, [arg if isinstance(arg, bytes) else str(arg).encode("ascii") for arg in args], body)
+
+
+_BAD_FORMAT = _response("BAD_FORMAT")
+_NOT_FOUND = _response("NOT_FOUND")
+
+
+def _uint(word, limit=2 ** 32 - 1):
+    if not word.isdigit() or int(word) > limit:
+        raise ValueError(word)
+    return int(word)
+
+
+def _tube_name(word):
+    name = word.decode("ascii")
+    if not _TUBE_NAME.match(name):
+        raise ValueError(name)
+    return name
+
+
+def _yaml(pairs):
+    text = "---\n" + "".join("{}: {}\n".format(key, value) for key, value in pairs)
+    return _response("OK", len(text), body=text.encode("utf8"))
+
+
+def _yaml_list(items):
+    text = "---\n" + "".join("- {}\n".format(item) for item in items)
+    return _response("OK", len(text), body=text.encode("utf8"))
+
+
+def encode_response(response):
+    """
+    A response as beanstalkd sends it
+    :type response: pystalkd.Protocol.Response
+    :rtype: bytes
+    """
+    line = b" ".join([response.status.encode("ascii")] + response.args) + CRLF
+    if response.body is None:
+        return line
+    return b"".join((line, response.body, CRLF))
+
+
+class _Job(object):
+    __slots__ = ("id", "tube", "priority", "delay", "ttr", "body", "state", "deadline", "created", "owner", "entry",
+                 "reserves", "timeouts", "releases", "buries", "kicks")
+
+    def __init__(self, job_id, tube, priority, delay, ttr, body, now):
+        self.id = job_id
+        self.tube = tube
+        self.priority = priority
+        self.delay = delay
+        self.ttr = ttr
+        self.body = body
+        self.state = None
+        # when a delayed job becomes ready or a reserved one expires
+        self.deadline = None
+        self.created = now
+        # session that reserved the job
+        self.owner = None
+        # heap entries carrying an older entry number are stale
+        self.entry = None
+        self.reserves = 0
+        self.timeouts = 0
+        self.releases = 0
+        self.buries = 0
+        self.kicks = 0
+
+
+class _Tube(object):
+    def __init__(self, name):
+        self.name = name
+        # (priority, job id, entry, job)
+        self.ready = []
+        # (deadline, job id, entry, job)
+        self.delayed = []
+        # in the order they were buried
+        self.buried = OrderedDict()
+        self.counts = {READY: 0, RESERVED: 0, DELAYED: 0, BURIED: 0}
+        self.urgent = 0
+        self.using = 0
+        self.watching = 0
+        self.waiting = 0
+        self.total_jobs = 0
+        self.cmd_delete = 0
+        self.cmd_pause = 0
+        self.pause = 0
+        self.paused_until = 0.0
+
+    def jobs(self):
+        return sum(self.counts.values())
+
+
+class Engine(object):
+    def __init__(self, max_job_size=MAX_JOB_SIZE):
+        """
+        In-process beanstalkd: tubes with ready, delayed, reserved and buried jobs, priority and delay heaps, TTR
+        expiry, pause-tube, kick and the stats of the real server, without a socket or a server process.
+        Clients are sessions speaking the beanstalkd protocol (see `session`). EmbeddedConnection, the Connection of
+        an engine, gives the whole Connection API on top of one, and `serve` makes the engine reachable on a local
+        socket by any beanstalkd client. Thread safe: sessions can be used from different threads, and a
+        blocking reserve in one waits for a put from another.
+        Nothing is persisted
+        :param max_job_size: biggest job body accepted, in bytes
+        :type max_job_size: int
+        """
+        self.max_job_size = max_job_size
+        self._condition = threading.Condition()
+        self._jobs = {}
+        self._tubes = {}
+        self._ids = count(1)
+        self._entries = count()
+        # (deadline, job id, entry, job) of the reserved jobs
+        self._reserved = []
+        self._sessions = set()
+        self._commands = dict.fromkeys(_COUNTED, 0)
+        self._waiting = 0
+        self._job_timeouts = 0
+        self._total_jobs = 0
+        self._total_connections = 0
+        self._started = monotonic()
+        self.id = uuid4().hex[:16]
+        self._tube("default")
+
+    def session(self):
+        """
+        A new client of the engine, with the state of a new beanstalkd connection
+        :rtype: Session
+        """
+        return Session(self)
+
+    def connect(self, **kwargs):
+        """
+        A connection to the engine
+        :param kwargs: passed to EmbeddedConnection (i.e. codec, parse_yaml)
+        :rtype: EmbeddedConnection
+        """
+        return EmbeddedConnection(self, **kwargs)
+
+    def serve(self, host="127.0.0.1", port=0):
+        """
+        Serve the beanstalkd protocol on `host`:`port` from background threads
+        :param port: 0 picks a free port, see EngineServer.port
+        :type port: int
+        :rtype: EngineServer
+        """
+        server = EngineServer(self, host, port)
+        server.start()
+        return server
+
+    # everything below is called with the lock held
+
+    def _tube(self, name):
+        tube = self._tubes.get(name)
+        if tube is None:
+            tube = self._tubes[name] = _Tube(name)
+        return tube
+
+    def _collect(self, tube):
+        """Forget `tube` once nothing references it, as beanstalkd does"""
+        if tube.name != "default" and not (tube.using or tube.watching or tube.jobs()):
+            self._tubes.pop(tube.name, None)
+
+    def _set_state(self, job, state):
+        tube = job.tube
+        if job.state is not None:
+            tube.counts[job.state] -= 1
+            if job.state == READY and job.priority < URGENT_PRIORITY:
+                tube.urgent -= 1
+        if state is not None:
+            tube.counts[state] += 1
+            if state == READY and job.priority < URGENT_PRIORITY:
+                tube.urgent += 1
+        job.state = state
+        job.entry = next(self._entries)
+
+    def _make_ready(self, job):
+        self._set_state(job, READY)
+        job.deadline = None
+        job.owner = None
+        heappush(job.tube.ready, (job.priority, job.id, job.entry, job))
+        self._condition.notify_all()
+
+    def _delay(self, job, delay, now):
+        self._set_state(job, DELAYED)
+        job.delay = delay
+        job.deadline = now + delay
+        job.owner = None
+        heappush(job.tube.delayed, (job.deadline, job.id, job.entry, job))
+
+    def _remove(self, job):
+        if job.state == BURIED:
+            job.tube.buried.pop(job.id, None)
+        elif job.state == RESERVED:
+            job.owner.reserved.discard(job)
+        self._set_state(job, None)
+        del self._jobs[job.id]
+        self._collect(job.tube)
+
+    def _tick(self, now):
+        """Make ready the delayed jobs that are due and the reserved jobs whose TTR expired"""
+        for tube in list(self._tubes.values()):
+            delayed = tube.delayed
+            while delayed and delayed[0][0] <= now:
+                _, _, entry, job = heappop(delayed)
+                if job.entry == entry:
+                    self._make_ready(job)
+        reserved = self._reserved
+        while reserved and reserved[0][0] <= now:
+            _, _, entry, job = heappop(reserved)
+            if job.entry == entry:
+                job.owner.reserved.discard(job)
+                job.timeouts += 1
+                self._job_timeouts += 1
+                self._make_ready(job)
+
+    def _next_event(self, now):
+        """
+        When the next delayed job is due, reserved job expires or paused tube resumes
+        :rtype: float | None
+        """
+        times = [tube.delayed[0][0] for tube in self._tubes.values() if tube.delayed]
+        times.extend(tube.paused_until for tube in self._tubes.values() if tube.paused_until > now)
+        if self._reserved:
+            times.append(self._reserved[0][0])
+        return min(times) if times else None
+
+    @staticmethod
+    def _top(heap):
+        """Valid entry on top of a heap of (key, job id, entry, job), dropping the stale ones"""
+        while heap:
+            entry = heap[0]
+            if entry[3].entry == entry[2]:
+                return entry
+            heappop(heap)
+        return None
+
+    def _pick(self, tubes, now):
+        """
+        Ready job with the best priority (then the oldest) among `tubes`, skipping paused tubes
+        :rtype: _Job | None
+        """
+        best = None
+        for tube in tubes:
+            if tube.paused_until > now:
+                continue
+            top = self._top(tube.ready)
+            if top is not None and (best is None or top[:2] < best[:2]):
+                best = top
+        return None if best is None else best[3]
+
+    def _stats(self, now):
+        counts = {READY: 0, RESERVED: 0, DELAYED: 0, BURIED: 0}
+        urgent = 0
+        for tube in self._tubes.values():
+            urgent += tube.urgent
+            for state, number in tube.counts.items():
+                counts[state] += number
+        times = os.times()
+        pairs = [("current-jobs-urgent", urgent), ("current-jobs-ready", counts[READY]),
+                 ("current-jobs-reserved", counts[RESERVED]), ("current-jobs-delayed", counts[DELAYED]),
+                 ("current-jobs-buried", counts[BURIED])]
+        pairs.extend(("cmd-" + command, self._commands[command]) for command in _COUNTED)
+        pairs.extend([("job-timeouts", self._job_timeouts), ("total-jobs", self._total_jobs),
+                      ("max-job-size", self.max_job_size), ("current-tubes", len(self._tubes)),
+                      ("current-connections", len(self._sessions)),
+                      ("current-producers", sum(1 for session in self._sessions if session.producer)),
+                      ("current-workers", sum(1 for session in self._sessions if session.worker)),
+                      ("current-waiting", self._waiting), ("total-connections", self._total_connections),
+                      ("pid", os.getpid()), ("version", '"{}"'.format(VERSION)),
+                      ("rusage-utime", "{:.6f}".format(times.user)), ("rusage-stime", "{:.6f}".format(times.system)),
+                      ("uptime", int(now - self._started)), ("binlog-oldest-index", 0),
+                      ("binlog-current-index", 0), ("binlog-records-migrated", 0), ("binlog-records-written", 0),
+                      ("binlog-max-size", 10485760), ("draining", "false"), ("id", self.id),
+                      ("hostname", socket.gethostname()), ("os", '"{}"'.format(platform.version())),
+                      ("platform", '"{}"'.format(platform.machine()))])
+        return pairs
+
+
+class Session(object):
+    def __init__(self, engine):
+        """
+        One client of an Engine: its used tube, watch list and reserved jobs. `feed` takes the bytes a client would
+        send to beanstalkd and returns the responses of the commands they complete
+        :type engine: Engine
+        """
+        self.engine = engine
+        self.closed = False
+        self.producer = False
+        self.worker = False
+        self.reserved = set()
+        self._buffer = bytearray()
+        # (priority, delay, ttr, size) of a put waiting for its body
+        self._put = None
+        # bytes of the body of a put too big for the engine still to be thrown away
+        self._skip = 0
+        with engine._condition:
+            self.using = engine._tube("default")
+            self.using.using += 1
+            self.watching = [self.using]
+            self.using.watching += 1
+            engine._sessions.add(self)
+            engine._total_connections += 1
+
+    def feed(self, data):
+        """
+        Execute the commands completed by `data`. A reserve blocks until it's answered
+        :type data: bytes | bytearray | memoryview
+        :return: a response for each command, in order
+        :rtype: list of pystalkd.Protocol.Response
+        """
+        buffer = self._buffer
+        buffer += data
+        responses = []
+        start = 0
+        while not self.closed:
+            if self._skip:
+                skipped = min(self._skip, len(buffer) - start)
+                start += skipped
+                self._skip -= skipped
+                if self._skip:
+                    break
+                continue
+            if self._put is not None:
+                size = self._put[3]
+                if len(buffer) - start < size + 2:
+                    break
+                end = start + size
+                if buffer[end:end + 2] != CRLF:
+                    responses.append(_response("EXPECTED_CRLF"))
+                else:
+                    responses.append(self._insert(bytes(buffer[start:end])))
+                start = end + 2
+                self._put = None
+                continue
+
+            end = buffer.find(CRLF, start)
+            if end < 0:
+                if len(buffer) - start > LINE_SIZE:
+                    responses.append(_BAD_FORMAT)
+                    start = len(buffer)
+                break
+            words = bytes(buffer[start:end]).split(b" ")
+            start = end + 2
+            if words[0] == b"put":
+                try:
+                    if len(words) != 5:
+                        raise ValueError(words)
+                    put = (_uint(words[1]), _uint(words[2]), _uint(words[3]), _uint(words[4], float("inf")))
+                except ValueError:
+                    responses.append(_BAD_FORMAT)
+                    continue
+                if put[3] > self.engine.max_job_size:
+                    # answered right away and the body dropped as it comes, as beanstalkd does: it's never buffered
+                    responses.append(_response("JOB_TOO_BIG"))
+                    self._skip = put[3] + 2
+                else:
+                    self._put = put
+                continue
+            response = self.execute(words)
+            if response is not None:
+                responses.append(response)
+        del buffer[:start]
+        return responses
+
+    def execute(self, words):
+        """
+        Execute a command without a body (every command but put)
+        :param words: words of the command line
+        :type words: list of bytes
+        :return: the response, None after quit
+        :rtype: pystalkd.Protocol.Response | None
+        """
+        name = words[0].decode("ascii", "replace")
+        if name == "quit":
+            self.close()
+            return None
+        handler = _HANDLERS.get(name)
+        if handler is None:
+            return _response("UNKNOWN_COMMAND")
+        with self.engine._condition:
+            if name in self.engine._commands:
+                self.engine._commands[name] += 1
+            # delayed jobs and expired TTRs are only applied by a tick: every command sees the state of now
+            self.engine._tick(monotonic())
+            try:
+                return handler(self, *words[1:])
+            except (TypeError, ValueError, UnicodeDecodeError):
+                return _BAD_FORMAT
+
+    def close(self):
+        """Disconnect: reserved jobs are ready again"""
+        engine = self.engine
+        with engine._condition:
+            if self.closed:
+                return
+            self.closed = True
+            for job in list(self.reserved):
+                engine._make_ready(job)
+            self.reserved.clear()
+            self.using.using -= 1
+            engine._collect(self.using)
+            for tube in self.watching:
+                tube.watching -= 1
+                engine._collect(tube)
+            engine._sessions.discard(self)
+
+    # command handlers, called with the lock held
+
+    def _insert(self, body):
+        engine = self.engine
+        priority, delay, ttr, _ = self._put
+        now = monotonic()
+        with engine._condition:
+            engine._commands["put"] += 1
+            self.producer = True
+            job = _Job(next(engine._ids), self.using, priority, delay, max(ttr, 1), body, now)
+            engine._jobs[job.id] = job
+            engine._total_jobs += 1
+            self.using.total_jobs += 1
+            if delay:
+                engine._delay(job, delay, now)
+            else:
+                engine._make_ready(job)
+        return _response("INSERTED", job.id)
+
+    def _use(self, word):
+        engine = self.engine
+        tube = engine._tube(_tube_name(word))
+        tube.using += 1
+        self.using.using -= 1
+        engine._collect(self.using)
+        self.using = tube
+        return _response("USING", word)
+
+    def _watch(self, word):
+        tube = self.engine._tube(_tube_name(word))
+        if tube not in self.watching:
+            self.watching.append(tube)
+            tube.watching += 1
+        return _response("WATCHING", len(self.watching))
+
+    def _ignore(self, word):
+        name = _tube_name(word)
+        tube = self.engine._tubes.get(name)
+        if tube in self.watching:
+            if len(self.watching) == 1:
+                return _response("NOT_IGNORED")
+            self.watching.remove(tube)
+            tube.watching -= 1
+            self.engine._collect(tube)
+        return _response("WATCHING", len(self.watching))
+
+    def _deadline_soon(self, now):
+        return any(job.deadline - now <= SAFETY_MARGIN for job in self.reserved)
+
+    def _reserve(self, timeout=None):
+        engine = self.engine
+        self.worker = True
+        deadline = None
+        if timeout is not None:
+            deadline = monotonic() + _uint(timeout)
+        while True:
+            now = monotonic()
+            engine._tick(now)
+            job = engine._pick(self.watching, now)
+            if job is not None:
+                break
+            if self._deadline_soon(now):
+                return _response("DEADLINE_SOON")
+            if deadline is not None and now >= deadline:
+                return _response("TIMED_OUT")
+            wake = [time for time in (deadline, engine._next_event(now)) if time is not None]
+            if self.reserved:
+                wake.append(min(job.deadline for job in self.reserved) - SAFETY_MARGIN)
+            engine._waiting += 1
+            for tube in self.watching:
+                tube.waiting += 1
+            try:
+                engine._condition.wait(max(min(wake) - now, 0) if wake else None)
+            finally:
+                engine._waiting -= 1
+                for tube in self.watching:
+                    tube.waiting -= 1
+            if self.closed:
+                return _response("TIMED_OUT")
+
+        heappop(job.tube.ready)
+        engine._set_state(job, RESERVED)
+        job.owner = self
+        job.deadline = now + job.ttr
+        job.reserves += 1
+        self.reserved.add(job)
+        heappush(engine._reserved, (job.deadline, job.id, job.entry, job))
+        return _response("RESERVED", job.id, len(job.body), body=job.body)
+
+    def _reserve_with_timeout(self, timeout):
+        return self._reserve(timeout)
+
+    def _mine(self, word):
+        job = self.engine._jobs.get(_uint(word, float("inf")))
+        if job is None or job.state != RESERVED or job.owner is not self:
+            return None
+        return job
+
+    def _delete(self, word):
+        job = self.engine._jobs.get(_uint(word, float("inf")))
+        if job is None or (job.state == RESERVED and job.owner is not self):
+            return _NOT_FOUND
+        job.tube.cmd_delete += 1
+        self.engine._remove(job)
+        return _response("DELETED")
+
+    def _release(self, word, priority, delay):
+        job = self._mine(word)
+        if job is None:
+            return _NOT_FOUND
+        priority, delay = _uint(priority), _uint(delay)
+        self.reserved.discard(job)
+        job.priority = priority
+        job.releases += 1
+        if delay:
+            self.engine._delay(job, delay, monotonic())
+        else:
+            self.engine._make_ready(job)
+        return _response("RELEASED")
+
+    def _bury(self, word, priority):
+        job = self._mine(word)
+        if job is None:
+            return _NOT_FOUND
+        job.priority = _uint(priority)
+        self.reserved.discard(job)
+        self.engine._set_state(job, BURIED)
+        job.owner = None
+        job.deadline = None
+        job.buries += 1
+        job.tube.buried[job.id] = job
+        return _response("BURIED")
+
+    def _touch(self, word):
+        job = self._mine(word)
+        if job is None:
+            return _NOT_FOUND
+        engine = self.engine
+        # a new entry, the one of the old deadline goes stale
+        job.entry = next(engine._entries)
+        job.deadline = monotonic() + job.ttr
+        heappush(engine._reserved, (job.deadline, job.id, job.entry, job))
+        return _response("TOUCHED")
+
+    def _found(self, job):
+        if job is None:
+            return _NOT_FOUND
+        return _response("FOUND", job.id, len(job.body), body=job.body)
+
+    def _peek(self, word):
+        return self._found(self.engine._jobs.get(_uint(word, float("inf"))))
+
+    def _peek_ready(self):
+        top = self.engine._top(self.using.ready)
+        return self._found(None if top is None else top[3])
+
+    def _peek_delayed(self):
+        top = self.engine._top(self.using.delayed)
+        return self._found(None if top is None else top[3])
+
+    def _peek_buried(self):
+        buried = self.using.buried
+        return self._found(next(iter(buried.values())) if buried else None)
+
+    def _kick(self, bound):
+        engine = self.engine
+        bound = _uint(bound)
+        tube = self.using
+        kicked = 0
+        if tube.buried:
+            while tube.buried and kicked < bound:
+                _, job = tube.buried.popitem(last=False)
+                job.kicks += 1
+                engine._make_ready(job)
+                kicked += 1
+        else:
+            while kicked < bound:
+                top = engine._top(tube.delayed)
+                if top is None:
+                    break
+                heappop(tube.delayed)
+                top[3].kicks += 1
+                engine._make_ready(top[3])
+                kicked += 1
+        return _response("KICKED", kicked)
+
+    def _kick_job(self, word):
+        engine = self.engine
+        job = engine._jobs.get(_uint(word, float("inf")))
+        if job is None or job.state not in (BURIED, DELAYED):
+            return _NOT_FOUND
+        job.tube.buried.pop(job.id, None)
+        job.kicks += 1
+        engine._make_ready(job)
+        return _response("KICKED")
+
+    def _stats_job(self, word):
+        job = self.engine._jobs.get(_uint(word, float("inf")))
+        if job is None:
+            return _NOT_FOUND
+        now = monotonic()
+        time_left = 0
+        if job.deadline is not None:
+            time_left = max(int(job.deadline - now), 0)
+        return _yaml([("id", job.id), ("tube", job.tube.name), ("state", job.state), ("pri", job.priority),
+                      ("age", int(now - job.created)), ("delay", job.delay), ("ttr", job.ttr),
+                      ("time-left", time_left), ("file", 0), ("reserves", job.reserves),
+                      ("timeouts", job.timeouts), ("releases", job.releases), ("buries", job.buries),
+                      ("kicks", job.kicks)])
+
+    def _stats_tube(self, word):
+        tube = self.engine._tubes.get(_tube_name(word))
+        if tube is None:
+            return _NOT_FOUND
+        now = monotonic()
+        return _yaml([("name", tube.name), ("current-jobs-urgent", tube.urgent),
+                      ("current-jobs-ready", tube.counts[READY]), ("current-jobs-reserved", tube.counts[RESERVED]),
+                      ("current-jobs-delayed", tube.counts[DELAYED]), ("current-jobs-buried", tube.counts[BURIED]),
+                      ("total-jobs", tube.total_jobs), ("current-using", tube.using),
+                      ("current-waiting", tube.waiting), ("current-watching", tube.watching),
+                      ("pause", tube.pause), ("cmd-delete", tube.cmd_delete), ("cmd-pause-tube", tube.cmd_pause),
+                      ("pause-time-left", max(int(tube.paused_until - now), 0))])
+
+    def _stats(self):
+        return _yaml(self.engine._stats(monotonic()))
+
+    def _list_tubes(self):
+        return _yaml_list(sorted(self.engine._tubes))
+
+    def _list_tube_used(self):
+        return _response("USING", self.using.name)
+
+    def _list_tubes_watched(self):
+        return _yaml_list(tube.name for tube in self.watching)
+
+    def _pause_tube(self, word, delay):
+        tube = self.engine._tubes.get(_tube_name(word))
+        if tube is None:
+            return _NOT_FOUND
+        tube.pause = _uint(delay)
+        tube.paused_until = monotonic() + tube.pause
+        tube.cmd_pause += 1
+        # waiting reserves must learn when it ends
+        self.engine._condition.notify_all()
+        return _response("PAUSED")
+
+
+_HANDLERS = {
+    "use": Session._use,
+    "watch": Session._watch,
+    "ignore": Session._ignore,
+    "reserve": Session._reserve,
+    "reserve-with-timeout": Session._reserve_with_timeout,
+    "delete": Session._delete,
+    "release": Session._release,
+    "bury": Session._bury,
+    "touch": Session._touch,
+    "peek": Session._peek,
+    "peek-ready": Session._peek_ready,
+    "peek-delayed": Session._peek_delayed,
+    "peek-buried": Session._peek_buried,
+    "kick": Session._kick,
+    "kick-job": Session._kick_job,
+    "stats-job": Session._stats_job,
+    "stats-tube": Session._stats_tube,
+    "stats": Session._stats,
+    "list-tubes": Session._list_tubes,
+    "list-tube-used": Session._list_tube_used,
+    "list-tubes-watched": Session._list_tubes_watched,
+    "pause-tube": Session._pause_tube,
+}
+
+
+class EmbeddedConnection(Connection):
+    def __init__(self, engine=None, parse_yaml=True, yaml_fallback=False, codec=None, blob_store=None,
+                 blob_threshold=BLOB_THRESHOLD, metrics=None, dedup=None, idempotency_keys=False):
+        """
+        Connection to an Engine in the same process: the whole Connection API (pipelines, codecs, metrics...),
+        with commands executed by a call instead of a round trip. The other arguments are the ones of Connection
+        :param engine: engine to connect to, a new one if None
+        :type engine: Engine
+        """
+        self.engine = engine if engine is not None else Engine()
+        self._session = None
+        self._responses = deque()
+        super(EmbeddedConnection, self).__init__("embedded", None, parse_yaml, None, yaml_fallback, codec,
+                                                 blob_store, blob_threshold, metrics, dedup, idempotency_keys)
+
+    def __repr__(self):
+        return "EmbeddedConnection({!r})".format(self.engine)
+
+    def connect(self):
+        """Start a new session on the engine"""
+        self._session = self.engine.session()
+        self._responses.clear()
+        self._using = "default"
+        self._watching = ["default"]
+
+    def close(self):
+        """End the session, its reserved jobs are ready again"""
+        if self._session is not None:
+            self._session.close()
+
+    def reconnect(self):
+        self.close()
+        self.connect()
+
+    def _send_buffers(self, buffers):
+        session = self._session
+        if session is None or session.closed:
+            raise SocketError("connection closed")
+        for buffer in buffers:
+            self._responses.extend(session.feed(buffer))
+
+    def _recv(self, copy=True):
+        if not self._responses:
+            raise SocketError("no response from the engine")
+        return self._responses.popleft()
+
+
+class EngineServer(object):
+    def __init__(self, engine, host="127.0.0.1", port=0):
+        """
+        Serve the beanstalkd protocol of `engine` on a TCP socket, a thread per client
+        :type engine: Engine
+        :type host: str
+        :param port: 0 picks a free port, see `port`
+        :type port: int
+        """
+        self.engine = engine
+        self.host = host
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(128)
+        self.port = self._listener.getsockname()[1]
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        """Accept clients in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, name="pystalkd-engine-server", daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve_client, args=(sock,), name="pystalkd-engine-client",
+                             daemon=True).start()
+
+    def _serve_client(self, sock):
+        session = self.engine.session()
+        try:
+            while not session.closed:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    break
+                responses = session.feed(data)
+                replies = b"".join(encode_response(response) for response in responses)
+                if replies:
+                    sock.sendall(replies)
+        except OSError:
+            pass
+        finally:
+            session.close()
+            sock.close()
+
+    def close(self):
+        """Stop accepting clients, the ones connected are served until they leave"""
+        try:
+            # wakes up the accept of serve_forever
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._listener.close()
+
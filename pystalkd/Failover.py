@@ -0,0 +1,308 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import errno
+import random
+import select
+import socket
+import time
+from functools import partial
+from time import monotonic
+
+from .Beanstalkd import (DEFAULT_PORT, PIPELINE_WINDOW, RECV_SIZE, BeanstalkdException, Connection, Request,
+                         SocketError, _ignored, _used, _watched)
+from .Protocol import ResponseParser
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+# commands sent again on the new connection after a failover: they don't change jobs, or only reserve one, so running
+# them twice is harmless. The others (i.e. delete of a job reserved by the lost connection) raise the SocketError
+RETRYABLE = frozenset(["reserve", "reserve-with-timeout", "use", "watch", "ignore", "peek", "peek-ready",
+                       "peek-delayed", "peek-buried", "stats", "stats-job", "stats-tube", "list-tubes",
+                       "list-tube-used", "list-tubes-watched"])
+# TCP keepalive: seconds idle before the first probe, seconds between probes, unanswered probes before giving up
+DEFAULT_KEEPALIVE = (5, 1, 3)
+
+
+def _address(host):
+    if isinstance(host, str):
+        name, _, port = host.rpartition(":")
+        if not name:
+            return host, DEFAULT_PORT
+        return name, int(port)
+    return host[0], int(host[1])
+
+
+def _wait_time(request):
+    """
+    Seconds the server may legitimately take to answer `request`, None if it may never answer (reserve)
+    """
+    if request.command == "reserve":
+        return None
+    if request.command == "reserve-with-timeout":
+        return int(request.args[0])
+    return 0
+
+
+class FailoverConnection(Connection):
+    def __init__(self, hosts, connect_timeout=1.0, io_timeout=5.0, keepalive=DEFAULT_KEEPALIVE,
+                 parallel_connect=False, reconnect_timeout=30.0, min_backoff=0.05, max_backoff=2.0,
+                 retry_puts=False, **kwargs):
+        """
+        Connection that survives the loss of its server: when the socket dies it connects again, to the same server or
+        to another of `hosts`, and replays the used tube and the watch list so the caller doesn't have to.
+        Dead servers are noticed quickly: commands time out after `io_timeout` seconds (plus the timeout of
+        reserve-with-timeout) and idle sockets, i.e. during a reserve without timeout, are probed with TCP keepalive.
+        Connection attempts go through `hosts` in order, or to all of them at once with `parallel_connect` (the
+        first to accept wins), and are retried with exponential backoff between `min_backoff` and `max_backoff`
+        seconds for up to `reconnect_timeout` seconds.
+        Commands in RETRYABLE are sent again on the new connection, the others raise the SocketError once the
+        connection is back, since their effect is unknown: put may have inserted the job (see `retry_puts`), and
+        jobs reserved by the lost connection are ready again for anyone, so they can't be deleted, released,
+        buried or touched anymore
+        :param hosts: "host:port" strings or (host, port) tuples, in order of preference
+        :type hosts: list of (str | (str, int))
+        :param connect_timeout: seconds to wait for each connection attempt
+        :type connect_timeout: float
+        :param io_timeout: seconds to wait for a response, None waits forever
+        :type io_timeout: float
+        :param keepalive: (idle, interval, count) of TCP keepalive, None to disable it
+        :type keepalive: (int, int, int)
+        :param parallel_connect: try every host at the same time
+        :type parallel_connect: bool
+        :param reconnect_timeout: seconds to keep trying before raising SocketError, None tries forever
+        :type reconnect_timeout: float
+        :type min_backoff: float
+        :type max_backoff: float
+        :param retry_puts: send put again after a failover. Jobs may be inserted twice, so only for idempotent jobs
+        :type retry_puts: bool
+        :param kwargs: passed to Connection (i.e. parse_yaml, codec)
+        """
+        self.hosts = [_address(host) for host in hosts]
+        assert self.hosts, "at least one host is needed"
+        self.io_timeout = io_timeout
+        self.keepalive = keepalive
+        self.parallel_connect = parallel_connect
+        self.reconnect_timeout = reconnect_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.retryable = RETRYABLE | {"put"} if retry_puts else RETRYABLE
+        # number of times the connection was lost and established again
+        self.failovers = 0
+        self._closed = False
+        # incremented on each new socket, so threads failing together reconnect only once
+        self._generation = 0
+        self._using = "default"
+        self._watching = ["default"]
+        host, port = self.hosts[0]
+        super(FailoverConnection, self).__init__(host, port, connect_timeout=connect_timeout, **kwargs)
+
+    def __repr__(self):
+        return "FailoverConnection({!r})".format(["{}:{}".format(host, port) for host, port in self.hosts])
+
+    def connect(self):
+        """
+        Connect to one of the hosts, retrying with backoff, and restore the used tube and the watch list
+        """
+        using, watching = self._using, list(self._watching)
+        backoff = self.min_backoff
+        deadline = None if self.reconnect_timeout is None else monotonic() + self.reconnect_timeout
+        with self._lock:
+            while True:
+                try:
+                    self._socket, (self.host, self.port) = self._open()
+                    self._parser = ResponseParser(RECV_SIZE)
+                    self._using = "default"
+                    self._watching = ["default"]
+                    self._restore(using, watching)
+                    break
+                except SocketError:
+                    if self._socket is not None:
+                        self._socket.close()
+                    if deadline is not None and monotonic() + backoff > deadline:
+                        raise
+                # jitter, so a fleet of workers doesn't reconnect in lockstep
+                time.sleep(backoff * random.uniform(0.5, 1))
+                backoff = min(backoff * 2, self.max_backoff)
+            self._closed = False
+            self._generation += 1
+
+    def _restore(self, using, watching):
+        requests = []
+        if using != "default":
+            requests.append(Request("use", using, ok_status=["USING"], handler=_used))
+        for name in watching:
+            if name != "default":
+                requests.append(Request("watch", name, ok_status=["WATCHING"], handler=partial(_watched, name)))
+        if "default" not in watching:
+            requests.append(Request("ignore", "default", ok_status=["WATCHING"], handler=partial(_ignored, "default")))
+        if not requests:
+            return
+        for result in super(FailoverConnection, self)._call_many(requests):
+            if isinstance(result, BeanstalkdException):
+                raise result
+
+    def _configure(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # not every platform lets the timings be set
+            for option, value in zip(("TCP_KEEPIDLE", "TCP_KEEPINTVL", "TCP_KEEPCNT"), self.keepalive):
+                if hasattr(socket, option):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        return sock
+
+    def _open(self):
+        """
+        A connected socket to one of the hosts
+        :rtype: (socket.socket, (str, int))
+        """
+        if self.parallel_connect and len(self.hosts) > 1:
+            return self._race()
+        errors = []
+        for address in self.hosts:
+            try:
+                return self._configure(socket.create_connection(address, self._connect_timeout)), address
+            except OSError as err:
+                errors.append("{}:{} {}".format(address[0], address[1], err))
+        raise SocketError("no server reachable: " + ", ".join(errors))
+
+    def _race(self):
+        """
+        Connect to every host at the same time and keep the first connection established
+        :rtype: (socket.socket, (str, int))
+        """
+        pending = {}
+        errors = []
+        for address in self.hosts:
+            try:
+                family, kind, proto, _, sockaddr = socket.getaddrinfo(address[0], address[1], 0,
+                                                                      socket.SOCK_STREAM)[0]
+                sock = socket.socket(family, kind, proto)
+                sock.setblocking(False)
+                code = sock.connect_ex(sockaddr)
+            except OSError as err:
+                errors.append("{}:{} {}".format(address[0], address[1], err))
+                continue
+            if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sock.close()
+                errors.append("{}:{} {}".format(address[0], address[1], errno.errorcode.get(code, code)))
+                continue
+            pending[sock] = address
+
+        winner = None
+        deadline = None if self._connect_timeout is None else monotonic() + self._connect_timeout
+        try:
+            while pending and winner is None:
+                remaining = None if deadline is None else max(deadline - monotonic(), 0)
+                _, writable, _ = select.select([], list(pending), [], remaining)
+                if not writable:
+                    errors.append("timed out")
+                    break
+                for sock in writable:
+                    address = pending.pop(sock)
+                    code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if code == 0 and winner is None:
+                        winner = sock, address
+                    else:
+                        sock.close()
+                        if code:
+                            errors.append("{}:{} {}".format(address[0], address[1], errno.errorcode.get(code, code)))
+        finally:
+            for sock in pending:
+                sock.close()
+        if winner is None:
+            raise SocketError("no server reachable: " + ", ".join(errors))
+        sock, address = winner
+        sock.setblocking(True)
+        return self._configure(sock), address
+
+    def close(self):
+        """close connection and send exit to beanstalkd server. It isn't reopened by the next command"""
+        self._closed = True
+        super(FailoverConnection, self).close()
+
+    def reconnect(self):
+        self.close()
+        self._socket = None
+        self.connect()
+
+    def _failover(self, generation):
+        """
+        Replace the connection of `generation`, unless another thread already did or it was closed
+        """
+        with self._lock:
+            if self._closed:
+                raise SocketError("connection closed")
+            if generation != self._generation:
+                return
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self.failovers += 1
+            self.connect()
+
+    def _send_requests(self, requests, buffers):
+        # the batch may wait as long as the sum of its reserves, computed here under the lock: it's per send
+        wait = 0
+        for request in requests:
+            request_wait = _wait_time(request)
+            if request_wait is None:
+                wait = None
+                break
+            wait += request_wait
+        self._send_buffers(buffers, wait)
+
+    def _send_buffers(self, buffers, wait=0):
+        """
+        Send `buffers` waiting for the server up to io_timeout plus `wait` seconds, forever if `wait` is None
+        """
+        timeout = None
+        if self.io_timeout is not None and wait is not None:
+            timeout = self.io_timeout + wait
+        SocketError.wrap(self._socket.settimeout, timeout)
+        super(FailoverConnection, self)._send_buffers(buffers)
+
+    def _call(self, request):
+        while True:
+            generation = self._generation
+            try:
+                return super(FailoverConnection, self)._call(request)
+            except SocketError:
+                self._failover(generation)
+                if request.command not in self.retryable:
+                    raise
+
+    def _call_many(self, requests, window=PIPELINE_WINDOW):
+        generation = self._generation
+        try:
+            for result in super(FailoverConnection, self)._call_many(requests, window):
+                yield result
+        except SocketError:
+            self._failover(generation)
+            raise
@@ -1,5 +1,6 @@
 # -*- coding: utf8 -*-
 """pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+from time import monotonic
 
 __license__ = '''
 Copyright (C) 2008-2014 Andreas Bolka
@@ -28,8 +29,22 @@ SOFTWARE.
 __version__ = '1.3.0'
 
 
+def decode_utf8(data):
+    """
+    Default decoder of Job bodies
+    :type data: bytes | memoryview
+    :rtype: str
+    """
+    return str(data, "utf8")
+
+
 class Job:
-    def __init__(self, connection, job_id, body, size, reserved=True):
+    # no per-instance __dict__: routers and prefetchers keep lots of jobs alive
+    __slots__ = ("size", "reserved", "job_id", "connection", "_raw", "_body", "_decoder", "_stats", "_stats_time",
+                 "_blob", "idempotency_key", "_error")
+
+    def __init__(self, connection, job_id, body, size, reserved=True, decoder=None, blob=None, idempotency_key=None,
+                 error=None):
         """
         Class representing a Job from beanstalkd
         `body` can be a bytes instance if it was used with put_bytes
@@ -38,29 +53,175 @@ class Job:
         :type connection: pystalkd.Beanstalkd.Connection
         :param job_id: Job id return by put
         :type job_id: int
-        :param body: Body of job
+        :param body: Body of job, or its raw bytes if `decoder` is given
         :type body: str | bytes
         :param reserved: job is reserved or not
         :type reserved: bool
         :param size: size in bytes of the job body
         :type size: int
+        :param decoder: called with the raw bytes on first access to `body` (i.e. decode_utf8 or a codec), so jobs
+        that are only routed or inspected through `raw_body` never pay for decoding
+        :type decoder: callable
+        :param blob: (store, key) of the payload of a claim-check job, removed from the store when the job is deleted
+        :type blob: tuple
+        :param idempotency_key: key the job was put with, None if it had none
+        :type idempotency_key: str
+        :param error: raised on access to the body instead of returning it, i.e. the payload of a claim-check job
+        couldn't be fetched. The job can still be released, buried or deleted
+        :type error: pystalkd.Beanstalkd.BeanstalkdException
         """
         self.size = size
-        self.body = body
+        if decoder is None:
+            self._body = body
+            self._raw = body if isinstance(body, (bytes, bytearray, memoryview)) else None
+        else:
+            self._body = None
+            self._raw = body
+        self._decoder = decoder
         self.reserved = reserved
         self.job_id = job_id
         self.connection = connection
+        # stats-job of the job and when it was received, see `metadata`
+        self._stats = None
+        self._stats_time = None
+        self._blob = blob
+        self.idempotency_key = idempotency_key
+        self._error = error
+
+    @property
+    def body(self):
+        """
+        Body of the job: str for reserve, bytes for reserve_bytes or whatever the codec decodes. Decoded on first
+        access
+        """
+        if self._error is not None:
+            raise self._error
+        if self._decoder is not None:
+            self._body = self._decoder(self._raw)
+            self._decoder = None
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+        self._decoder = None
+
+    @property
+    def raw_body(self):
+        """
+        Body as received from the server, without any decoding
+        :rtype: bytes | memoryview
+        """
+        if self._error is not None:
+            raise self._error
+        if self._raw is None:
+            self._raw = self._body.encode("utf8")
+        return self._raw
+
+    @property
+    def text(self):
+        """
+        Body as received from the server decoded as utf-8, even if it was encoded by a codec
+        :rtype: str
+        """
+        if self._error is not None:
+            raise self._error
+        if self._decoder is decode_utf8:
+            return self.body
+        if self._raw is None:
+            return self._body
+        return str(self._raw, "utf8")
+
+    def _remember(self, stats):
+        self._stats = stats
+        self._stats_time = monotonic()
+
+    def invalidate(self):
+        """Forget the cached metadata, the next access asks the server again"""
+        self._stats = None
+
+    def metadata(self, refresh=False):
+        """
+        Return the stats-job dict of this job, cached.
+        The server is only asked on first use or with `refresh`: priority, ttr, tube and reserves don't change while
+        the job is reserved, and `age` and `time_left` are computed from the time the stats were received.
+        Connection.load_metadata fills the cache of many jobs with pipelined commands. The cache is dropped when the
+        job is deleted, released or buried
+        :param refresh: ask the server even if the metadata is cached
+        :type refresh: bool
+        :rtype: dict
+        """
+        if self._stats is None or refresh:
+            self._remember(self.connection._job_stats(self.job_id))
+        return self._stats
+
+    def _field(self, name):
+        return self.metadata()[name]
+
+    def _elapsed(self):
+        return int(monotonic() - self._stats_time)
+
+    @property
+    def priority(self):
+        """:rtype: int"""
+        return self._field("pri")
+
+    @property
+    def ttr(self):
+        """:rtype: int"""
+        return self._field("ttr")
+
+    @property
+    def tube(self):
+        """:rtype: str"""
+        return self._field("tube")
+
+    @property
+    def reserves(self):
+        """:rtype: int"""
+        return self._field("reserves")
+
+    @property
+    def age(self):
+        """Seconds since the job was put, estimated from the cached metadata
+        :rtype: int
+        """
+        age = self._field("age")
+        return None if age is None else age + self._elapsed()
+
+    @property
+    def time_left(self):
+        """Seconds before the reservation expires, estimated from the cached metadata
+        :rtype: int
+        """
+        time_left = self._field("time-left")
+        return None if time_left is None else max(time_left - self._elapsed(), 0)
 
     def _priority(self):
-        stats = self.stats()
-        if isinstance(stats, dict):
-            return stats['pri']
-        return 2 ** 31
+        return self.priority
+
+    def _done(self):
+        self.reserved = False
+        self._stats = None
+
+    def _collect(self):
+        """Remove the payload of a deleted claim-check job from its blob store"""
+        if self._blob is not None:
+            store, key = self._blob
+            self._blob = None
+            store.delete(key)
+
+    def _touched(self):
+        if self._stats is not None:
+            # the server restarts the ttr countdown
+            self._stats["time-left"] = self._stats["ttr"]
+            self._stats_time = monotonic()
 
     def delete(self):
         """Delete this job."""
         self.connection.delete(self.job_id)
-        self.reserved = False
+        self._done()
+        self._collect()
 
     def release(self, priority=None, delay=0):
         """Release a reserved job back into the ready queue.
@@ -73,7 +234,7 @@ class Job:
         """
         if self.reserved:
             self.connection.release(self.job_id, priority or self._priority(), delay)
-            self.reserved = False
+            self._done()
 
     def bury(self, priority=None):
         """Bury a job, by job id.
@@ -83,7 +244,7 @@ class Job:
         """
         if self.reserved:
             self.connection.bury(self.job_id, priority or self._priority())
-            self.reserved = False
+            self._done()
 
     def kick(self):
         """If the given job exists and is in a buried or
@@ -92,7 +253,7 @@ class Job:
         :return: job_id
         :rtype: int
         """
-        self.connection.kick_job(self.job_id)
+        return self.connection.kick_job(self.job_id)
 
     def touch(self):
         """Touch a this job requesting more time to work
@@ -100,9 +261,88 @@ class Job:
         """
         if self.reserved:
             self.connection.touch(self.job_id)
+            self._touched()
 
     def stats(self):
         """Return a dict of stats about this job.
         See <https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#stats-job-command> for full info.
         """
         return self.connection.stats_job(self.job_id)
+
+
+class AsyncJob(Job):
+    """
+    Job returned by pystalkd.AsyncBeanstalkd.AsyncConnection. Same as Job but its methods are coroutines
+    """
+    __slots__ = ()
+
+    async def metadata(self, refresh=False):
+        """
+        Return the stats-job dict of this job, cached. Same as Job.metadata: it must be awaited once before the
+        properties (priority, ttr, tube...) can be used, they return None otherwise
+        :type refresh: bool
+        :rtype: dict
+        """
+        if self._stats is None or refresh:
+            self._remember(await self.connection._job_stats(self.job_id))
+        return self._stats
+
+    def _field(self, name):
+        if self._stats is None:
+            return None
+        return self._stats[name]
+
+    async def _priority(self):
+        return (await self.metadata())["pri"]
+
+    async def delete(self):
+        """Delete this job."""
+        await self.connection.delete(self.job_id)
+        self._done()
+        self._collect()
+
+    async def release(self, priority=None, delay=0):
+        """Release a reserved job back into the ready queue.
+        See <https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#release-command> for full info.
+        :param priority: new priority to assign to the job.
+        :param delay: number of seconds to wait before putting the job in the ready queue.
+        The job will be in the "delayed" state during this time.
+        :type priority: int
+        :type delay: int | timedelta
+        """
+        if self.reserved:
+            await self.connection.release(self.job_id, priority or await self._priority(), delay)
+            self._done()
+
+    async def bury(self, priority=None):
+        """Bury a job, by job id.
+        See <https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#bury-command> for full info.
+        :param priority: new priority to assign to the job.
+        :type priority: int
+        """
+        if self.reserved:
+            await self.connection.bury(self.job_id, priority or await self._priority())
+            self._done()
+
+    async def kick(self):
+        """If the given job exists and is in a buried or
+        delayed state, it will be moved to the ready queue of the the same tube where it currently belongs
+        See <https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#kick-job-command> for full info.
+        :return: job_id
+        :rtype: int
+        """
+        return await self.connection.kick_job(self.job_id)
+
+    async def touch(self):
+        """Touch a this job requesting more time to work
+        See <https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#touch-command> for full info.
+        """
+        if self.reserved:
+            await self.connection.touch(self.job_id)
+            self._touched()
+
+    async def stats(self):
+        """Return a dict of stats about this job.
+        See <https://github.com/kr/beanstalkd/blob/master/doc/protocol.md#stats-job-command> for full info.
+        """
+        return await self.connection.stats_job(self.job_id)
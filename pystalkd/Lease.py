@@ -0,0 +1,243 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import heapq
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import count
+from time import monotonic
+
+from .Beanstalkd import BeanstalkdException, total_seconds
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+
+class _Lease(object):
+    def __init__(self, job, ttr, time_left):
+        self.job = job
+        self.ttr = ttr
+        self.deadline = monotonic() + time_left
+        # sequence of the heap entry currently scheduling this lease, older entries are ignored
+        self.sequence = None
+
+
+class LeaseKeeper(object):
+    def __init__(self, connection, ratio=0.5, batch_window=0.5):
+        """
+        Touch reserved jobs in the background so they are not given to another worker when their TTR expires.
+        Jobs given to `keep` are touched every `ratio` * ttr seconds until they are deleted, released or buried
+        (`job.reserved` is False), forgotten, or the server answers NOT_FOUND. When a job is due, the ones due within
+        the next `batch_window` seconds are touched with it, with pipelined commands.
+        beanstalkd only accepts a touch from the connection that reserved the job, so the keeper sends them through
+        `connection` from its own thread. Use reserve with a timeout on that connection while jobs are kept: the
+        server doesn't answer anything else while a reserve is waiting.
+        Jobs whose touch fails (i.e. NOT_FOUND) are forgotten and their error added to `errors`. If the connection
+        fails the keeper stops touching: the error is added to `errors` and raised by the next `keep`
+        :param connection: connection that reserved the jobs
+        :type connection: pystalkd.Beanstalkd.Connection
+        :param ratio: fraction of the ttr after which a job is touched
+        :type ratio: float
+        :param batch_window: seconds, jobs due this close to each other are touched together
+        :type batch_window: float
+        """
+        assert 0 < ratio < 1, "ratio must be between 0 and 1"
+        self.connection = connection
+        self.ratio = ratio
+        self.batch_window = batch_window
+        self.touches = 0
+        self.errors = []
+        # error that stopped the background thread
+        self._failure = None
+        self._leases = {}
+        # (time of next touch, sequence, job id)
+        self._heap = []
+        # jobs waiting for their ttr and time-left from stats-job
+        self._unknown = []
+        self._learning = set()
+        self._sequence = count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="pystalkd-lease-keeper", daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._leases)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _schedule(self, lease):
+        # touch after `ratio` of the time left, but never later than the deadline itself
+        now = monotonic()
+        due = now + max(min(lease.ttr, lease.deadline - now) * self.ratio, 0)
+        lease.sequence = next(self._sequence)
+        heapq.heappush(self._heap, (due, lease.sequence, lease.job.job_id))
+
+    def keep(self, job, ttr=None, time_left=None):
+        """
+        Start keeping `job` reserved.
+        `ttr` and `time_left` (seconds) come from the metadata cached in the job (see Job.metadata) or are asked to
+        the server with stats-job when not given. If the ttr is known (i.e. from the put) pass it to save the round
+        trip
+        :type job: pystalkd.Job.Job
+        :type ttr: int | timedelta
+        :type time_left: int | float | timedelta
+        """
+        if isinstance(ttr, timedelta):
+            ttr = total_seconds(ttr)
+        if isinstance(time_left, timedelta):
+            time_left = time_left.total_seconds()
+        if ttr is None and job._stats is not None:
+            ttr, time_left = job.ttr, job.time_left
+        with self._condition:
+            if self._failure is not None:
+                raise self._failure
+            if ttr is None:
+                self._unknown.append(job)
+                self._learning.add(job.job_id)
+            else:
+                lease = self._leases[job.job_id] = _Lease(job, ttr, ttr if time_left is None else time_left)
+                self._schedule(lease)
+            self._condition.notify()
+
+    def forget(self, job):
+        """
+        Stop keeping `job` reserved
+        :type job: pystalkd.Job.Job
+        """
+        with self._condition:
+            self._leases.pop(job.job_id, None)
+            self._learning.discard(job.job_id)
+            if job in self._unknown:
+                self._unknown.remove(job)
+
+    @contextmanager
+    def lease(self, job, ttr=None):
+        """
+        Keep `job` reserved while in a with statement
+        :type job: pystalkd.Job.Job
+        :type ttr: int | timedelta
+        """
+        self.keep(job, ttr)
+        try:
+            yield job
+        finally:
+            self.forget(job)
+
+    def close(self):
+        """Stop the background thread. Jobs stop being touched"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _learn(self, jobs):
+        """
+        Ask ttr and time-left of `jobs` with pipelined stats-job
+        :type jobs: list of pystalkd.Job.Job
+        """
+        results = self.connection.load_metadata(jobs)
+        with self._condition:
+            for job, stats in zip(jobs, results):
+                if job.job_id not in self._learning:
+                    # forgotten while stats-job was in flight
+                    continue
+                self._learning.discard(job.job_id)
+                if isinstance(stats, BeanstalkdException):
+                    self.errors.append(stats)
+                    continue
+                if not job.reserved:
+                    continue
+                lease = _Lease(job, job.ttr, job.time_left)
+                self._leases[job.job_id] = lease
+                self._schedule(lease)
+
+    def _due(self):
+        """
+        Pop the leases that must be touched now. Call with the lock held
+        :rtype: list of _Lease
+        """
+        limit = monotonic() + self.batch_window
+        due = []
+        while self._heap and self._heap[0][0] <= limit:
+            _, sequence, job_id = heapq.heappop(self._heap)
+            lease = self._leases.get(job_id)
+            if lease is None or lease.sequence != sequence:
+                continue
+            if not lease.job.reserved:
+                del self._leases[job_id]
+                continue
+            due.append(lease)
+        return due
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self._unknown:
+                    if self._heap and self._heap[0][0] <= monotonic():
+                        break
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] - monotonic()
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+                unknown, self._unknown = self._unknown, []
+                due = self._due()
+
+            try:
+                if unknown:
+                    self._learn(unknown)
+                if due:
+                    results = self.connection.touch_many([lease.job for lease in due])
+            except BeanstalkdException as err:
+                # the connection is unusable: no more touches, the leases will expire
+                with self._condition:
+                    self.errors.append(err)
+                    self._failure = err
+                return
+
+            if not due:
+                continue
+            now = monotonic()
+            with self._condition:
+                for lease, result in zip(due, results):
+                    if self._leases.get(lease.job.job_id) is not lease:
+                        continue
+                    if isinstance(result, BeanstalkdException):
+                        self.errors.append(result)
+                        del self._leases[lease.job.job_id]
+                        continue
+                    self.touches += 1
+                    lease.deadline = now + lease.ttr
+                    self._schedule(lease)
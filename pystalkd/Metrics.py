@@ -0,0 +1,248 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+# upper bounds (seconds) of the latency buckets: from a local round trip to a long reserve
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+def request_size(request):
+    """
+    Bytes sent for `request`
+    :type request: pystalkd.Beanstalkd.Request
+    :rtype: int
+    """
+    if request.body is None:
+        return len(request.data)
+    return len(request.data) + len(request.body) + 2
+
+
+def response_size(response):
+    """
+    Bytes received for `response`: the status line and the data chunk, if any
+    :type response: pystalkd.Protocol.Response
+    :rtype: int
+    """
+    size = len(response.status) + 2 + sum(len(arg) + 1 for arg in response.args)
+    if response.body is not None:
+        size += len(response.body) + 2
+    return size
+
+
+class CommandStats(object):
+    __slots__ = ("calls", "errors", "bytes_sent", "bytes_received", "latency_sum", "buckets")
+
+    def __init__(self, size):
+        """
+        Counters of one command
+        :param size: number of latency buckets, without the +Inf one
+        :type size: int
+        """
+        self.calls = 0
+        # failures by status (or exception name when there was no response)
+        self.errors = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        # calls per latency bucket, not cumulative. The last one is +Inf
+        self.buckets = [0] * (size + 1)
+
+
+class Metrics(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS, before=None, after=None):
+        """
+        Instrumentation of the commands sent by one or more connections (see the `metrics` argument of Connection and
+        AsyncConnection): for each command name the calls, the failures by status, the bytes sent and received and
+        a latency histogram with fixed buckets. Pipelined commands are timed from the send of their batch to the
+        read of their own response.
+        Connections without metrics only pay an attribute check per command. Safe to share between threads
+        :param buckets: upper bounds of the latency buckets, in seconds
+        :type buckets: collections.Iterable[float]
+        :param before: called as before(command) before a command is sent
+        :type before: callable
+        :param after: called as after(command, status, seconds) when its response arrives, or with the exception
+        name as status if it never does
+        :type after: callable
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.before = []
+        self.after = []
+        self.add_hooks(before, after)
+        self._commands = {}
+        self._lock = threading.Lock()
+
+    def add_hooks(self, before=None, after=None):
+        """
+        Add callbacks called around every command, see the constructor
+        :type before: callable
+        :type after: callable
+        """
+        if before is not None:
+            self.before.append(before)
+        if after is not None:
+            self.after.append(after)
+
+    def start(self, request):
+        """
+        Call the before hooks for `request`, about to be sent
+        :type request: pystalkd.Beanstalkd.Request
+        :return: start time, to give to `finish` or `fail`
+        :rtype: float
+        """
+        for hook in self.before:
+            hook(request.command)
+        return perf_counter()
+
+    def finish(self, request, response, start, failed=None):
+        """
+        Record a command answered with `response`
+        :type request: pystalkd.Beanstalkd.Request
+        :type response: pystalkd.Protocol.Response
+        :param start: value returned by `start`
+        :type start: float
+        :param failed: whether the response is a failure, by default when it is not one of the ok status of `request`
+        :type failed: bool
+        """
+        elapsed = perf_counter() - start
+        if failed is None:
+            failed = response.status not in request.ok_status
+        self.record(request.command, response.status, failed, request_size(request), response_size(response),
+                    elapsed)
+
+    def fail(self, request, error, start):
+        """
+        Record a command that got no response because of `error` (i.e. a SocketError)
+        :type request: pystalkd.Beanstalkd.Request
+        :type error: Exception
+        :param start: value returned by `start`
+        :type start: float
+        """
+        self.record(request.command, type(error).__name__, True, request_size(request), 0, perf_counter() - start)
+
+    def record(self, command, status, failed, sent, received, elapsed):
+        """
+        Count one call of `command` and call the after hooks
+        :type command: str
+        :type status: str
+        :type failed: bool
+        :param sent: bytes sent
+        :type sent: int
+        :param received: bytes received
+        :type received: int
+        :param elapsed: latency in seconds
+        :type elapsed: float
+        """
+        bucket = bisect_left(self.buckets, elapsed)
+        with self._lock:
+            stats = self._commands.get(command)
+            if stats is None:
+                stats = self._commands[command] = CommandStats(len(self.buckets))
+            stats.calls += 1
+            if failed:
+                stats.errors[status] = stats.errors.get(status, 0) + 1
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            stats.latency_sum += elapsed
+            stats.buckets[bucket] += 1
+        for hook in self.after:
+            hook(command, status, elapsed)
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self._lock:
+            self._commands = {}
+
+    def snapshot(self):
+        """
+        Copy of the counters, by command name:
+        {"put": {"calls": 2, "errors": {"JOB_TOO_BIG": 1}, "bytes_sent": 61, "bytes_received": 20,
+        "latency": {"sum": 0.0003, "count": 2, "buckets": {0.0001: 0, 0.00025: 2, ..., inf: 2}}}}
+        Buckets are cumulative, as in Prometheus: calls that took at most that many seconds
+        :rtype: dict
+        """
+        with self._lock:
+            commands = [(command, stats.calls, dict(stats.errors), stats.bytes_sent, stats.bytes_received,
+                         stats.latency_sum, list(stats.buckets)) for command, stats in self._commands.items()]
+        snapshot = {}
+        bounds = self.buckets + (float("inf"),)
+        for command, calls, errors, sent, received, latency_sum, buckets in commands:
+            cumulative = {}
+            total = 0
+            for bound, count in zip(bounds, buckets):
+                total += count
+                cumulative[bound] = total
+            snapshot[command] = {"calls": calls, "errors": errors, "bytes_sent": sent, "bytes_received": received,
+                                 "latency": {"sum": latency_sum, "count": calls, "buckets": cumulative}}
+        return snapshot
+
+    def prometheus(self, prefix="pystalkd"):
+        """
+        The counters in the Prometheus text exposition format, labelled by command
+        :param prefix: start of the metric names
+        :type prefix: str
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, description):
+            lines.append("# HELP {}_{} {}".format(prefix, name, description))
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+
+        family("commands_total", "counter", "Commands sent to beanstalkd")
+        for command, stats in sorted(snapshot.items()):
+            lines.append('{}_commands_total{{command="{}"}} {}'.format(prefix, command, stats["calls"]))
+        family("command_errors_total", "counter", "Failed commands by response status")
+        for command, stats in sorted(snapshot.items()):
+            for status, count in sorted(stats["errors"].items()):
+                lines.append('{}_command_errors_total{{command="{}",status="{}"}} {}'.format(prefix, command, status,
+                                                                                            count))
+        family("sent_bytes_total", "counter", "Bytes sent to beanstalkd")
+        for command, stats in sorted(snapshot.items()):
+            lines.append('{}_sent_bytes_total{{command="{}"}} {}'.format(prefix, command, stats["bytes_sent"]))
+        family("received_bytes_total", "counter", "Bytes received from beanstalkd")
+        for command, stats in sorted(snapshot.items()):
+            lines.append('{}_received_bytes_total{{command="{}"}} {}'.format(prefix, command,
+                                                                            stats["bytes_received"]))
+        family("command_duration_seconds", "histogram", "Time from sending a command to reading its response")
+        for command, stats in sorted(snapshot.items()):
+            latency = stats["latency"]
+            for bound, count in latency["buckets"].items():
+                le = "+Inf" if bound == float("inf") else "{:g}".format(bound)
+                lines.append('{}_command_duration_seconds_bucket{{command="{}",le="{}"}} {}'.format(prefix, command,
+                                                                                                   le, count))
+            lines.append('{}_command_duration_seconds_sum{{command="{}"}} {}'.format(prefix, command,
+                                                                                   latency["sum"]))
+            lines.append('{}_command_duration_seconds_count{{command="{}"}} {}'.format(prefix, command,
+                                                                                     latency["count"]))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,413 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import json
+import os
+import struct
+import sys
+from time import monotonic
+
+from .Beanstalkd import DEFAULT_HOST, DEFAULT_PORT, PIPELINE_WINDOW, BeanstalkdException, Connection, Request
+from .Job import Job
+from .Protocol import parse_stats
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+# dump file: MAGIC, the tube name (HEADER + utf8), then a RECORD, the idempotency key (utf8) and the body per job
+MAGIC = b"PSTKDMP2"
+HEADER = struct.Struct("<H")
+# priority, remaining delay, ttr, body size, key size (NO_KEY if the job has none)
+RECORD = struct.Struct("<IIIIH")
+NO_KEY = 0xffff
+
+
+class DumpFormatError(BeanstalkdException):
+    """Not a dump file, or a truncated one"""
+    pass
+
+
+def _save_checkpoint(path, state):
+    # written aside and renamed, so a crash leaves the previous checkpoint or the new one, never half of one
+    temporary = path + ".tmp"
+    with open(temporary, "w") as checkpoint:
+        json.dump(state, checkpoint)
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+    os.replace(temporary, path)
+
+
+def _remove_checkpoint(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path) as checkpoint:
+            return json.load(checkpoint)
+    except FileNotFoundError:
+        return None
+
+
+# stats-job fields needed to put a job again
+_FIELDS = frozenset(["pri", "ttr", "delay", "age"])
+
+
+def _job_fields(connection, response):
+    """stats-job reduced to _FIELDS"""
+    return parse_stats(response.body, _FIELDS)
+
+
+def _reserve_window(source, window, delayed):
+    """
+    Reserve up to `window` ready jobs with one pipeline and fetch their stats with another
+    :param delayed: the jobs were kicked from the delayed state, estimate their remaining delay
+    :type delayed: bool
+    :rtype: list of (Job, int, int, int)
+    """
+    pipeline = source.pipeline()
+    for _ in range(window):
+        pipeline.reserve(0, True)
+    # TIMED_OUT (None) or DEADLINE_SOON: the tube has no more ready jobs
+    jobs = [job for job in pipeline.execute() if isinstance(job, Job)]
+    if not jobs:
+        return []
+    pipeline = source.pipeline()
+    for job in jobs:
+        pipeline._call(Request("stats-job", job.job_id, ok_status=["OK"], error_status=["NOT_FOUND"],
+                               handler=_job_fields))
+    reserved = []
+    for job, stats in zip(jobs, pipeline.execute(raise_on_error=True, window=window)):
+        delay = max(stats["delay"] - stats["age"], 0) if delayed else 0
+        reserved.append((job, stats["pri"], delay, stats["ttr"]))
+    return reserved
+
+
+def drain(source, tube, window=PIPELINE_WINDOW, kick_buried=False):
+    """
+    Reserve every job of `tube`, a window at a time. The jobs are yielded reserved, with what is needed to put them
+    again (their idempotency key is in Job.idempotency_key), and must be deleted by the caller once they're safe
+    elsewhere.
+    Ready jobs come first. Then, if `kick_buried`, the buried jobs are kicked and drained as ready jobs. Delayed
+    jobs can't be reserved, so they're kicked too (only possible once the tube has no buried jobs, they're left in
+    place otherwise) and their remaining delay estimated as the delay they were put with minus their age.
+    Producers should be stopped: jobs put meanwhile are drained too, possibly in the wrong phase
+    :param source: connection used only by the drain, it's made to use and watch `tube` only and to read
+    idempotency keys
+    :type source: pystalkd.Beanstalkd.Connection
+    :type tube: str
+    :param window: jobs reserved with one pipeline
+    :type window: int
+    :param kick_buried: drain the buried jobs too, they're moved as ready jobs
+    :type kick_buried: bool
+    :return: windows of (job, priority, remaining delay, ttr)
+    :rtype: collections.Iterator[list of (Job, int, int, int)]
+    """
+    # the key is put back separately, so the body must come without its envelope
+    source.idempotency_keys = True
+    source.use(tube)
+    source.watch(tube)
+    for name in source.watching():
+        if name != tube:
+            source.ignore(name)
+
+    def phase(delayed):
+        while True:
+            jobs = _reserve_window(source, window, delayed)
+            if not jobs:
+                return
+            yield jobs
+            if len(jobs) < window:
+                return
+
+    yield from phase(False)
+    stats = source.stats_tube(tube)
+    if kick_buried and stats["current-jobs-buried"]:
+        source.kick(stats["current-jobs-buried"])
+        yield from phase(False)
+        stats = source.stats_tube(tube)
+    if stats["current-jobs-delayed"] and not stats["current-jobs-buried"]:
+        source.kick(stats["current-jobs-delayed"])
+        yield from phase(True)
+
+
+def write_header(output, tube):
+    name = tube.encode("utf8")
+    output.write(MAGIC + HEADER.pack(len(name)) + name)
+
+
+def read_header(stream):
+    """
+    Check the header of a dump file
+    :return: name of the dumped tube
+    :rtype: str
+    """
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise DumpFormatError("not a pystalkd dump")
+    data = stream.read(HEADER.size)
+    if len(data) < HEADER.size:
+        raise DumpFormatError("truncated header")
+    name = stream.read(HEADER.unpack(data)[0])
+    return str(name, "utf8")
+
+
+def pack_record(priority, delay, ttr, body, key=None):
+    """
+    A job in the dump format
+    :param key: idempotency key of the job
+    :type key: str | None
+    :rtype: bytes
+    """
+    if key is None:
+        return b"".join((RECORD.pack(priority, delay, ttr, len(body), NO_KEY), body))
+    encoded = key.encode("utf8")
+    return b"".join((RECORD.pack(priority, delay, ttr, len(body), len(encoded)), encoded, body))
+
+
+def read_records(stream, window=PIPELINE_WINDOW):
+    """
+    Records of a dump file, after its header
+    :return: windows of (priority, delay, ttr, body, idempotency key or None) and the offset in the file after each
+    window
+    :rtype: collections.Iterator[(list of (int, int, int, bytes, str), int)]
+    """
+    records = []
+    while True:
+        data = stream.read(RECORD.size)
+        if not data:
+            break
+        if len(data) < RECORD.size:
+            raise DumpFormatError("truncated record")
+        priority, delay, ttr, size, key_size = RECORD.unpack(data)
+        key = None
+        if key_size != NO_KEY:
+            encoded = stream.read(key_size)
+            if len(encoded) < key_size:
+                raise DumpFormatError("truncated key")
+            key = str(encoded, "utf8")
+        body = stream.read(size)
+        if len(body) < size:
+            raise DumpFormatError("truncated body")
+        records.append((priority, delay, ttr, body, key))
+        if len(records) == window:
+            yield records, stream.tell()
+            records = []
+    if records:
+        yield records, stream.tell()
+
+
+def dump(source, tube, path, window=PIPELINE_WINDOW, kick_buried=False, progress=None):
+    """
+    Move the jobs of `tube` to the file `path` with their priority, remaining delay and TTR (see `drain`).
+    Each window is written and synced, then recorded in the checkpoint `path`.checkpoint, then deleted from the
+    server. If the dump is interrupted, calling it again with the same `path` resumes it: the file is cut back to
+    the checkpoint and the jobs it lists as written are deleted, so no job is lost or dumped twice. The checkpoint
+    is removed once the tube is empty
+    :type source: pystalkd.Beanstalkd.Connection
+    :type tube: str
+    :type path: str
+    :param progress: called with the total number of jobs dumped after each window
+    :type progress: callable
+    :return: number of jobs in the file
+    :rtype: int
+    """
+    checkpoint_path = path + ".checkpoint"
+    checkpoint = _load_checkpoint(checkpoint_path)
+    if checkpoint is None:
+        # "x": an existing dump isn't overwritten
+        output = open(path, "xb")
+        write_header(output, tube)
+        count = 0
+    else:
+        output = open(path, "r+b")
+        output.truncate(checkpoint["offset"])
+        output.seek(checkpoint["offset"])
+        count = checkpoint["jobs"]
+        source.delete_many(checkpoint["pending"], window)
+
+    with output:
+        for jobs in drain(source, tube, window, kick_buried):
+            output.write(b"".join(pack_record(priority, delay, ttr, bytes(job.raw_body), job.idempotency_key)
+                                  for job, priority, delay, ttr in jobs))
+            output.flush()
+            os.fsync(output.fileno())
+            count += len(jobs)
+            _save_checkpoint(checkpoint_path, {"offset": output.tell(), "jobs": count,
+                                               "pending": [job.job_id for job, _, _, _ in jobs]})
+            # a job whose TTR expired meanwhile may have been reserved by someone else: it's in the file anyway
+            source.delete_many([job for job, _, _, _ in jobs], window)
+            if progress is not None:
+                progress(count)
+    _remove_checkpoint(checkpoint_path)
+    return count
+
+
+def load(destination, path, tube=None, window=PIPELINE_WINDOW, progress=None):
+    """
+    Put the jobs of the dump file `path` with pipelined puts, a window at a time.
+    The offset in the file after each window is recorded in the checkpoint `path`.load-checkpoint, calling load
+    again after an interruption resumes from there (the window being put when it stopped may be put twice). The
+    checkpoint is removed at the end
+    :type destination: pystalkd.Beanstalkd.Connection
+    :param tube: tube to put the jobs in, the dumped tube if None
+    :type tube: str
+    :return: number of jobs put
+    :rtype: int
+    """
+    checkpoint_path = path + ".load-checkpoint"
+    checkpoint = _load_checkpoint(checkpoint_path)
+    count = 0
+    with open(path, "rb") as stream:
+        dumped = read_header(stream)
+        if checkpoint is not None:
+            stream.seek(checkpoint["offset"])
+            count = checkpoint["jobs"]
+        destination.use(tube or dumped)
+        for records, offset in read_records(stream, window):
+            pipeline = destination.pipeline()
+            for priority, delay, ttr, body, key in records:
+                pipeline.put(body, priority, delay, ttr, raw=True, idempotency_key=key)
+            pipeline.execute(raise_on_error=True, window=window)
+            count += len(records)
+            _save_checkpoint(checkpoint_path, {"offset": offset, "jobs": count})
+            if progress is not None:
+                progress(count)
+    _remove_checkpoint(checkpoint_path)
+    return count
+
+
+def migrate(source, destination, tube, to_tube=None, window=PIPELINE_WINDOW, kick_buried=False, progress=None):
+    """
+    Move the jobs of `tube` to another tube or server with their priority, remaining delay and TTR (see `drain`):
+    each window is put on `destination`, then deleted from `source`. Nothing is lost if it's interrupted, running it
+    again moves what's left (the window being moved when it stopped may be put twice)
+    :param source: connection to the server the jobs are taken from, used only by the migration
+    :type source: pystalkd.Beanstalkd.Connection
+    :param destination: connection to the server the jobs are put on, not the same as `source`
+    :type destination: pystalkd.Beanstalkd.Connection
+    :type tube: str
+    :param to_tube: tube on `destination`, `tube` if None
+    :type to_tube: str
+    :return: number of jobs moved
+    :rtype: int
+    """
+    assert source is not destination, "the source connection watches the tube, puts need their own connection"
+    destination.use(to_tube or tube)
+    count = 0
+    for jobs in drain(source, tube, window, kick_buried):
+        pipeline = destination.pipeline()
+        for job, priority, delay, ttr in jobs:
+            pipeline.put(job.raw_body, priority, delay, ttr, raw=True, idempotency_key=job.idempotency_key)
+        pipeline.execute(raise_on_error=True, window=window)
+        source.delete_many([job for job, _, _, _ in jobs], window)
+        count += len(jobs)
+        if progress is not None:
+            progress(count)
+    return count
+
+
+def _connect(address):
+    host, _, port = address.partition(":")
+    return Connection(host, int(port or DEFAULT_PORT))
+
+
+def _progress():
+    started = monotonic()
+
+    def report(count):
+        elapsed = monotonic() - started
+        sys.stderr.write("\r{} jobs, {:.0f} jobs/s".format(count, count / elapsed if elapsed else 0))
+        sys.stderr.flush()
+
+    return report
+
+
+def add_arguments(commands):
+    """
+    dump, load and migrate commands, for the command line of python3 -m pystalkd
+    :param commands: subparsers of the command line
+    """
+    server = "{}:{}".format(DEFAULT_HOST, DEFAULT_PORT)
+    parser = commands.add_parser("dump", help="move the jobs of a tube to a file")
+    parser.add_argument("tube")
+    parser.add_argument("file", help="dump file, an interrupted dump to the same file is resumed")
+    parser.add_argument("-s", "--server", default=server, help="host[:port] (default %(default)s)")
+    parser.add_argument("--kick-buried", action="store_true", help="dump the buried jobs too, as ready jobs")
+    parser.add_argument("-w", "--window", type=int, default=PIPELINE_WINDOW, help="jobs per pipeline")
+    parser.set_defaults(run=_run_dump)
+
+    parser = commands.add_parser("load", help="put the jobs of a dump file")
+    parser.add_argument("file")
+    parser.add_argument("-s", "--server", default=server, help="host[:port] (default %(default)s)")
+    parser.add_argument("-t", "--tube", help="tube to put the jobs in (default: the dumped tube)")
+    parser.add_argument("-w", "--window", type=int, default=PIPELINE_WINDOW, help="jobs per pipeline")
+    parser.set_defaults(run=_run_load)
+
+    parser = commands.add_parser("migrate", help="move the jobs of a tube to another tube or server")
+    parser.add_argument("tube")
+    parser.add_argument("-f", "--from", dest="source", default=server, help="host[:port] (default %(default)s)")
+    parser.add_argument("-t", "--to", dest="destination", default=server, help="host[:port] (default %(default)s)")
+    parser.add_argument("--to-tube", help="tube on the destination (default: the same)")
+    parser.add_argument("--kick-buried", action="store_true", help="move the buried jobs too, as ready jobs")
+    parser.add_argument("-w", "--window", type=int, default=PIPELINE_WINDOW, help="jobs per pipeline")
+    parser.set_defaults(run=_run_migrate)
+
+
+def _run_dump(args):
+    source = _connect(args.server)
+    try:
+        count = dump(source, args.tube, args.file, args.window, args.kick_buried, _progress())
+    finally:
+        source.close()
+    print("\n{} jobs dumped to {}".format(count, args.file))
+    return 0
+
+
+def _run_load(args):
+    destination = _connect(args.server)
+    try:
+        count = load(destination, args.file, args.tube, args.window, _progress())
+    finally:
+        destination.close()
+    print("\n{} jobs loaded".format(count))
+    return 0
+
+
+def _run_migrate(args):
+    if args.source == args.destination and args.to_tube in (None, args.tube):
+        sys.exit("source and destination are the same tube")
+    source = _connect(args.source)
+    destination = _connect(args.destination)
+    try:
+        count = migrate(source, destination, args.tube, args.to_tube, args.window, args.kick_buried, _progress())
+    finally:
+        source.close()
+        destination.close()
+    print("\n{} jobs migrated".format(count))
+    return 0
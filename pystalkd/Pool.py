@@ -0,0 +1,260 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic
+
+from .Beanstalkd import DEFAULT_HOST, DEFAULT_PORT, BeanstalkdException, Connection, SocketError
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+
+class PoolTimeout(BeanstalkdException):
+    pass
+
+
+class ConnectionPool(object):
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, min_size=1, max_size=10, idle_timeout=300.0,
+                 health_check_interval=30.0, **kwargs):
+        """
+        Thread safe pool of Connection objects.
+        A connection can only be used by one thread at a time: borrow it with `connection()` in a with statement
+        (or `get` and `put`). Every connection handed out uses and watches only the "default" tube, whatever the
+        previous borrower did with it.
+        Idle connections above `min_size` are closed after `idle_timeout` seconds and connections idle for more than
+        `health_check_interval` seconds are checked with a round trip before being handed out
+        :param host: beanstalkd host
+        :type host: str
+        :param port: beanstalkd port
+        :type port: int
+        :param min_size: connections opened at creation and never reaped
+        :type min_size: int
+        :param max_size: maximum number of open connections
+        :type max_size: int
+        :param idle_timeout: seconds an idle connection above `min_size` is kept open
+        :type idle_timeout: float
+        :param health_check_interval: seconds of idleness after which a connection is checked before checkout
+        :type health_check_interval: float
+        :param kwargs: passed to Connection
+        """
+        assert 0 <= min_size <= max_size, "min_size must be between 0 and max_size"
+        self.host = host
+        self.port = port
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self._kwargs = kwargs
+
+        self._condition = threading.Condition()
+        # (connection, last time it was returned), most recently used on the right
+        self._idle = deque()
+        # open connections plus the ones being opened
+        self._size = 0
+        self._closed = False
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.discarded = 0
+
+        for _ in range(min_size):
+            self._idle.append((self._create(), monotonic()))
+            self._size += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _create(self):
+        return Connection(self.host, self.port, **self._kwargs)
+
+    def _reap(self):
+        """
+        Remove idle connections above `min_size` that were not used for `idle_timeout` seconds. Call with the lock
+        held, the returned connections must be closed after releasing it
+        :rtype: list of Connection
+        """
+        reaped = []
+        now = monotonic()
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] >= self.idle_timeout:
+            reaped.append(self._idle.popleft()[0])
+            self._size -= 1
+        return reaped
+
+    @staticmethod
+    def _reset(connection):
+        """
+        Go back to using and watching only the "default" tube, pipelined
+        :type connection: Connection
+        """
+        pipeline = connection.pipeline()
+        if connection._using != "default":
+            pipeline.use("default")
+        if "default" not in connection._watching:
+            pipeline.watch("default")
+        for name in connection._watching:
+            if name != "default":
+                pipeline.ignore(name)
+        if len(pipeline):
+            pipeline.execute(raise_on_error=True)
+
+    def get(self, timeout=None):
+        """
+        Borrow a connection. It must be given back with `put`
+        :param timeout: seconds to wait for a connection when `max_size` connections are in use, None waits forever
+        :type timeout: float
+        :rtype: Connection
+        """
+        start = monotonic()
+        connection = None
+        with self._condition:
+            reaped = self._reap()
+        for old in reaped:
+            old.close()
+
+        with self._condition:
+            waited = False
+            while True:
+                if self._closed:
+                    raise BeanstalkdException("pool is closed")
+                if self._idle:
+                    # LIFO: hot connections are reused and the cold ones get reaped
+                    connection, last_used = self._idle.pop()
+                    self.hits += 1
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    self.misses += 1
+                    break
+                remaining = None if timeout is None else timeout - (monotonic() - start)
+                if remaining is not None and remaining <= 0:
+                    self.waits += 1
+                    self.wait_time += monotonic() - start
+                    raise PoolTimeout("no connection available after {} seconds".format(timeout))
+                waited = True
+                self._condition.wait(remaining)
+            if waited:
+                self.waits += 1
+                self.wait_time += monotonic() - start
+
+        if connection is not None:
+            try:
+                if monotonic() - last_used >= self.health_check_interval:
+                    connection.send_command("list-tube-used", ok_status=["USING"])
+                self._reset(connection)
+                return connection
+            except BeanstalkdException:
+                connection.close()
+                with self._condition:
+                    self.discarded += 1
+
+        # the slot is already counted in _size, give it back if the connection can't be opened
+        try:
+            return self._create()
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def put(self, connection, discard=False):
+        """
+        Give back a connection borrowed with `get`
+        :type connection: Connection
+        :param discard: close the connection instead of reusing it (i.e. after a SocketError)
+        :type discard: bool
+        """
+        with self._condition:
+            if discard or self._closed:
+                self._size -= 1
+                if discard:
+                    self.discarded += 1
+            else:
+                self._idle.append((connection, monotonic()))
+                connection = None
+            self._condition.notify()
+        if connection is not None:
+            connection.close()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Borrow a connection for a with statement. The connection is discarded if the block raises a SocketError
+        or an exception that is not from beanstalkd, since the connection may be in the middle of a command
+        :param timeout: seconds to wait for a connection, None waits forever
+        :type timeout: float
+        """
+        connection = self.get(timeout)
+        try:
+            yield connection
+        except SocketError:
+            self.put(connection, discard=True)
+            raise
+        except BeanstalkdException:
+            self.put(connection)
+            raise
+        except BaseException:
+            self.put(connection, discard=True)
+            raise
+        else:
+            self.put(connection)
+
+    def close(self):
+        """Close idle connections. Borrowed connections are closed when given back"""
+        with self._condition:
+            self._closed = True
+            idle = [connection for connection, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            connection.close()
+
+    def stats(self):
+        """
+        Return a dict of pool statistics: open connections (`size`, `idle`, `in-use`), checkouts served by an idle
+        connection (`hits`) or by a new one (`misses`), checkouts that had to wait (`waits`) and the total time
+        they waited (`wait-time`, seconds) and connections closed because they were broken (`discarded`)
+        :rtype: dict
+        """
+        with self._condition:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in-use": self._size - len(self._idle),
+                "hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "wait-time": self.wait_time,
+                "discarded": self.discarded,
+            }
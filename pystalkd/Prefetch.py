@@ -0,0 +1,264 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import threading
+from collections import deque
+from math import ceil
+from time import monotonic
+
+from .Beanstalkd import BeanstalkdException, Connection, DeadlineSoon
+from .Job import Job
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+# weight of the newest sample in the moving averages of handler time and reserve round trip
+SMOOTHING = 0.2
+
+
+class PrefetchConsumer(object):
+    def __init__(self, connections, min_depth=1, max_depth=64, touch_after=0.5, poll_interval=0.05, raw=False,
+                 metadata=False):
+        """
+        Reserve jobs ahead of the consumers so a job is ready as soon as the previous one is done.
+        A thread per connection keeps up to `depth` jobs reserved in a local queue, reserving them with pipelined
+        reserve-with-timeout 0 commands. `get` hands them out. The depth adapts between `min_depth` and `max_depth`:
+        enough jobs to cover a reserve round trip at the measured handler time, so fast handlers never wait and slow
+        ones don't sit on jobs other workers could take.
+        Jobs waiting in the queue for more than `touch_after` seconds are touched so their TTR doesn't expire, and
+        `close` releases the ones never handed out.
+        Connections are only polled (never blocked in a reserve), so acks from the consumers through the same
+        connection are sent right away; when the tubes are empty new jobs are noticed within `poll_interval` seconds
+        :param connections: connections watching the tubes to consume, already set up with watch/ignore
+        :type connections: Connection | list of Connection
+        :param min_depth: minimum number of jobs reserved ahead
+        :type min_depth: int
+        :param max_depth: maximum number of jobs reserved ahead
+        :type max_depth: int
+        :param touch_after: seconds a job waits in the queue before being touched
+        :type touch_after: float
+        :param poll_interval: longest wait between two reserves when the tubes are empty, in seconds
+        :type poll_interval: float
+        :param raw: If True then job bodies are bytes and not str
+        :type raw: bool
+        :param metadata: fill the metadata cache of the jobs (see Job.metadata) with a pipelined stats-job batch
+        after each batch of reserves, before they are handed out
+        :type metadata: bool
+        """
+        assert 1 <= min_depth <= max_depth, "min_depth must be between 1 and max_depth"
+        if isinstance(connections, Connection):
+            connections = [connections]
+        self.connections = list(connections)
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.touch_after = touch_after
+        self.poll_interval = poll_interval
+        self.raw = raw
+        self.metadata = metadata
+
+        self.depth = min_depth
+        self.fetched = 0
+        self.touched = 0
+        self.released = 0
+        self.errors = []
+        # (job, time it was reserved or last touched)
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._handler_time = None
+        self._round_trip = None
+        self._last_get = None
+
+        self._threads = [threading.Thread(target=self._fetch, args=(connection,), daemon=True,
+                                          name="pystalkd-prefetch-{}".format(i))
+                         for i, connection in enumerate(self.connections)]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            job = self.get()
+            if job is None:
+                return
+            yield job
+
+    def __len__(self):
+        with self._condition:
+            return len(self._queue)
+
+    def _adapt(self):
+        """
+        Choose the depth from the moving averages. Call with the lock held
+        """
+        if self._handler_time is None or self._round_trip is None:
+            return
+        # jobs consumed during one refill, per connection, plus one being refilled
+        needed = ceil(self._round_trip / max(self._handler_time, 1e-6)) + 1
+        self.depth = max(self.min_depth, min(self.max_depth, needed))
+
+    def get(self, timeout=None):
+        """
+        Return the next prefetched job, waiting for one if the queue is empty
+        :param timeout: seconds to wait, None waits until a job arrives or the consumer is closed
+        :type timeout: float
+        :return: a reserved job or None on timeout or after close
+        :rtype: Job | None
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._condition:
+            now = monotonic()
+            if self._last_get is not None:
+                # time between two gets approximates the handler time of one consumer
+                elapsed = now - self._last_get
+                if self._handler_time is None:
+                    self._handler_time = elapsed
+                else:
+                    self._handler_time += SMOOTHING * (elapsed - self._handler_time)
+                self._adapt()
+            while not self._queue:
+                if self._closed:
+                    return None
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            job, _ = self._queue.popleft()
+            self._last_get = monotonic()
+            # room in the queue, wake the fetchers
+            self._condition.notify_all()
+            return job
+
+    def _stale(self, connection):
+        """
+        Jobs of `connection` that waited too long in the queue, their wait restarts. Call with the lock held
+        :rtype: list of Job
+        """
+        limit = monotonic() - self.touch_after
+        stale = []
+        for i, (job, since) in enumerate(self._queue):
+            if job.connection is connection and since <= limit:
+                stale.append(job)
+                self._queue[i] = (job, monotonic())
+        return stale
+
+    def _fetch(self, connection):
+        backoff = 0.001
+        while True:
+            with self._condition:
+                stale = self._stale(connection)
+                while not self._closed and not stale and len(self._queue) >= self.depth:
+                    self._condition.wait(self.touch_after)
+                    stale = self._stale(connection)
+                if self._closed:
+                    return
+                wanted = max(self.depth - len(self._queue), 0)
+
+            try:
+                if stale:
+                    results = connection.touch_many(stale)
+                    self._forget_lost(stale, results)
+                if not wanted:
+                    continue
+                start = monotonic()
+                pipeline = connection.pipeline()
+                for _ in range(wanted):
+                    pipeline.reserve(0, self.raw)
+                results = pipeline.execute()
+                round_trip = monotonic() - start
+                if self.metadata:
+                    connection.load_metadata([result for result in results if isinstance(result, Job)])
+            except BeanstalkdException as err:
+                with self._condition:
+                    self.errors.append(err)
+                    self._condition.notify_all()
+                return
+
+            jobs = [result for result in results if isinstance(result, Job)]
+            failures = [result for result in results
+                        if isinstance(result, BeanstalkdException) and not isinstance(result, DeadlineSoon)]
+            now = monotonic()
+            with self._condition:
+                self.errors.extend(failures)
+                if self._round_trip is None:
+                    self._round_trip = round_trip
+                else:
+                    self._round_trip += SMOOTHING * (round_trip - self._round_trip)
+                self._adapt()
+                self.fetched += len(jobs)
+                self._queue.extend((job, now) for job in jobs)
+                if jobs:
+                    self._condition.notify_all()
+                    backoff = 0.001
+                    continue
+                # nothing ready: poll again later, unless closing
+                self._condition.wait(backoff)
+                backoff = min(backoff * 2, self.poll_interval)
+
+    def _forget_lost(self, jobs, results):
+        """
+        Drop from the queue jobs whose touch failed: the reservation is gone
+        """
+        lost = {id(job) for job, result in zip(jobs, results) if isinstance(result, BeanstalkdException)}
+        if not lost:
+            with self._condition:
+                self.touched += len(jobs)
+            return
+        with self._condition:
+            self.touched += len(jobs) - len(lost)
+            self._queue = deque(entry for entry in self._queue if id(entry[0]) not in lost)
+
+    def close(self):
+        """
+        Stop prefetching and release the jobs that were not handed out, keeping their priority
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        with self._condition:
+            waiting, self._queue = list(self._queue), deque()
+        for connection in self.connections:
+            jobs = [job for job, _ in waiting if job.connection is connection]
+            if not jobs:
+                continue
+            try:
+                results = connection.release_many(jobs)
+            except BeanstalkdException as err:
+                self.errors.append(err)
+                continue
+            for result in results:
+                if isinstance(result, BeanstalkdException):
+                    self.errors.append(result)
+                else:
+                    self.released += 1
@@ -0,0 +1,464 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import os
+import threading
+import time
+from datetime import timedelta
+from time import monotonic
+from urllib.parse import quote
+
+from .Beanstalkd import DEFAULT_PRIORITY, DEFAULT_TTR, BeanstalkdException, CommandFailed, total_seconds
+from .Migrate import (_load_checkpoint, _remove_checkpoint, _save_checkpoint, pack_record, read_header, read_records,
+                      write_header)
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+OVERFLOW_POLICIES = ("block", "drop", "spill")
+# put failures telling the server can't take more jobs for now
+PRESSURE_STATUS = ("OUT_OF_MEMORY", "DRAINING")
+
+
+class Backpressure(BeanstalkdException):
+    """A put wasn't admitted within the timeout of a blocking AdaptiveProducer"""
+    pass
+
+
+class TubeLimits(object):
+    def __init__(self, max_ready=10000, target_ready=None, rate=100.0, min_rate=1.0, max_rate=10000.0,
+                 increase=None, decrease=0.5, max_batch=100):
+        """
+        Limits and controller settings of a tube for AdaptiveProducer.
+        The put rate follows AIMD: at each sample of the tube it grows by `increase` jobs/s while the ready jobs are
+        at most `target_ready` (twice as fast when workers are waiting for jobs), and is multiplied by `decrease`
+        when they're more, or when the server answers OUT_OF_MEMORY or DRAINING. No job is put while `max_ready`
+        jobs are ready
+        :param max_ready: ready jobs above which puts stop
+        :type max_ready: int
+        :param target_ready: ready jobs the controller aims to stay under, max_ready / 2 if None
+        :type target_ready: int
+        :param rate: initial put rate, jobs/s
+        :type rate: float
+        :type min_rate: float
+        :type max_rate: float
+        :param increase: jobs/s added at each sample, a tenth of `rate` if None
+        :type increase: float
+        :type decrease: float
+        :param max_batch: most jobs put with one pipeline, also the burst of the token bucket
+        :type max_batch: int
+        """
+        assert 0 < decrease < 1, "decrease must be between 0 and 1"
+        assert 0 < min_rate <= rate <= max_rate, "rate must be between min_rate and max_rate"
+        self.max_ready = max_ready
+        self.target_ready = max_ready // 2 if target_ready is None else target_ready
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = rate / 10 if increase is None else increase
+        self.decrease = decrease
+        self.max_batch = max_batch
+
+
+class _Tube(object):
+    __slots__ = ("name", "limits", "rate", "tokens", "refilled", "sampled", "ready", "reserved", "waiting", "put",
+                 "dropped", "spilled", "replayed", "spill_path", "replaying")
+
+    def __init__(self, name, limits, spill_path):
+        self.name = name
+        self.limits = limits
+        self.rate = limits.rate
+        # token bucket, full at start
+        self.tokens = float(limits.max_batch)
+        self.refilled = monotonic()
+        self.sampled = None
+        # last sample of stats-tube, `ready` also counts the jobs put since
+        self.ready = 0
+        self.reserved = 0
+        self.waiting = 0
+        self.put = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.spill_path = spill_path
+        # a thread is putting the spilled jobs, the others leave it alone
+        self.replaying = False
+
+    def slow_down(self):
+        self.rate = max(self.rate * self.limits.decrease, self.limits.min_rate)
+
+    def adjust(self):
+        limits = self.limits
+        if self.ready > limits.target_ready:
+            self.slow_down()
+        else:
+            increase = limits.increase * 2 if self.waiting else limits.increase
+            self.rate = min(self.rate + increase, limits.max_rate)
+
+    def refill(self, now):
+        self.tokens = min(self.tokens + (now - self.refilled) * self.rate, self.limits.max_batch)
+        self.refilled = now
+
+    def admit(self, wanted):
+        """jobs that can be put right now, out of `wanted`"""
+        admitted = min(wanted, int(self.tokens), self.limits.max_ready - self.ready)
+        if admitted <= 0:
+            return 0
+        self.tokens -= admitted
+        self.ready += admitted
+        return admitted
+
+    def wait_time(self, sample_interval):
+        """seconds before `admit` may give something"""
+        if self.ready >= self.limits.max_ready:
+            return max(self.sampled + sample_interval - monotonic(), 0)
+        return max((1 - self.tokens) / self.rate, 0)
+
+
+def _pack(records):
+    """(priority, delay, ttr, body, key) records in the dump format"""
+    return b"".join(pack_record(*record) for record in records)
+
+
+def _write_records(path, tube, records):
+    """replace the file `path` with a dump of `records`"""
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as output:
+        write_header(output, tube)
+        output.write(_pack(records))
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(temporary, path)
+
+
+class AdaptiveProducer(object):
+    def __init__(self, connection, limits=None, default=None, sample_interval=1.0, overflow="block", timeout=None,
+                 spill_directory=None, raw=False):
+        """
+        Put jobs at the pace the consumers keep up with.
+        The stats-tube of each tube is sampled at most every `sample_interval` seconds (current-jobs-ready,
+        current-jobs-reserved and current-waiting), and the put rate is shaped by a token bucket whose rate follows
+        an AIMD controller (see TubeLimits). Jobs are put in pipelined batches of what the bucket allows.
+        A job that isn't admitted is handled by `overflow`: "block" waits for room (Backpressure is raised after
+        `timeout` seconds), "drop" discards it and "spill" appends it to a file in `spill_directory`, replayed when
+        the tube has room again: before later puts to the tube, with `flush`, or by a producer started later on the
+        same directory. Spilled jobs are synced to disk and replayed in order, later puts wait behind them
+        :param connection: connection used for the puts and the samples
+        :type connection: pystalkd.Beanstalkd.Connection
+        :param limits: TubeLimits by tube name
+        :type limits: dict
+        :param default: TubeLimits of the other tubes, the defaults of TubeLimits if None
+        :type default: TubeLimits
+        :type sample_interval: float
+        :param overflow: one of OVERFLOW_POLICIES
+        :type overflow: str
+        :param timeout: seconds a blocked put waits, None waits forever
+        :type timeout: float
+        :type spill_directory: str
+        :param raw: bodies are bytes, not str
+        :type raw: bool
+        """
+        assert overflow in OVERFLOW_POLICIES, "overflow must be one of " + ", ".join(OVERFLOW_POLICIES)
+        assert overflow != "spill" or spill_directory is not None, "spilling needs a spill_directory"
+        self.connection = connection
+        self.limits = dict(limits or {})
+        self.default = default or TubeLimits()
+        self.sample_interval = sample_interval
+        self.overflow = overflow
+        self.timeout = timeout
+        self.spill_directory = spill_directory
+        self.raw = raw
+        self._tubes = {}
+        self._lock = threading.RLock()
+
+    def _tube(self, name):
+        tube = self._tubes.get(name)
+        if tube is None:
+            spill_path = None
+            if self.spill_directory is not None:
+                # tube names may contain "/"
+                spill_path = os.path.join(self.spill_directory, quote(name, safe="") + ".spill")
+            tube = self._tubes[name] = _Tube(name, self.limits.get(name, self.default), spill_path)
+        return tube
+
+    def _sample(self, tube):
+        now = monotonic()
+        if tube.sampled is not None and now - tube.sampled < self.sample_interval:
+            return
+        try:
+            stats = self.connection.stats_tube(tube.name)
+        except CommandFailed:
+            # the tube doesn't exist until the first job is put or someone watches it
+            stats = {}
+        tube.sampled = now
+        tube.ready = stats.get("current-jobs-ready", 0)
+        tube.reserved = stats.get("current-jobs-reserved", 0)
+        tube.waiting = stats.get("current-waiting", 0)
+        tube.adjust()
+
+    def _admit(self, tube, wanted):
+        self._sample(tube)
+        tube.refill(monotonic())
+        return tube.admit(wanted)
+
+    def _admit_blocking(self, tube, wanted, deadline):
+        while True:
+            with self._lock:
+                admitted = self._admit(tube, wanted)
+                if admitted:
+                    return admitted
+                wait = tube.wait_time(self.sample_interval)
+            if deadline is not None:
+                if monotonic() >= deadline:
+                    raise Backpressure("{} not admitted within {} seconds".format(tube.name, self.timeout))
+                wait = min(wait, max(deadline - monotonic(), 0))
+            time.sleep(max(wait, 0.001))
+
+    def _send(self, tube, jobs):
+        """
+        Put `jobs`, (body, priority, delay, ttr) tuples, with one pipeline. The tube used by the connection is
+        restored afterwards
+        :return: job id or exception of each job
+        :rtype: list of (int | BeanstalkdException)
+        """
+        conn = self.connection
+        with conn._lock:
+            previous = conn.using()
+            conn.use(tube.name)
+            try:
+                results = conn.put_many([{"body": body, "priority": priority, "delay": delay, "ttr": ttr}
+                                         for body, priority, delay, ttr in jobs], raw=self.raw)
+            finally:
+                conn.use(previous)
+        inserted = sum(not isinstance(result, BeanstalkdException) for result in results)
+        with self._lock:
+            tube.put += inserted
+            if any(isinstance(result, BeanstalkdException) and result.args[0] in PRESSURE_STATUS
+                   for result in results):
+                tube.slow_down()
+                # closed until the next sample
+                tube.ready = max(tube.ready, tube.limits.max_ready)
+        return results
+
+    def put(self, tube, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR):
+        """
+        Put a job into `tube` when the tube has room
+        :type tube: str
+        :type body: str | bytes
+        :type priority: int
+        :type delay: int | timedelta
+        :type ttr: int | timedelta
+        :return: job id, None if the job was dropped or spilled
+        :rtype: int | None
+        """
+        result = self.put_many(tube, [body], priority, delay, ttr)[0]
+        if isinstance(result, BeanstalkdException):
+            raise result
+        return result
+
+    def put_many(self, tube, bodies, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR):
+        """
+        Put jobs into `tube` in pipelined batches, as fast as the tube allows. Items of `bodies` are bodies or dicts
+        with a "body" key and any of "priority", "delay" and "ttr", as for Connection.put_many
+        :return: job id, None (dropped or spilled) or exception (i.e. CommandFailed('JOB_TOO_BIG')) of each job
+        :rtype: list of (int | None | BeanstalkdException)
+        """
+        if isinstance(ttr, timedelta):
+            ttr = total_seconds(ttr)
+        if isinstance(delay, timedelta):
+            delay = total_seconds(delay)
+        jobs = []
+        for item in bodies:
+            if isinstance(item, dict):
+                jobs.append((item["body"], item.get("priority", priority), item.get("delay", delay),
+                             item.get("ttr", ttr)))
+            else:
+                jobs.append((item, priority, delay, ttr))
+        state = self._tube(tube)
+        results = [None] * len(jobs)
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        # indexes of the jobs still to be put
+        pending = list(range(len(jobs)))
+        while pending:
+            if self.overflow == "spill" and self._spilled(state) and not self._replay(state):
+                # the spilled jobs go first
+                self._spill(state, [jobs[index] for index in pending])
+                break
+            if self.overflow == "block":
+                admitted = self._admit_blocking(state, min(len(pending), state.limits.max_batch), deadline)
+            else:
+                with self._lock:
+                    admitted = self._admit(state, min(len(pending), state.limits.max_batch))
+            if not admitted:
+                if self.overflow == "drop":
+                    with self._lock:
+                        state.dropped += len(pending)
+                else:
+                    self._spill(state, [jobs[index] for index in pending])
+                break
+            batch, pending = pending[:admitted], pending[admitted:]
+            retry = []
+            for index, result in zip(batch, self._send(state, [jobs[index] for index in batch])):
+                if isinstance(result, BeanstalkdException) and result.args[0] in PRESSURE_STATUS:
+                    retry.append(index)
+                else:
+                    results[index] = result
+            # refused by the server: tried again when admitted (block) or sent to overflow with the rest
+            pending = retry + pending
+        return results
+
+    def _spilled(self, tube):
+        return tube.spill_path is not None and os.path.exists(tube.spill_path)
+
+    def _spill(self, tube, jobs):
+        with self._lock:
+            new = not os.path.exists(tube.spill_path)
+            with open(tube.spill_path, "ab") as spill:
+                if new:
+                    write_header(spill, tube.name)
+                records = []
+                for body, priority, delay, ttr in jobs:
+                    if not isinstance(body, (bytes, bytearray, memoryview)):
+                        body = body.encode("utf8")
+                    records.append((priority, delay, ttr, bytes(body), None))
+                spill.write(_pack(records))
+                spill.flush()
+                os.fsync(spill.fileno())
+            tube.spilled += len(jobs)
+
+    def _replay(self, tube):
+        """
+        Put the spilled jobs of `tube` while it has room.
+        The spill file is only appended to: the offset replayed so far is saved in the checkpoint
+        `spill_path`.checkpoint, and the file is removed once replayed to the end. The jobs of a window that weren't
+        put are moved to the small `spill_path`.held file, replayed before the rest. After a crash a job may be put
+        twice
+        :return: True if none are left
+        :rtype: bool
+        """
+        with self._lock:
+            if tube.replaying:
+                # the jobs of the caller go after the ones being replayed
+                return False
+            if not self._spilled(tube):
+                return True
+            tube.replaying = True
+        try:
+            return self._replay_held(tube) and self._replay_spill(tube)
+        finally:
+            with self._lock:
+                tube.replaying = False
+
+    def _replay_held(self, tube):
+        held_path = tube.spill_path + ".held"
+        if not os.path.exists(held_path):
+            return True
+        with open(held_path, "rb") as held:
+            read_header(held)
+            records = [record for window, _ in read_records(held) for record in window]
+        kept = self._put_records(tube, records)
+        if kept:
+            _write_records(held_path, tube.name, kept)
+            return False
+        os.remove(held_path)
+        return True
+
+    def _replay_spill(self, tube):
+        checkpoint_path = tube.spill_path + ".checkpoint"
+        checkpoint = _load_checkpoint(checkpoint_path)
+        with open(tube.spill_path, "rb") as spill:
+            read_header(spill)
+            if checkpoint is not None:
+                spill.seek(checkpoint["offset"])
+            windows = read_records(spill, tube.limits.max_batch)
+            while True:
+                with self._lock:
+                    # _spill appends under the lock, a window is never read half written
+                    window = next(windows, None)
+                    if window is None:
+                        os.remove(tube.spill_path)
+                        _remove_checkpoint(checkpoint_path)
+                        return True
+                records, end = window
+                kept = self._put_records(tube, records)
+                if kept:
+                    _write_records(tube.spill_path + ".held", tube.name, kept)
+                _save_checkpoint(checkpoint_path, {"offset": end})
+                if kept:
+                    return False
+
+    def _put_records(self, tube, records):
+        """
+        Put spilled `records` as far as the tube has room, the connection is used without holding the lock
+        :return: the records that weren't put, in order
+        :rtype: list
+        """
+        with self._lock:
+            admitted = self._admit(tube, len(records))
+        sent, kept = records[:admitted], records[admitted:]
+        if sent:
+            results = self._send(tube, [(body if self.raw else str(body, "utf8"), priority, delay, ttr)
+                                        for priority, delay, ttr, body, _ in sent])
+            # jobs refused because the server is full are kept, the others of the pipeline were inserted
+            refused = [record for record, result in zip(sent, results)
+                       if isinstance(result, BeanstalkdException) and result.args[0] in PRESSURE_STATUS]
+            with self._lock:
+                tube.replayed += len(sent) - len(refused)
+            kept = refused + kept
+        return kept
+
+    def flush(self, tube=None):
+        """
+        Replay spilled jobs as far as the tubes have room, without waiting
+        :param tube: tube to replay, all the tubes with a spill file in `spill_directory` if None
+        :type tube: str
+        :return: True if no spilled job is left
+        :rtype: bool
+        """
+        if self.spill_directory is None:
+            return True
+        if tube is not None:
+            return self._replay(self._tube(tube))
+        empty = True
+        for name in os.listdir(self.spill_directory):
+            if name.endswith(".spill"):
+                with open(os.path.join(self.spill_directory, name), "rb") as spill:
+                    tube_name = read_header(spill)
+                empty = self._replay(self._tube(tube_name)) and empty
+        return empty
+
+    def stats(self, tube):
+        """
+        State of the controller of `tube`: rate (jobs/s), tokens, the last sample (ready, reserved, waiting) and the
+        counts of jobs put, dropped, spilled and replayed from the spill file
+        :type tube: str
+        :rtype: dict
+        """
+        with self._lock:
+            state = self._tube(tube)
+            return {"rate": state.rate, "tokens": state.tokens, "ready": state.ready, "reserved": state.reserved,
+                    "waiting": state.waiting, "put": state.put, "dropped": state.dropped, "spilled": state.spilled,
+                    "replayed": state.replayed}
@@ -0,0 +1,321 @@
+# -*- coding: utf8 -*-
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+
+import re
+from collections import namedtuple
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+CRLF = b"\r\n"
+
+# replies that are followed by a data chunk, mapped to the position of the <bytes> argument
+BODY_STATUSES = {
+    "RESERVED": 1,
+    "FOUND": 1,
+    "OK": 0,
+}
+
+# beanstalkd lines are at most 224 bytes, anything bigger without a CRLF is garbage
+MAX_LINE_SIZE = 1024
+
+Response = namedtuple("Response", ["status", "args", "body"])
+Response.__doc__ = """
+A parsed beanstalkd reply
+:param status: first word of the reply i.e "RESERVED"
+:type status: str
+:param args: remaining words of the status line
+:type args: list of bytes
+:param body: data chunk of RESERVED, FOUND and OK replies, None otherwise
+:type body: bytes | memoryview | None
+"""
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class UnsupportedYaml(ProtocolError):
+    """A YAML document (or scalar) outside the subset understood by `parse_yaml`"""
+    pass
+
+
+# implicit types of plain YAML 1.1 scalars, as resolved by PyYAML
+_NULLS = {"", "~", "null", "Null", "NULL"}
+_BOOLS = {"yes": True, "Yes": True, "YES": True, "true": True, "True": True, "TRUE": True, "on": True, "On": True,
+          "ON": True, "no": False, "No": False, "NO": False, "false": False, "False": False, "FALSE": False,
+          "off": False, "Off": False, "OFF": False}
+_INT = re.compile(r"[-+]?(?:0|[1-9][0-9]*)\Z")
+_FLOAT = re.compile(r"(?:[-+]?[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][-+][0-9]+)?\Z")
+# other scalars YAML gives a type to (octal, hex and sexagesimal numbers, underscores, infinity, dates...) or that
+# need syntax not used by beanstalkd. They are left to PyYAML
+_EXOTIC = re.compile(r"[-+.]?[0-9]"
+                     r"|[-+]?\.(?:inf|Inf|INF|nan|NaN|NAN)\Z"
+                     r"|[-?:,\[\]{}#&*!|>'\"%@`=<]"
+                     r"|.*(?::\s|\s#|:\Z)")
+
+
+def _unquote(text):
+    if len(text) > 1 and text[0] == text[-1] == '"' and "\\" not in text:
+        return text[1:-1]
+    return text
+
+
+def _scalar(text, strict):
+    unquoted = _unquote(text)
+    if unquoted is not text:
+        return unquoted
+    if text in _NULLS:
+        return None
+    if text in _BOOLS:
+        return _BOOLS[text]
+    if _INT.match(text):
+        return int(text)
+    if _FLOAT.match(text):
+        return float(text)
+    if strict and _EXOTIC.match(text):
+        raise UnsupportedYaml("scalar {!r}".format(text))
+    return text
+
+
+def parse_yaml(data, strict=False, as_str=(), plain=False):
+    """
+    Parse the YAML documents sent by beanstalkd: a map of scalars (stats, stats-tube, stats-job) or a list of
+    scalars (list-tubes, list-tubes-watched). Ints, floats, booleans and nulls are typed as PyYAML does, so the
+    result is the same as yaml.load for every document beanstalkd sends, without the cost of a generic YAML parser.
+    Scalars YAML would give an unusual type (i.e. a tube named "0x1f" or "2020-01-01") are kept as str, or raise
+    UnsupportedYaml if `strict` is True
+    :param data: data chunk of an OK reply
+    :type data: bytes | str
+    :type strict: bool
+    :param as_str: keys of a map whose values are always str, even when they look like numbers (i.e. "tube")
+    :type as_str: collections.Container[str]
+    :param plain: keep every item of a list as str (i.e. tube names)
+    :type plain: bool
+    :rtype: dict | list
+    """
+    if not isinstance(data, str):
+        data = str(data, "utf8")
+    lines = data.splitlines()
+    if lines and lines[0].rstrip() == "---":
+        lines = lines[1:]
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return None
+
+    if lines[0].startswith("- ") or lines[0] == "-":
+        items = []
+        for line in lines:
+            if not (line.startswith("- ") or line == "-"):
+                raise UnsupportedYaml("list item {!r}".format(line))
+            item = line[2:].strip()
+            if plain:
+                items.append(_unquote(item))
+            else:
+                items.append(_scalar(item, strict))
+        return items
+
+    mapping = {}
+    for line in lines:
+        key, separator, value = line.partition(":")
+        if not separator or line[0].isspace() or (value and not value[0].isspace()):
+            raise UnsupportedYaml("map entry {!r}".format(line))
+        key = key.strip()
+        value = value.strip()
+        if key in as_str:
+            mapping[key] = _unquote(value)
+        else:
+            mapping[_scalar(key, strict)] = _scalar(value, strict)
+    return mapping
+
+
+def parse_stats(data, fields=None, as_str=()):
+    """
+    Fast path of `parse_yaml` for the flat maps of stats, stats-tube and stats-job when the values needed are ints:
+    only `fields` are kept (every key if None), as ints except the keys in `as_str`, kept as unquoted str.
+    Meant for the commands pipelined by the thousand (i.e. a stats-job per job id), where typing every scalar
+    would cost more than the round trip
+    :param data: data chunk of an OK reply
+    :type data: bytes | str
+    :type fields: collections.Container[str] | None
+    :param as_str: keys whose values aren't ints (i.e. "tube")
+    :type as_str: collections.Container[str]
+    :rtype: dict
+    """
+    if not isinstance(data, str):
+        data = str(data, "utf8")
+    stats = {}
+    for line in data.split("\n"):
+        key, separator, value = line.partition(": ")
+        if not separator or (fields is not None and key not in fields):
+            continue
+        if key in as_str:
+            stats[key] = _unquote(value.strip())
+        else:
+            stats[key] = int(value)
+    return stats
+
+
+class ResponseParser(object):
+    def __init__(self, buffer_size=65536):
+        """
+        Incremental (sans-IO) parser for beanstalkd replies.
+        Bytes coming from the server are written directly into a persistent buffer (see `get_buffer` and
+        `buffer_updated`) or appended with `feed`. `next_response` returns complete replies, one at a time,
+        and keeps whatever is left for the next one, so pipelined replies are never lost.
+        :param buffer_size: initial size of the receive buffer
+        :type buffer_size: int
+        """
+        self._buffer = bytearray(buffer_size)
+        self._start = 0
+        self._end = 0
+        # offset from `_start` where the search for CRLF should resume
+        self._scanned = 0
+        # parsed status line waiting for its data chunk
+        self._pending = None
+
+    def __len__(self):
+        return self._end - self._start
+
+    def bytes_needed(self):
+        """
+        Minimum number of bytes still missing to complete the current reply. For replies with a data chunk this is
+        exact, for status lines it is a hint of 1 byte
+        :rtype: int
+        """
+        if self._pending is not None:
+            _, _, size = self._pending
+            return max(size + 2 - len(self), 1)
+        return 1
+
+    def get_buffer(self, size_hint=4096):
+        """
+        Return a writable memoryview over the free space of the receive buffer. After writing into it call
+        `buffer_updated` with the number of bytes written. Meant to be used with `socket.recv_into`
+        :param size_hint: minimum free space wanted
+        :type size_hint: int
+        :rtype: memoryview
+        """
+        size_hint = max(size_hint, self.bytes_needed())
+        if len(self._buffer) - self._end < size_hint:
+            remaining = len(self)
+            if len(self._buffer) - remaining < size_hint:
+                # a new buffer instead of extend(), views handed out earlier may still be alive
+                buffer = bytearray(max(remaining + size_hint, 2 * len(self._buffer)))
+                buffer[:remaining] = self._buffer[self._start:self._end]
+                self._buffer = buffer
+                self._start = 0
+                self._end = remaining
+            else:
+                self._compact()
+        return memoryview(self._buffer)[self._end:]
+
+    def buffer_updated(self, n_bytes):
+        """
+        Mark `n_bytes` of the view returned by `get_buffer` as filled
+        :type n_bytes: int
+        """
+        self._end += n_bytes
+
+    def feed(self, data):
+        """
+        Append `data` to the receive buffer
+        :type data: bytes | bytearray | memoryview
+        """
+        size = len(data)
+        self.get_buffer(size)[:size] = data
+        self.buffer_updated(size)
+
+    def _compact(self):
+        if self._start:
+            remaining = self._end - self._start
+            self._buffer[:remaining] = self._buffer[self._start:self._end]
+            self._start = 0
+            self._end = remaining
+
+    def _parse_line(self):
+        buffer = self._buffer
+        begin = self._start + self._scanned
+        line_end = buffer.find(CRLF, max(begin - 1, self._start), self._end)
+        if line_end < 0:
+            self._scanned = len(self)
+            if self._scanned > MAX_LINE_SIZE:
+                raise ProtocolError("status line too long")
+            return None
+        words = bytes(buffer[self._start:line_end]).split()
+        self._start = line_end + 2
+        self._scanned = 0
+        if not words:
+            raise ProtocolError("empty status line")
+        status = words[0].decode("ascii", "replace")
+        args = words[1:]
+        size = None
+        if status in BODY_STATUSES:
+            try:
+                size = int(args[BODY_STATUSES[status]])
+            except (IndexError, ValueError):
+                raise ProtocolError("malformed {} reply".format(status))
+        return status, args, size
+
+    def next_response(self, copy=True):
+        """
+        Parse the next complete reply from the buffer
+        :param copy: if False the data chunk is a memoryview over the receive buffer instead of a bytes copy. The
+        view is only valid until the buffer is written again (`get_buffer` or `feed`)
+        :type copy: bool
+        :return: the reply or None if more data is needed
+        :rtype: Response | None
+        """
+        if self._pending is None:
+            parsed = self._parse_line()
+            if parsed is None:
+                return None
+            status, args, size = parsed
+            if size is None:
+                self._reset_if_empty()
+                return Response(status, args, None)
+            self._pending = parsed
+
+        status, args, size = self._pending
+        if len(self) < size + 2:
+            return None
+
+        body_end = self._start + size
+        if self._buffer[body_end:body_end + 2] != CRLF:
+            raise ProtocolError("data chunk of {} reply is not terminated by CRLF".format(status))
+        if copy:
+            body = bytes(self._buffer[self._start:body_end])
+        else:
+            body = memoryview(self._buffer)[self._start:body_end]
+        self._start = body_end + 2
+        self._pending = None
+        self._reset_if_empty()
+        return Response(status, args, body)
+
+    def _reset_if_empty(self):
+        # cheap rewind so the common case (one reply per read) never needs to move memory
+        if self._start == self._end:
+            self._start = self._end = 0
@@ -0,0 +1,340 @@
+# -*- coding: utf8 -*-
+
+"""pystalkd - A beanstalkd Client Library for Python3 - Based on https://github.com/earl/beanstalkc"""
+import shutil
+import sys
+import time
+from collections import deque
+from time import monotonic
+
+from .Beanstalkd import DEFAULT_HOST, DEFAULT_PORT, BeanstalkdException, CommandFailed, Connection, Request
+from .Protocol import parse_stats
+
+__license__ = '''
+Copyright (C) 2008-2014 Andreas Bolka
+Copyright (c) 2019 Gabriel Menezes
+
+MIT License
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+__version__ = '1.3.0'
+
+# rate name -> counters of `stats` adding up to it
+SERVER_RATES = (("puts", ("cmd-put",)), ("reserves", ("cmd-reserve", "cmd-reserve-with-timeout")),
+                ("deletes", ("cmd-delete",)), ("timeouts", ("job-timeouts",)))
+# same for `stats-tube`, which has no reserve or timeout counters
+TUBE_RATES = (("puts", ("total-jobs",)), ("deletes", ("cmd-delete",)))
+SORT_KEYS = ("backlog", "age", "puts", "deletes", "name")
+# ANSI: cursor home and clear screen
+CLEAR = "\x1b[H\x1b[2J"
+
+
+# stats-tube fields kept by Monitor, all ints
+TUBE_FIELDS = frozenset(["current-jobs-urgent", "current-jobs-ready", "current-jobs-reserved", "current-jobs-delayed",
+                         "current-jobs-buried", "total-jobs", "current-using", "current-waiting", "current-watching",
+                         "pause", "cmd-delete", "cmd-pause-tube", "pause-time-left"])
+
+
+def _tube_stats(connection, response):
+    """stats-tube reduced to TUBE_FIELDS"""
+    return parse_stats(response.body, TUBE_FIELDS)
+
+
+def _head_id(connection, response):
+    if response.status == "NOT_FOUND":
+        return None
+    return int(response.args[0])
+
+
+class RateWindow(object):
+    __slots__ = ("_samples",)
+
+    def __init__(self, size):
+        """
+        Ring buffer of the last `size` (time, value) samples of a counter, the rate is taken over all of them
+        :type size: int
+        """
+        self._samples = deque(maxlen=size)
+
+    def add(self, when, value):
+        if self._samples and value < self._samples[-1][1]:
+            # the server restarted, the old samples would give a negative rate
+            self._samples.clear()
+        self._samples.append((when, value))
+
+    def rate(self):
+        """
+        Increase per second over the window, None until there are two samples
+        :rtype: float | None
+        """
+        if len(self._samples) < 2:
+            return None
+        (first_time, first), (last_time, last) = self._samples[0], self._samples[-1]
+        if last_time <= first_time:
+            return None
+        return (last - first) / (last_time - first_time)
+
+
+class TubeView(object):
+    __slots__ = ("name", "stats", "rates", "head_age")
+
+    def __init__(self, name, stats, rates, head_age):
+        """
+        One tube at the last refresh of a Monitor
+        :param stats: counters of stats-tube, see TUBE_FIELDS
+        :type stats: dict
+        :param rates: per second rate by name of TUBE_RATES, None when unknown
+        :type rates: dict
+        :param head_age: seconds since the job at the head of the ready queue was put, None without ready jobs
+        :type head_age: float | None
+        """
+        self.name = name
+        self.stats = stats
+        self.rates = rates
+        self.head_age = head_age
+
+    @property
+    def backlog(self):
+        return self.stats["current-jobs-ready"]
+
+    @property
+    def paused(self):
+        """seconds the tube stays paused, 0 if it isn't"""
+        return self.stats["pause-time-left"]
+
+
+class Monitor(object):
+    def __init__(self, connection, window=10, ages=True):
+        """
+        Periodic view of a server and of all its tubes, for dashboards like `python3 -m pystalkd top`.
+        Each `refresh` sends stats, list-tubes and a stats-tube for every tube known from the previous refresh in a
+        single pipeline, so it costs one round trip whatever the number of tubes (tubes created since are seen by
+        the next refresh). Rates are computed from the counter deltas over the last `window` refreshes.
+        With `ages` the age of the job at the head of each non-empty ready queue (the next one reserved, i.e. the
+        most urgent, not always the oldest) costs a second pipeline of use + peek-ready, and a third of stats-job
+        only for heads that changed since the previous refresh. The used tube of `connection` is restored after, but
+        the connection shouldn't be shared with producers while the monitor runs
+        :param connection: connection with parse_yaml, for the server stats
+        :type connection: pystalkd.Beanstalkd.Connection
+        :param window: number of refreshes the rates are computed over
+        :type window: int
+        :param ages: also compute the head ages
+        :type ages: bool
+        """
+        self.connection = connection
+        self.window = window
+        self.ages = ages
+        # results of the last refresh
+        self.server = {}
+        self.rates = {}
+        self.tubes = []
+        self._known = None
+        # (tube, rate name) -> RateWindow, None as tube for the server counters
+        self._windows = {}
+        # tube -> (job id, age, monotonic time of the age)
+        self._heads = {}
+
+    def refresh(self):
+        """
+        Query the server and update `server`, `rates` and `tubes`
+        :return: the tubes
+        :rtype: list of TubeView
+        """
+        conn = self.connection
+        if self._known is None:
+            self._known = conn.tubes()
+        pipeline = conn.pipeline()
+        pipeline.stats().tubes()
+        for name in self._known:
+            pipeline._call(Request("stats-tube", name, ok_status=["OK"], error_status=["NOT_FOUND"],
+                                   handler=_tube_stats))
+        results = pipeline.execute()
+        now = monotonic()
+        for result in results:
+            # a tube can disappear between two refreshes, anything else is an error
+            if isinstance(result, BeanstalkdException) and not isinstance(result, CommandFailed):
+                raise result
+        self.server = results[0]
+        stats = {name: tube for name, tube in zip(self._known, results[2:]) if isinstance(tube, dict)}
+        self._known = results[1]
+
+        windows = {}
+        self.rates = self._update(windows, None, SERVER_RATES, self.server, now)
+        rates = {name: self._update(windows, name, TUBE_RATES, tube, now) for name, tube in stats.items()}
+        # tubes gone since the previous refresh are forgotten
+        self._windows = windows
+        ages = self._head_ages(stats, now) if self.ages else {}
+        self.tubes = [TubeView(name, tube, rates[name], ages.get(name)) for name, tube in stats.items()]
+        return self.tubes
+
+    def _update(self, windows, tube, counters, stats, now):
+        rates = {}
+        for rate, names in counters:
+            key = (tube, rate)
+            window = self._windows.get(key)
+            if window is None:
+                window = RateWindow(self.window)
+            window.add(now, sum(stats.get(name, 0) for name in names))
+            windows[key] = window
+            rates[rate] = window.rate()
+        return rates
+
+    def _head_ages(self, stats, now):
+        """
+        Age of the job at the head of the ready queue of every tube with ready jobs
+        :rtype: dict
+        """
+        names = [name for name, tube in stats.items() if tube["current-jobs-ready"]]
+        if not names:
+            self._heads = {}
+            return {}
+        conn = self.connection
+        pipeline = conn.pipeline()
+        for name in names:
+            # the job id is all that's needed, the body is skipped by the handler
+            pipeline.use(name)._call(Request("peek-ready", ok_status=["FOUND", "NOT_FOUND"], handler=_head_id))
+        pipeline.use(conn.using())
+        heads = pipeline.execute(raise_on_error=True)[1:-1:2]
+
+        ages = {}
+        unknown = []
+        for name, job_id in zip(names, heads):
+            previous = self._heads.get(name)
+            if job_id is None:
+                continue
+            if previous is not None and previous[0] == job_id:
+                ages[name] = previous[1] + now - previous[2]
+            else:
+                unknown.append((name, job_id))
+        if unknown:
+            pipeline = conn.pipeline()
+            for _, job_id in unknown:
+                pipeline._job_stats(job_id)
+            for (name, job_id), job_stats in zip(unknown, pipeline.execute()):
+                # deleted since the peek: the next refresh will see the new head
+                if isinstance(job_stats, dict):
+                    ages[name] = job_stats["age"]
+        self._heads = {name: (job_id, ages[name], now) for name, job_id in zip(names, heads) if name in ages}
+        return ages
+
+
+def _rate(value):
+    return "-" if value is None else "{:.1f}".format(value)
+
+
+def _duration(seconds):
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    if seconds < 60:
+        return "{}s".format(seconds)
+    if seconds < 3600:
+        return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+    if seconds < 86400:
+        return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    return "{}d{:02d}h".format(seconds // 86400, seconds % 86400 // 3600)
+
+
+def _sort_key(sort):
+    if sort == "name":
+        return lambda tube: tube.name
+    if sort == "age":
+        return lambda tube: -(tube.head_age or 0)
+    if sort in ("puts", "deletes"):
+        return lambda tube: -(tube.rates[sort] or 0)
+    return lambda tube: -tube.backlog
+
+
+def render(monitor, sort="backlog", limit=None):
+    """
+    Text of the last refresh of `monitor`: the server rates and a line per tube
+    :param sort: one of SORT_KEYS, the biggest first (alphabetical for name)
+    :type sort: str
+    :param limit: maximum number of tubes shown
+    :type limit: int
+    :rtype: str
+    """
+    server = monitor.server
+    rates = monitor.rates
+    lines = ["{} {}  up {}  tubes {}  connections {}  jobs ready {} reserved {} delayed {} buried {}".format(
+        server.get("hostname", "-"), server.get("version", "-"), _duration(server.get("uptime")), len(monitor.tubes),
+        *[server.get(name, "-") for name in ("current-connections", "current-jobs-ready", "current-jobs-reserved",
+                                             "current-jobs-delayed", "current-jobs-buried")]),
+        "per second: puts {}  reserves {}  deletes {}  timeouts {}".format(
+            *[_rate(rates.get(name)) for name, _ in SERVER_RATES]),
+        "",
+        "{:<32} {:>9} {:>9} {:>9} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            "TUBE", "READY", "RESERVED", "DELAYED", "BURIED", "WAITING", "PUT/S", "DELETE/S", "HEAD AGE", "PAUSED")]
+    tubes = sorted(monitor.tubes, key=_sort_key(sort))
+    shown = tubes if limit is None else tubes[:limit]
+    for tube in shown:
+        stats = tube.stats
+        lines.append("{:<32} {:>9} {:>9} {:>9} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            tube.name[:32], stats["current-jobs-ready"], stats["current-jobs-reserved"],
+            stats["current-jobs-delayed"], stats["current-jobs-buried"], stats["current-waiting"],
+            _rate(tube.rates["puts"]), _rate(tube.rates["deletes"]), _duration(tube.head_age),
+            _duration(tube.paused) if tube.paused else "").rstrip())
+    if len(shown) < len(tubes):
+        lines.append("... {} more".format(len(tubes) - len(shown)))
+    return "\n".join(lines)
+
+
+def add_arguments(parser):
+    """
+    Options of the top command, for the command line of python3 -m pystalkd
+    :type parser: argparse.ArgumentParser
+    """
+    parser.add_argument("server", nargs="?", default="{}:{}".format(DEFAULT_HOST, DEFAULT_PORT),
+                        help="host[:port] of the server (default %(default)s)")
+    parser.add_argument("-i", "--interval", type=float, default=1.0, help="seconds between refreshes")
+    parser.add_argument("-w", "--window", type=int, default=10, help="refreshes the rates are computed over")
+    parser.add_argument("-s", "--sort", choices=SORT_KEYS, default="backlog")
+    parser.add_argument("-n", "--limit", type=int, help="tubes shown (default: what fits in the terminal)")
+    parser.add_argument("--no-age", action="store_true", help="skip the head ages, saving up to two round trips")
+    parser.add_argument("--once", action="store_true", help="print a single refresh and exit")
+    parser.set_defaults(run=run)
+
+
+def run(args):
+    host, _, port = args.server.partition(":")
+    conn = Connection(host, int(port or DEFAULT_PORT))
+    monitor = Monitor(conn, window=args.window, ages=not args.no_age)
+    interactive = sys.stdout.isatty() and not args.once
+    try:
+        while True:
+            started = monotonic()
+            monitor.refresh()
+            limit = args.limit
+            if limit is None and interactive:
+                # header, footer and a spare line for the cursor
+                limit = max(shutil.get_terminal_size().lines - 6, 1)
+            text = render(monitor, args.sort, limit)
+            if interactive:
+                sys.stdout.write(CLEAR + text + "\n")
+                sys.stdout.flush()
+            else:
+                print(text, flush=True)
+            if args.once:
+                return 0
+            time.sleep(max(args.interval - (monotonic() - started), 0))
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        conn.close()
@@ -28,4 +28,6 @@ SOFTWARE.
 '''
 __version__ = '1.3.0'
 
+# the optional modules (AsyncBeanstalkd, Pool, Embedded, Dedup...) are imported explicitly where they're used, so
+# sync-only users don't pay for asyncio, sqlite3 and the rest at startup
 from . import Beanstalkd, Job
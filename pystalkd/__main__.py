@@ -0,0 +1,30 @@
+# -*- coding: utf8 -*-
+
+"""
+Command line tools:
+
+    python3 -m pystalkd top [host[:port]]                 live view of the tubes of a server
+    python3 -m pystalkd dump TUBE FILE [-s host:port]    move the jobs of a tube to a file
+    python3 -m pystalkd load FILE [-s host:port]         put the jobs of a dump file
+    python3 -m pystalkd migrate TUBE -f host -t host     move the jobs of a tube to another tube or server
+    python3 -m pystalkd buried [--kick | --delete]       list, kick or delete buried jobs matching filters
+"""
+import argparse
+import sys
+
+from . import Buried, Migrate, Top
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m pystalkd")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+    Top.add_arguments(commands.add_parser("top", help="live view of the tubes of a server"))
+    Migrate.add_arguments(commands)
+    Buried.add_arguments(commands.add_parser("buried", help="list, kick or delete buried jobs matching filters"))
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,31 @@
 from datetime import timedelta
 from pystalkd import Beanstalkd
+from pystalkd.AsyncBeanstalkd import AsyncConnection
+from pystalkd.Job import Job
+from pystalkd.Pool import ConnectionPool, PoolTimeout
+from pystalkd.Cluster import ClusterConnection, HashRing
+from pystalkd.Codec import Codec
+from pystalkd.Dedup import BloomIndex, MemoryIndex, SqliteIndex, UNKNOWN_ID
+from pystalkd.Embedded import Engine, EngineServer
+from pystalkd.Buried import BuriedScanner
+from pystalkd.ClaimCheck import MmapStore
+from pystalkd.Failover import FailoverConnection
+from pystalkd.Lease import LeaseKeeper
+from pystalkd.Metrics import Metrics
+from pystalkd.Migrate import dump, load, migrate
+from pystalkd.Prefetch import PrefetchConsumer
+from pystalkd.Producer import AdaptiveProducer, Backpressure, TubeLimits
+from pystalkd.Top import Monitor, render
+from pystalkd.Protocol import ResponseParser, ProtocolError, UnsupportedYaml, parse_stats, parse_yaml
 from os import urandom
+import asyncio
 import json
+import threading
+import os
 import random
 import string
+import tempfile
+import time
 import unittest
 
 __author__ = 'Gabriel'
@@ -239,6 +261,429 @@ class TestBeanstalkd(unittest.TestCase):
         job.delete()
         self.assertEqual(test_bytes, body)
 
+    def test_body_with_crlf(self):
+        # bodies are read by length, so the delimiter inside the data (even at the end) must be preserved
+        test_bytes = b"\r\n" * 5000 + urandom(4093) + b"\r\n"
+        self.conn.put_bytes(test_bytes)
+        job = self.conn.reserve_bytes(0)
+        body = job.body
+        job.delete()
+        self.assertEqual(test_bytes, body)
+
+    def test_pipeline(self):
+        with self.conn.pipeline() as pipeline:
+            pipeline.use(self.tube_name).put("one").put_bytes(b"two").delete(2 ** 31)
+        tube, first, second, deleted = pipeline.results
+        self.assertEqual(tube, self.tube_name)
+        self.assertIsInstance(first, int)
+        self.assertEqual(second, first + 1)
+        self.assertIsInstance(deleted, Beanstalkd.CommandFailed)
+
+        self.conn.watch(self.tube_name)
+        pipeline = self.conn.pipeline()
+        pipeline.reserve(0).reserve_bytes(0).reserve(0)
+        one, two, nothing = pipeline.execute()
+        self.assertEqual((one.body, two.body, nothing), ("one", b"two", None))
+        self.assertEqual(self.conn.pipeline().delete(one.job_id).delete(two.job_id).execute(), [None, None])
+        with self.assertRaises(Beanstalkd.CommandFailed):
+            self.conn.pipeline().delete(one.job_id).execute(raise_on_error=True)
+
+    def test_put_many(self):
+        self.conn.use(self.tube_name)
+        self.conn.watch(self.tube_name)
+        if self.conn.parse_yaml:
+            max_size = self.conn.stats()['max-job-size']
+        else:
+            max_size = 65535  # bytes
+
+        bodies = (b"job %d" % i if i != 3 else {"body": b"x" * (max_size + 1)} for i in range(2500))
+        ids = self.conn.put_bytes_many(bodies, window=100)
+        self.assertEqual(len(ids), 2500)
+        self.assertIsInstance(ids[3], Beanstalkd.CommandFailed)
+        self.assertEqual(str(ids[3]), "JOB_TOO_BIG")
+        self.assertEqual(ids[4], ids[2] + 1)
+
+        ids = self.conn.put_many(["low", {"body": "high", "priority": 0}])
+        job = self.conn.reserve(0)
+        self.assertEqual((job.job_id, job.body), (ids[1], "high"))
+        job.delete()
+
+    def test_zero_copy(self):
+        self.conn.use(self.tube_name)
+        self.conn.watch(self.tube_name)
+        body = bytearray(urandom(60000))
+        body[100:102] = b"\r\n"
+        job_id = self.conn.put_bytes(memoryview(body))
+        self.conn.put_bytes(bytearray(b"small"))
+        ids = self.conn.put_bytes_many([body, memoryview(body)[:10], body], window=2)
+        self.assertTrue(all(isinstance(i, int) for i in ids))
+
+        job = self.conn.reserve_view(0)
+        self.assertEqual(job.job_id, job_id)
+        self.assertIsInstance(job.body, memoryview)
+        self.assertEqual(job.body, body)
+        job.delete()
+        job = self.conn.reserve_view(0)
+        self.assertEqual(job.body, b"small")
+        job.delete()
+
+        pipeline = self.conn.pipeline()
+        for _ in ids:
+            pipeline.reserve_view(0)
+        jobs = pipeline.execute()
+        self.assertEqual([bytes(job.body) for job in jobs], [bytes(body), bytes(body[:10]), bytes(body)])
+        self.conn.delete_many(jobs)
+
+    def test_ack_many(self):
+        self.conn.use(self.tube_name)
+        self.conn.watch(self.tube_name)
+        self.conn.put_many(["job"] * 6)
+        jobs = [self.conn.reserve(0) for _ in range(6)]
+        self.assertEqual(self.conn.touch_many(jobs[:2]), [None, None])
+        self.assertEqual(self.conn.release_many([jobs[0], jobs[1].job_id], priority=5), [None, None])
+        self.assertFalse(jobs[0].reserved)
+        self.assertTrue(jobs[1].reserved)
+        self.assertEqual(self.conn.bury_many(jobs[2:3]), [None])
+        results = self.conn.delete_many(jobs[3:] + [2 ** 31])
+        self.assertEqual(results[:3], [None] * 3)
+        self.assertIsInstance(results[3], Beanstalkd.CommandFailed)
+        self.assertFalse(any(job.reserved for job in jobs[3:]))
+
+        with self.conn.deferred_acks(max_size=2) as acks:
+            jobs = [self.conn.reserve(0), self.conn.reserve(0)]
+            acks.delete(jobs[0])
+            self.assertEqual(len(acks), 1)
+            acks.delete(jobs[1])
+            self.assertEqual(len(acks), 0)
+            acks.delete(jobs[1])
+        self.assertEqual([job for job, _ in acks.failed], [jobs[1]])
+        self.assertIsNone(self.conn.reserve(0))
+
+        # no ack follows and max_delay isn't reached: the pending one goes out with the reserve, before it blocks
+        acks = self.conn.deferred_acks(max_delay=60)
+        self.conn.put("last")
+        job = self.conn.reserve(0)
+        acks.delete(job)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.conn.reserve(5)))
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual(len(acks), 0)
+        other = Beanstalkd.Connection(self.host, self.port)
+        self.assertRaises(Beanstalkd.CommandFailed, other.stats_job, job.job_id)
+        other.use(self.tube_name)
+        other.put("next")
+        thread.join(5)
+        self.assertEqual(result[0].body, "next")
+        result[0].delete()
+        other.close()
+
+    def test_job_metadata(self):
+        self.conn.use(self.tube_name)
+        self.conn.watch(self.tube_name)
+        self.conn.put_many([{"body": "a", "priority": 7, "ttr": 30}, "b", "c"])
+        job = self.conn.reserve(0, metadata=True)
+        self.assertEqual((job.priority, job.ttr, job.tube, job.reserves), (7, 30, self.tube_name, 1))
+        self.assertLessEqual(job.time_left, 30)
+        job.release()
+        self.assertIsNone(job._stats)
+
+        job = self.conn.reserve(0)
+        self.assertEqual(job.metadata()["pri"], 7)
+        self.assertEqual(job.reserves, 2)
+        job.delete()
+
+        jobs = [self.conn.reserve(0), self.conn.reserve(0)]
+        results = self.conn.load_metadata(jobs + [Job(self.conn, 2 ** 31, "", 0)])
+        self.assertEqual([stats["pri"] for stats in results[:2]], [Beanstalkd.DEFAULT_PRIORITY] * 2)
+        self.assertIsInstance(results[2], Beanstalkd.CommandFailed)
+        # priorities are cached: no stats-job before the pipelined release
+        self.assertEqual(self.conn.release_many(jobs), [None, None])
+        self.assertEqual(self.conn.delete_many(jobs), [None, None])
+
+    def test_lazy_body(self):
+        self.conn.use(self.tube_name)
+        self.conn.watch(self.tube_name)
+        self.conn.put("ação")
+        job = self.conn.reserve(0)
+        self.assertFalse(hasattr(job, "__dict__"))
+        self.assertEqual(job.raw_body, "ação".encode("utf8"))
+        self.assertIsNotNone(job._decoder)
+        self.assertEqual((job.text, job.body), ("ação", "ação"))
+        job.release()
+        job = self.conn.reserve_bytes(0)
+        self.assertEqual((job.body, job.text), ("ação".encode("utf8"), "ação"))
+        job.delete()
+
+    def test_send(self):
+        # send and send_command return what they always have: the reply without its status
+        self.conn.use(self.tube_name)
+        self.conn.watch(self.tube_name)
+        status, job_id = self.conn.send_command("put", 0, 0, 120, b"5\r\nhello", ok_status=["INSERTED"])
+        self.assertEqual(status, "INSERTED")
+        self.assertTrue(job_id.isdigit())
+        reply = self.conn.send_command("reserve-with-timeout", 0, ok_status=["RESERVED"])
+        self.assertEqual(reply, ("RESERVED", job_id + b" 5\r\nhello"))
+        job = self.conn.parse_job(reply[1])
+        self.assertEqual((job.job_id, job.body, job.size), (int(job_id), "hello", 5))
+        status, rest = self.conn.send("stats-job", job.job_id)
+        size, _, data = rest.partition(b"\r\n")
+        self.assertEqual(status, "OK")
+        self.assertTrue(data.startswith(b"---\nid: " + job_id + b"\n"))
+        # the trailing newline of the YAML is stripped with the CRLF
+        self.assertEqual(len(data), int(size) - 1)
+        self.assertEqual(self.conn.send("delete", job.job_id), ("DELETED", b"DELETED"))
+
+    def test_tube_cache(self):
+        conn = Beanstalkd.Connection(self.host, self.port)
+        calls = []
+        call = conn._call
+        conn._call = lambda request: calls.append(request.command) or call(request)
+
+        conn.use(self.tube_name)
+        conn.watch(self.tube_name)
+        self.assertEqual(calls, ["use", "watch"])
+        with conn.temporary_use(self.tube_name):
+            conn.watch(self.tube_name)
+            conn.ignore("other")
+            self.assertEqual(conn.using(), self.tube_name)
+            self.assertEqual(conn.watching(), ["default", self.tube_name])
+        self.assertEqual(calls, ["use", "watch"])
+
+        # the cache follows commands sent behind its back with send_command
+        self.assertEqual(conn.send_command("ignore", "default", ok_status=["WATCHING"]), ("WATCHING", b"1"))
+        self.assertEqual(conn.refresh_tubes(), (self.tube_name, [self.tube_name]))
+        data = "---\n- {}\n".format(self.tube_name).encode("utf8")
+        self.assertEqual(conn.send("list-tubes-watched"), ("OK", b"%d\r\n%s" % (len(data), data.rstrip())))
+        conn.reconnect()
+        self.assertEqual((conn.using(), conn.watching()), ("default", ["default"]))
+        self.assertEqual(conn.refresh_tubes(), ("default", ["default"]))
+        conn.close()
+
+    def test_codec(self):
+        self.conn.watch(self.tube_name)
+        self.conn.ignore("default")
+        self.conn.use(self.tube_name)
+        self.conn.put("plain")
+        producer = Beanstalkd.Connection(self.host, self.port, codec=Codec("text"))
+        producer.set_codec(Codec("json", "zlib", threshold=100), self.tube_name)
+        producer.use(self.tube_name)
+        document = {"items": list(range(1000))}
+        producer.put(document)
+        producer.put_bytes(b"raw")
+        with producer.pipeline() as pipeline:
+            pipeline.use("default").put("text").use(self.tube_name).put([1, 2])
+        producer.close()
+
+        self.conn.set_codec(Codec("json"))
+        job = self.conn.reserve(0)
+        self.assertEqual(job.body, "plain")
+        job.delete()
+        job = self.conn.reserve(0)
+        self.assertLess(job.size, len(json.dumps(document)) // 2)
+        self.assertIsNotNone(job._decoder)
+        self.assertEqual(job.body, document)
+        job.delete()
+        job = self.conn.reserve_bytes(0)
+        self.assertEqual(job.body, b"raw")
+        job.delete()
+        job = self.conn.reserve(0)
+        self.assertEqual(job.body, [1, 2])
+        job.delete()
+        self.conn.watch("default")
+        self.conn.ignore(self.tube_name)
+        job = self.conn.reserve(0)
+        self.assertEqual(job.body, "text")
+        job.delete()
+
+    def test_claim_check(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = MmapStore(directory)
+            producer = Beanstalkd.Connection(self.host, self.port, blob_store=store, blob_threshold=1024)
+            producer.use(self.tube_name)
+            big = urandom(100000)
+            producer.put_bytes(big)
+            producer.put("small")
+            producer.close()
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            consumer = Beanstalkd.Connection(self.host, self.port, blob_store=store)
+            consumer.watch(self.tube_name)
+            consumer.ignore("default")
+            job = consumer.reserve_bytes(0)
+            self.assertEqual(job.size, len(big))
+            self.assertEqual(bytes(job.body), big)
+            job.delete()
+            self.assertEqual(os.listdir(directory), [])
+            job = consumer.reserve(0)
+            self.assertEqual(job.body, "small")
+            job.delete()
+
+            # a missing blob or a bad key doesn't lose the reserved jobs, nor the rest of the pipeline
+            producer = Beanstalkd.Connection(self.host, self.port)
+            producer.use(self.tube_name)
+            for key in (b"missing", b"\xe9t\xe9", b"../key"):
+                producer.put_bytes(Beanstalkd.CLAIM_CHECK + key)
+            producer.put("after")
+            producer.close()
+            *jobs, after = consumer.pipeline().reserve_bytes(0).reserve(0).reserve_bytes(0).reserve(0).execute()
+            self.assertEqual(after.body, "after")
+            for job in jobs:
+                with self.assertRaises(Beanstalkd.BeanstalkdException) as raised:
+                    job.raw_body
+                self.assertIn("job {}".format(job.job_id), str(raised.exception))
+                job.delete()
+            after.delete()
+            consumer.close()
+
+    def test_metrics(self):
+        seen = []
+        metrics = Metrics(buckets=(0.001, 60), after=lambda command, status, elapsed: seen.append((command, status)))
+        conn = Beanstalkd.Connection(self.host, self.port, metrics=metrics)
+        conn.use(self.tube_name)
+        conn.watch(self.tube_name)
+        conn.ignore("default")
+        conn.put("measured")
+        job = conn.reserve(0)
+        job.delete()
+        self.assertRaises(Beanstalkd.CommandFailed, conn.delete, job.job_id)
+        conn.put_many(["a", "b"])
+        conn.delete_many(conn.reserve(0) for _ in range(2))
+        conn.close()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["put"]["calls"], 3)
+        self.assertEqual(snapshot["put"]["bytes_sent"], 3 * len("put 2147483648 0 120 1\r\n\r\n") + len("measuredab"))
+        self.assertEqual(snapshot["delete"]["calls"], 4)
+        self.assertEqual(snapshot["delete"]["errors"], {"NOT_FOUND": 1})
+        self.assertEqual(snapshot["reserve-with-timeout"]["latency"]["buckets"][float("inf")], 3)
+        self.assertEqual(len(seen), sum(stats["calls"] for stats in snapshot.values()))
+        self.assertIn(("delete", "NOT_FOUND"), seen)
+        text = metrics.prometheus()
+        self.assertIn('pystalkd_command_errors_total{command="delete",status="NOT_FOUND"} 1\n', text)
+        self.assertIn('pystalkd_command_duration_seconds_bucket{command="put",le="+Inf"} 3\n', text)
+
+    def test_async(self):
+        async def run():
+            async with AsyncConnection(self.host, self.port) as conn:
+                async with conn.temporary_use(self.tube_name):
+                    self.assertEqual(await conn.using(), self.tube_name)
+                    job_id = await conn.put("async")
+                self.assertEqual(await conn.using(), "default")
+                await conn.watch(self.tube_name)
+                await conn.ignore("default")
+
+                job = await conn.reserve(0)
+                self.assertEqual((job.job_id, job.body), (job_id, "async"))
+                await job.release()
+                job = await conn.reserve_bytes(0)
+                self.assertEqual(job.body, b"async")
+                await job.delete()
+                self.assertIsNone(await conn.reserve(0))
+                with self.assertRaises(Beanstalkd.CommandFailed):
+                    await job.delete()
+
+                # a cancelled reserve drops the connection, the next command restores the watch list
+                reserve = asyncio.ensure_future(conn.reserve())
+                await asyncio.sleep(0.1)
+                reserve.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await reserve
+                await conn.put("after cancel")
+                if conn.parse_yaml:
+                    self.assertEqual(await conn.watching(), [self.tube_name])
+                self.assertIsNone(await conn.reserve(0))
+
+        asyncio.run(run())
+
+    def test_pool(self):
+        with ConnectionPool(self.host, self.port, min_size=1, max_size=2, health_check_interval=0) as pool:
+            with pool.connection() as conn:
+                conn.use(self.tube_name)
+                conn.watch(self.tube_name)
+                conn.ignore("default")
+            with pool.connection() as same:
+                self.assertIs(same, conn)
+                self.assertEqual(same.send_command("list-tube-used", ok_status=["USING"]), ("USING", b"default"))
+                if same.parse_yaml:
+                    self.assertListEqual(same.watching(), ["default"])
+                other = pool.get()
+                self.assertIsNot(other, same)
+                with self.assertRaises(PoolTimeout):
+                    pool.get(timeout=0.1)
+                threading.Timer(0.1, pool.put, (other,)).start()
+                self.assertIs(pool.get(timeout=5), other)
+                pool.put(other)
+            stats = pool.stats()
+            self.assertEqual((stats["size"], stats["idle"], stats["in-use"]), (2, 2, 0))
+            self.assertEqual((stats["hits"], stats["misses"], stats["waits"]), (3, 1, 2))
+
+    def test_cluster(self):
+        cluster = ClusterConnection([(self.host, self.port)])
+        cluster.use(self.tube_name)
+        cluster.watch(self.tube_name)
+        cluster.put("one", key="a")
+        cluster.put("two")
+        if cluster.parse_yaml:
+            self.assertEqual(cluster.stats_tube(self.tube_name)["current-jobs-ready"], 2)
+        first, second = cluster.reserve(0), cluster.reserve(0)
+        self.assertEqual((first.body, second.body), ("one", "two"))
+        self.assertIs(first.connection, cluster.nodes[0])
+        cluster.release(first)
+        cluster.delete(second)
+        self.assertEqual(cluster.reserve(1).body, "one")
+        self.assertIsNone(cluster.reserve(0))
+        cluster.close()
+
+    def test_lease_keeper(self):
+        self.conn.use(self.tube_name)
+        self.conn.watch(self.tube_name)
+        # beanstalkd answers DEADLINE_SOON to a reserve when a reserved job has 1 second left, a 1 second ttr always does
+        self.conn.put_many(["short", "long"], ttr=2)
+        short, long = self.conn.reserve(0), self.conn.reserve(0)
+        with LeaseKeeper(self.conn) as keeper:
+            keeper.keep(short, ttr=2)
+            keeper.keep(long)
+            time.sleep(0.6)
+            short.delete()
+            time.sleep(2.0)
+            # without the keeper the job would be ready again and the reserve would get it
+            self.assertIsNone(self.conn.reserve(0))
+            self.assertEqual(len(keeper), 1)
+            self.assertGreaterEqual(keeper.touches, 2)
+        self.assertEqual(keeper.errors, [])
+        long.delete()
+
+        # a keeper whose connection fails stops touching, and says so
+        self.conn.put("lost")
+        job = self.conn.reserve(0)
+        with LeaseKeeper(self.conn) as keeper:
+            self.conn.close()
+            keeper.keep(job, ttr=0.1)
+            time.sleep(0.3)
+            self.assertEqual(len(keeper.errors), 1)
+            self.assertIsInstance(keeper.errors[0], Beanstalkd.SocketError)
+            self.assertRaises(Beanstalkd.SocketError, keeper.keep, job, 10)
+        self.conn.reconnect()
+
+    def test_prefetch(self):
+        self.conn.use(self.tube_name)
+        self.conn.put_many(["job {}".format(i) for i in range(20)])
+        self.conn.watch(self.tube_name)
+        self.conn.ignore("default")
+        with PrefetchConsumer(self.conn, min_depth=2, max_depth=8) as consumer:
+            bodies = []
+            for _ in range(15):
+                job = consumer.get(timeout=5)
+                bodies.append(job.body)
+                job.delete()
+            self.assertEqual(bodies, ["job {}".format(i) for i in range(15)])
+            self.assertGreaterEqual(consumer.depth, 2)
+        self.assertEqual(consumer.errors, [])
+        self.assertEqual(consumer.fetched, 15 + consumer.released)
+        remaining = [self.conn.reserve(0) for _ in range(5)]
+        self.assertNotIn(None, remaining)
+
     # http://stackoverflow.com/a/5387956/482238
 
     def steps(self):
@@ -259,6 +704,660 @@ class TestBeanstalkd(unittest.TestCase):
         self.conn.close()
 
 
+class TestResponseParser(unittest.TestCase):
+    def test_byte_by_byte(self):
+        parser = ResponseParser(16)
+        data = b"RESERVED 12 6\r\nab\r\ncd\r\n"
+        for i in range(len(data) - 1):
+            parser.feed(data[i:i + 1])
+            self.assertIsNone(parser.next_response())
+        parser.feed(data[-1:])
+        response = parser.next_response()
+        self.assertEqual(response.status, "RESERVED")
+        self.assertEqual(response.args, [b"12", b"6"])
+        self.assertEqual(response.body, b"ab\r\ncd")
+        self.assertEqual(len(parser), 0)
+
+    def test_leftover_is_kept(self):
+        parser = ResponseParser()
+        parser.feed(b"INSERTED 1\r\nOK 4\r\n- a\n\r\nDELE")
+        self.assertEqual(parser.next_response(), ("INSERTED", [b"1"], None))
+        self.assertEqual(parser.next_response(), ("OK", [b"4"], b"- a\n"))
+        self.assertIsNone(parser.next_response())
+        parser.feed(b"TED\r\n")
+        self.assertEqual(parser.next_response(), ("DELETED", [], None))
+
+    def test_recv_into(self):
+        parser = ResponseParser(8)
+        body = urandom(100000)
+        data = b"FOUND 3 100000\r\n" + body + b"\r\n"
+        while data:
+            view = parser.get_buffer(1000)
+            n_bytes = min(len(view), len(data), 7777)
+            view[:n_bytes] = data[:n_bytes]
+            parser.buffer_updated(n_bytes)
+            data = data[n_bytes:]
+        self.assertEqual(parser.next_response().body, body)
+
+    def test_bad_terminator(self):
+        parser = ResponseParser()
+        parser.feed(b"FOUND 1 2\r\nabcd")
+        with self.assertRaises(ProtocolError):
+            parser.next_response()
+
+    def test_parse_yaml(self):
+        stats = b"---\ncurrent-jobs-ready: 3\nrusage-stime: 0.012000\nversion: \"1.13\"\ndraining: false\n" \
+                b"hostname: my-host.local\n"
+        self.assertEqual(parse_yaml(stats), {"current-jobs-ready": 3, "rusage-stime": 0.012, "version": "1.13",
+                                             "draining": False, "hostname": "my-host.local"})
+        tubes = b"---\n- default\n- 42\n- 1.5\n- on\n- 0x1f\n"
+        self.assertEqual(parse_yaml(tubes), ["default", 42, 1.5, True, "0x1f"])
+        with self.assertRaises(UnsupportedYaml):
+            parse_yaml(tubes, strict=True)
+        try:
+            import yaml
+        except ImportError:
+            return
+        for document in (stats, tubes[:-7]):
+            self.assertEqual(parse_yaml(document, strict=True), yaml.load(document, Loader=yaml.FullLoader))
+
+    def test_parse_stats(self):
+        stats = b"---\nid: 7\ntube: \"42\"\nstate: buried\npri: 1024\nage: 3\n"
+        self.assertEqual(parse_stats(stats, as_str=("tube", "state")),
+                         {"id": 7, "tube": "42", "state": "buried", "pri": 1024, "age": 3})
+        self.assertEqual(parse_stats(stats, fields=("pri", "age")), {"pri": 1024, "age": 3})
+
+
+class TestHashRing(unittest.TestCase):
+    def test_distribution(self):
+        ring = HashRing(["a:1", "b:1", "c:1"])
+        keys = ["key{}".format(i) for i in range(3000)]
+        nodes = [ring.get(key) for key in keys]
+        for node in ("a:1", "b:1", "c:1"):
+            self.assertGreater(nodes.count(node), 700)
+
+        # removing a node only moves its own keys
+        smaller = HashRing(["a:1", "b:1"])
+        for key, node in zip(keys, nodes):
+            if node != "c:1":
+                self.assertEqual(smaller.get(key), node)
+
+
+class TestEmbedded(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine()
+        self.conn = self.engine.connect()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_priority_and_delay(self):
+        self.conn.put("low", priority=10)
+        self.conn.put("high", priority=1)
+        self.conn.put("later", delay=1)
+        self.conn.put("same", priority=10)
+        self.assertEqual([self.conn.reserve(0).body for _ in range(3)], ["high", "low", "same"])
+        self.assertIsNone(self.conn.reserve(0))
+        self.assertEqual(self.conn.stats()["current-jobs-delayed"], 1)
+        self.assertEqual(self.conn.reserve(3).body, "later")
+        stats = self.conn.stats()
+        self.assertEqual((stats["current-jobs-reserved"], stats["total-jobs"], stats["cmd-put"]), (4, 4, 4))
+
+    def test_ttr_and_deadline_soon(self):
+        self.conn.put("job", ttr=1)
+        job = self.conn.reserve(0)
+        # beanstalkd's safety margin: a reserved job expiring within a second stops reserves from waiting
+        self.assertRaises(Beanstalkd.DeadlineSoon, self.conn.reserve, 5)
+        worker = self.engine.connect()
+        expired = worker.reserve(3)
+        self.assertEqual(expired.job_id, job.job_id)
+        self.assertEqual(expired.stats()["timeouts"], 1)
+        self.assertRaises(Beanstalkd.CommandFailed, job.delete)
+        expired.delete()
+        worker.close()
+
+    def test_expired_ttr(self):
+        # no reserve runs meanwhile: the commands naming the job see it expired all the same
+        self.conn.put("job", ttr=1)
+        job = self.conn.reserve(0)
+        time.sleep(1.1)
+        self.assertEqual(self.conn.stats_job(job.job_id)["state"], "ready")
+        self.assertRaises(Beanstalkd.CommandFailed, self.conn.touch, job.job_id)
+        self.assertRaises(Beanstalkd.CommandFailed, job.release)
+        self.assertRaises(Beanstalkd.CommandFailed, job.bury)
+        worker = self.engine.connect()
+        self.assertEqual(worker.reserve(0).job_id, job.job_id)
+        worker.close()
+
+    def test_job_too_big(self):
+        session = Engine(max_job_size=10).session()
+        # answered before the body arrives, which is thrown away as it comes instead of buffered
+        self.assertEqual([response.status for response in session.feed(b"put 0 0 10 100000\r\n")], ["JOB_TOO_BIG"])
+        for _ in range(9):
+            self.assertEqual(session.feed(b"x" * 10000), [])
+            self.assertLess(len(session._buffer), 100)
+        responses = session.feed(b"x" * 10000 + b"\r\nput 0 0 10 2\r\nhi\r\n")
+        self.assertEqual([response.status for response in responses], ["INSERTED"])
+        session.close()
+
+    def test_cluster_surplus(self):
+        engines = [Engine(), Engine()]
+        servers = [engine.serve() for engine in engines]
+        cluster = ClusterConnection([(server.host, server.port) for server in servers])
+        for node in cluster.nodes:
+            node.put("job", ttr=1)
+        first = cluster.reserve(0)
+        # the job of the other node is kept by the cluster while its TTR runs out, then another worker takes it
+        other = engines[0] if first.connection.port == servers[1].port else engines[1]
+        first.delete()
+        time.sleep(1.1)
+        worker = other.connect()
+        taken = worker.reserve(0)
+        self.assertIsNotNone(taken)
+        self.assertIsNone(cluster.reserve(0))
+        # ready again: reserved anew, with a whole TTR
+        taken.release()
+        job = cluster.reserve(0)
+        self.assertEqual((job.job_id, job.stats()["reserves"]), (taken.job_id, 3))
+        job.delete()
+        worker.close()
+        cluster.close()
+        for server in servers:
+            server.close()
+
+    def test_bury_kick_pause(self):
+        self.conn.use("work")
+        self.conn.watch("work")
+        self.conn.put_many(["a", "b"])
+        self.conn.put("c", delay=60)
+        self.conn.reserve(0).bury()
+        self.assertEqual(self.conn.peek_buried().body, "a")
+        self.assertEqual(self.conn.kick(10), 1)
+        self.assertEqual(self.conn.kick(10), 1)
+        self.assertEqual(self.conn.stats_tube("work")["current-jobs-ready"], 3)
+        self.conn.pause_tube("work", 60)
+        self.assertIsNone(self.conn.reserve(0))
+        self.assertEqual(self.conn.stats_tube("work")["pause"], 60)
+
+    def test_waiting_reserve_and_tubes(self):
+        consumer = self.engine.connect()
+        consumer.watch("jobs")
+        result = []
+        thread = threading.Thread(target=lambda: result.append(consumer.reserve(5)))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(self.conn.stats()["current-waiting"], 1)
+        self.conn.use("jobs")
+        self.conn.put("wake up")
+        thread.join()
+        self.assertEqual(result[0].body, "wake up")
+        result[0].delete()
+        self.conn.use("default")
+        consumer.close()
+        # tubes nobody uses, watches or has jobs in are gone
+        self.assertEqual(self.conn.tubes(), ["default"])
+
+    def test_served(self):
+        with self.engine.serve() as server:
+            conn = Beanstalkd.Connection(server.host, server.port)
+            conn.put_bytes(b"\r\n" * 100)
+            self.assertEqual(self.conn.reserve_bytes(0).body, b"\r\n" * 100)
+            self.assertEqual(conn.stats()["current-connections"], 2)
+            conn.close()
+
+
+class TestFailover(unittest.TestCase):
+    def setUp(self):
+        self.engines = [Engine(), Engine()]
+        self.servers = [engine.serve() for engine in self.engines]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def kill(self, index):
+        """stop a server and drop its clients, as if the host went down"""
+        self.servers[index].close()
+        for session in list(self.engines[index]._sessions):
+            session.close()
+
+    def test_failover(self):
+        conn = FailoverConnection(["{}:{}".format(server.host, server.port) for server in self.servers],
+                                  min_backoff=0.01)
+        conn.use("orders")
+        conn.watch("orders")
+        conn.ignore("default")
+        conn.put("first")
+        self.assertEqual(conn.port, self.servers[0].port)
+
+        self.kill(0)
+        # the put may or may not have happened, so it isn't sent again
+        self.assertRaises(Beanstalkd.SocketError, conn.put, "lost")
+        self.assertEqual((conn.port, conn.failovers), (self.servers[1].port, 1))
+        self.assertEqual(conn.refresh_tubes(), ("orders", ["orders"]))
+        conn.put("second")
+        self.assertEqual(self.engines[1].connect().stats_tube("orders")["current-jobs-ready"], 1)
+
+        # the first host is back: a reserve is retried there once the second goes down
+        self.servers[0] = EngineServer(self.engines[0], port=self.servers[0].port)
+        self.servers[0].start()
+        self.kill(1)
+        job = conn.reserve(0)
+        self.assertEqual((job.body, conn.failovers), ("first", 2))
+        job.delete()
+        conn.close()
+        self.assertRaises(Beanstalkd.SocketError, conn.reserve, 0)
+
+    def test_parallel_connect(self):
+        # a port nobody listens on
+        closed = EngineServer(Engine())
+        closed.close()
+        hosts = [(closed.host, closed.port), (self.servers[1].host, self.servers[1].port)]
+        conn = FailoverConnection(hosts, parallel_connect=True)
+        self.assertEqual(conn.port, self.servers[1].port)
+        conn.close()
+        self.assertRaises(Beanstalkd.SocketError, FailoverConnection, hosts[:1], reconnect_timeout=0.2)
+
+    def test_pipelined_wait(self):
+        conn = FailoverConnection([(self.servers[0].host, self.servers[0].port)], io_timeout=0.2)
+        stop = threading.Event()
+
+        def chatter():
+            while not stop.is_set():
+                conn.peek_ready()
+
+        thread = threading.Thread(target=chatter)
+        thread.start()
+        try:
+            # the commands of the other thread, sent while the batch is encoded, don't cut its wait down to io_timeout
+            pipeline = conn.pipeline().reserve(1)
+            for _ in range(999):
+                pipeline.delete(2 ** 31)
+            self.assertIsNone(pipeline.execute()[0])
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(conn.failovers, 0)
+        conn.close()
+
+
+class TestTop(unittest.TestCase):
+    def test_monitor(self):
+        engine = Engine()
+        producer = engine.connect()
+        producer.use("mails")
+        producer.put("first")
+        producer.put("later", delay=60)
+        producer.use("reports")
+        producer.pause_tube("reports", 30)
+        conn = engine.connect()
+        monitor = Monitor(conn, window=3)
+        monitor.refresh()
+        self.assertEqual(monitor.rates["puts"], None)
+
+        time.sleep(0.2)
+        producer.put_many(["a", "b"])
+        tubes = {tube.name: tube for tube in monitor.refresh()}
+        self.assertEqual(sorted(tubes), ["default", "mails", "reports"])
+        self.assertEqual((tubes["mails"].backlog, tubes["reports"].backlog), (1, 2))
+        self.assertGreater(tubes["reports"].rates["puts"], 0)
+        self.assertEqual(tubes["mails"].rates["puts"], 0)
+        self.assertGreater(monitor.rates["puts"], 0)
+        self.assertTrue(tubes["reports"].paused > 0 and not tubes["mails"].paused)
+        self.assertIsNotNone(tubes["mails"].head_age)
+        self.assertIsNone(tubes["default"].head_age)
+        # the peeks don't change the tube used by the connection
+        self.assertEqual(conn.refresh_tubes()[0], "default")
+
+        lines = render(monitor, limit=1).splitlines()
+        self.assertTrue(lines[4].startswith("reports"))
+        self.assertEqual(lines[-1], "... 2 more")
+        conn.close()
+        producer.close()
+
+
+class TestMigrate(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine()
+        self.producer = self.engine.connect()
+        self.producer.use("jobs")
+        self.producer.put_bytes(b"poison", priority=0)
+        worker = self.engine.connect()
+        worker.watch("jobs")
+        worker.reserve_bytes(0).bury()
+        worker.close()
+        self.producer.put_bytes_many([b"job %d" % i for i in range(5)], priority=7, ttr=30)
+        self.producer.put_bytes(b"later", priority=3, delay=60)
+
+    def tearDown(self):
+        self.producer.close()
+
+    def test_dump_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "jobs.dump")
+            source = self.engine.connect()
+
+            def interrupt(count):
+                raise KeyboardInterrupt
+
+            self.assertRaises(KeyboardInterrupt, dump, source, "jobs", path, 2, False, interrupt)
+            source.close()
+            self.assertTrue(os.path.exists(path + ".checkpoint"))
+            # resumed: the buried job blocks the kick of the delayed one, both stay
+            self.assertEqual(dump(self.engine.connect(), "jobs", path, 2), 5)
+            self.assertFalse(os.path.exists(path + ".checkpoint"))
+            stats = self.producer.stats_tube("jobs")
+            self.assertEqual((stats["current-jobs-ready"], stats["current-jobs-buried"],
+                              stats["current-jobs-delayed"]), (0, 1, 1))
+            self.assertRaises(FileExistsError, dump, self.engine.connect(), "jobs", path)
+            rest = os.path.join(directory, "rest.dump")
+            self.assertEqual(dump(self.engine.connect(), "jobs", rest, kick_buried=True), 2)
+
+            target = Engine()
+            conn = target.connect()
+            self.assertEqual(load(conn, path), 5)
+            self.assertEqual(load(conn, rest, "rest"), 2)
+            conn.watch("jobs")
+            conn.watch("rest")
+            jobs = [conn.reserve_bytes(0) for _ in range(6)]
+            self.assertEqual([job.body for job in jobs], [b"poison"] + [b"job %d" % i for i in range(5)])
+            self.assertEqual((jobs[1].priority, jobs[1].ttr, jobs[1].tube), (7, 30, "jobs"))
+            delayed = conn.peek_delayed()
+            self.assertEqual((delayed.body, delayed.priority), ("later", 3))
+            self.assertIn(delayed.stats()["time-left"], (58, 59, 60))
+            conn.close()
+
+    def test_migrate(self):
+        target = Engine()
+        self.assertEqual(migrate(self.engine.connect(), target.connect(), "jobs", "moved", kick_buried=True), 7)
+        self.assertEqual(self.producer.stats_tube("jobs")["total-jobs"], 7)
+        self.assertEqual(self.producer.stats()["current-jobs-ready"] + self.producer.stats()["current-jobs-delayed"], 0)
+        conn = target.connect()
+        stats = conn.stats_tube("moved")
+        self.assertEqual((stats["current-jobs-ready"], stats["current-jobs-delayed"]), (6, 1))
+        conn.close()
+
+    def test_idempotency_keys(self):
+        self.producer.use("keyed")
+        self.producer.put("order 1", idempotency_key="order-1")
+        self.producer.put("no key")
+        self.producer.put_bytes(b"", idempotency_key="")
+        target = Engine()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "keyed.dump")
+            # the dumping connection reads the keys even if not asked to
+            self.assertEqual(dump(self.engine.connect(), "keyed", path), 3)
+            self.assertEqual(load(target.connect(), path, "loaded"), 3)
+        self.assertEqual(migrate(target.connect(), self.engine.connect(), "loaded", "back"), 3)
+        conn = self.engine.connect(idempotency_keys=True)
+        conn.watch("back")
+        jobs = [conn.reserve(0) for _ in range(3)]
+        self.assertEqual([(job.idempotency_key, job.body) for job in jobs],
+                         [("order-1", "order 1"), (None, "no key"), ("", "")])
+        conn.close()
+
+
+class TestBuried(unittest.TestCase):
+    def test_scanner(self):
+        engine = Engine()
+        conn = engine.connect()
+        for tube in ("mails", "reports"):
+            conn.use(tube)
+            conn.watch(tube)
+            conn.put_many(["{} {}".format(tube, i) for i in range(5)])
+        conn.ignore("default")
+        conn.bury_many([conn.reserve(0) for _ in range(8)])
+        buried = conn.peek_buried()
+        self.assertEqual(buried.kick(), buried.job_id)
+        self.assertRaises(Beanstalkd.CommandFailed, conn.kick_job, buried.job_id)
+
+        reports = []
+        scanner = BuriedScanner(engine.connect(), window=3, progress=reports.append)
+        jobs = list(scanner.jobs())
+        # peek_buried looked at the used tube
+        self.assertEqual([job.body for job in jobs], ["mails 0", "mails 1", "mails 2", "mails 3", "mails 4",
+                                                      "reports 1", "reports 2"])
+        self.assertEqual((jobs[0].tube, jobs[0].reserved, jobs[0].metadata()["buries"]), ("mails", False, 1))
+        self.assertEqual(len(reports), 4)
+        self.assertEqual((scanner.report.scanned, scanner.report.buried), (10, 7))
+
+        report = BuriedScanner(engine.connect(), tubes=["reports"], window=4).kick(lambda job: job.body != "reports 1")
+        self.assertEqual((report.buried, report.matched, report.kicked), (2, 1, 1))
+        report = BuriedScanner(engine.connect()).delete(lambda job: job.body.endswith("1"))
+        self.assertEqual(report.deleted, 2)
+        self.assertEqual(conn.stats()["current-jobs-buried"], 4)
+        self.assertEqual(conn.stats_tube("reports")["current-jobs-ready"], 4)
+        conn.close()
+
+
+class TestProducer(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine()
+        self.conn = self.engine.connect()
+        self.limits = {"jobs": TubeLimits(max_ready=20, rate=100, max_batch=10)}
+
+    def tearDown(self):
+        self.conn.close()
+
+    def drain(self, count):
+        worker = self.engine.connect()
+        worker.watch("jobs")
+        worker.delete_many([worker.reserve(0) for _ in range(count)])
+        worker.close()
+
+    def test_block_and_drop(self):
+        producer = AdaptiveProducer(self.conn, self.limits, sample_interval=0.05)
+        start = time.monotonic()
+        ids = producer.put_many("jobs", ["job"] * 15)
+        # a burst of 10, then 5 at 100 jobs/s at most
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertTrue(all(isinstance(job_id, int) for job_id in ids))
+        # the producer doesn't change the tube of the connection
+        self.assertEqual(self.conn.using(), "default")
+        producer.timeout = 0.2
+        self.assertRaises(Backpressure, producer.put_many, "jobs", ["job"] * 10)
+        self.assertEqual(self.conn.stats_tube("jobs")["current-jobs-ready"], 20)
+        stats = producer.stats("jobs")
+        self.assertLess(stats["rate"], 100)
+
+        dropping = AdaptiveProducer(self.conn, self.limits, sample_interval=0.05, overflow="drop")
+        self.assertEqual(dropping.put_many("jobs", ["job"] * 3), [None] * 3)
+        self.assertEqual(dropping.stats("jobs")["dropped"], 3)
+        self.drain(20)
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as directory:
+            producer = AdaptiveProducer(self.conn, self.limits, sample_interval=0.05, overflow="spill",
+                                        spill_directory=directory, raw=True)
+            ids = producer.put_many("jobs", [b"%d" % i for i in range(30)])
+            self.assertEqual(ids.count(None), 20)
+            self.assertEqual(producer.stats("jobs")["spilled"], 20)
+            self.assertEqual(os.listdir(directory), ["jobs.spill"])
+            self.drain(10)
+
+            # a new producer finds the spill file and replays it first, in order
+            producer = AdaptiveProducer(self.conn, self.limits, sample_interval=0.05, overflow="spill",
+                                        spill_directory=directory, raw=True)
+            path = os.path.join(directory, "jobs.spill")
+            size = os.path.getsize(path)
+            # a partial replay doesn't rewrite the spill file, the offset replayed is saved aside
+            self.assertFalse(producer.flush())
+            self.assertEqual(os.path.getsize(path), size)
+            self.assertIn("jobs.spill.checkpoint", os.listdir(directory))
+            while not producer.flush():
+                time.sleep(0.05)
+                self.drain(self.conn.stats_tube("jobs")["current-jobs-ready"])
+            self.assertEqual(os.listdir(directory), [])
+            self.assertEqual(producer.stats("jobs")["replayed"], 20)
+            worker = self.engine.connect()
+            worker.watch("jobs")
+            ready = self.conn.stats_tube("jobs")["current-jobs-ready"]
+            bodies = [worker.reserve_bytes(0).body for _ in range(ready)]
+            self.assertEqual(bodies, [b"%d" % i for i in range(30 - ready, 30)])
+            worker.close()
+
+    def test_replay_refused(self):
+        with tempfile.TemporaryDirectory() as directory:
+            producer = AdaptiveProducer(self.conn, {"jobs": TubeLimits(max_ready=20, max_batch=25)},
+                                        sample_interval=0, overflow="spill", spill_directory=directory, raw=True)
+            producer.put_many("jobs", [b"%d" % i for i in range(25)])
+            self.assertEqual(producer.stats("jobs")["spilled"], 5)
+            self.drain(20)
+
+            # the server refuses the second job of the replay pipeline, the ones after it are inserted
+            put_many = self.conn.put_many
+
+            def refuse_second(items, **kwargs):
+                results = put_many(items[:1] + items[2:], **kwargs)
+                return results[:1] + [Beanstalkd.CommandFailed("DRAINING")] + results[1:]
+
+            self.conn.put_many = refuse_second
+            self.assertFalse(producer.flush())
+            del self.conn.put_many
+            self.assertEqual(producer.stats("jobs")["replayed"], 4)
+            while not producer.flush():
+                time.sleep(0.02)
+            self.assertEqual(producer.stats("jobs")["replayed"], 5)
+            worker = self.engine.connect()
+            worker.watch("jobs")
+            bodies = [worker.reserve_bytes(0).body for _ in range(5)]
+            self.assertEqual(bodies, [b"20", b"22", b"23", b"24", b"21"])
+            self.assertIsNone(worker.reserve_bytes(0))
+            worker.close()
+
+
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine()
+        self.conn = self.engine.connect(dedup=MemoryIndex())
+        self.conn.use("orders")
+        self.conn.watch("orders")
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_put(self):
+        job_id = self.conn.put("order 1", idempotency_key="order-1")
+        self.assertEqual(self.conn.put("order 1", idempotency_key="order-1"), job_id)
+        self.assertEqual(self.conn.put_bytes(b"order 1", idempotency_key="order-1"), job_id)
+        self.assertNotEqual(self.conn.put("order 2", idempotency_key="order-2"), job_id)
+        self.assertNotEqual(self.conn.put("no key"), job_id)
+        self.assertEqual(self.conn.stats_tube("orders")["current-jobs-ready"], 3)
+
+        job = self.conn.reserve(0)
+        self.assertEqual((job.job_id, job.idempotency_key, job.body, job.size), (job_id, "order-1", "order 1", 7))
+        job.delete()
+        job = self.conn.reserve_bytes(0)
+        self.assertEqual((job.idempotency_key, job.raw_body), ("order-2", b"order 2"))
+        job.delete()
+        job = self.conn.reserve(0)
+        self.assertEqual((job.idempotency_key, job.body), (None, "no key"))
+        job.delete()
+
+    def test_put_many(self):
+        first = self.conn.put("a", idempotency_key="a")
+        ids = self.conn.put_many([{"body": "a", "idempotency_key": "a"}, "b", {"body": "c", "idempotency_key": "c"},
+                                  {"body": "c", "idempotency_key": "c", "priority": 1}])
+        self.assertEqual(ids[0], first)
+        self.assertEqual(len(set(ids[1:3])), 2)
+        self.assertEqual(self.conn.dedup.get("c"), ids[2])
+        self.assertEqual(ids[3], ids[2])
+        self.assertEqual(self.conn.stats_tube("orders")["current-jobs-ready"], 3)
+        self.conn.dedup = None
+        self.assertNotEqual(self.conn.put("a", idempotency_key="a"), first)
+
+    def test_binary_bodies(self):
+        bodies = [b"\xffIK\x05hello world", b"\xffIK\xff\xfe\xfd", b"\xffIK", b"\xff", b"\xffIK\x00",
+                  b"\xffIK\x02\xff\xfe rest"]
+        # a connection that doesn't read keys leaves every body alone
+        plain = self.engine.connect()
+        plain.use("orders")
+        plain.watch("orders")
+        plain.put_many(bodies, raw=True)
+        jobs = [plain.reserve_bytes(0) for _ in bodies]
+        self.assertEqual([(job.idempotency_key, job.raw_body, job.size) for job in jobs],
+                         [(None, body, len(body)) for body in bodies])
+        plain.delete_many(jobs)
+        plain.close()
+
+        # one that does only takes whole envelopes with a utf8 key
+        self.conn.put_many(bodies[1:], raw=True)
+        jobs = [self.conn.reserve_bytes(0) for _ in bodies[1:]]
+        self.assertEqual([(job.idempotency_key, job.raw_body, job.size) for job in jobs],
+                         [(None, body, len(body)) for body in bodies[1:4]] + [("", b"", 0)] +
+                         [(None, bodies[5], len(bodies[5]))])
+        self.conn.delete_many(jobs)
+        keys = Engine().connect(idempotency_keys=True)
+        keys.put("order 1", idempotency_key="order-1")
+        self.assertEqual(keys.reserve(0).idempotency_key, "order-1")
+        keys.close()
+
+    def test_cluster(self):
+        servers = [Engine().serve(), Engine().serve()]
+        cluster = ClusterConnection([(server.host, server.port) for server in servers], dedup=MemoryIndex())
+        job_id = cluster.put("order 1", idempotency_key="order-1")
+        # routed by the idempotency key, so a retry finds the job on the same node
+        self.assertEqual(cluster.put("order 1", idempotency_key="order-1"), job_id)
+        self.assertEqual(cluster.node_for("order-1").stats()["current-jobs-ready"], 1)
+        self.assertEqual(cluster.stats()["current-jobs-ready"], 1)
+        job = cluster.reserve(0)
+        self.assertEqual((job.idempotency_key, job.body), ("order-1", "order 1"))
+        job.delete()
+        cluster.close()
+        for server in servers:
+            server.close()
+
+    def test_memory_index(self):
+        index = MemoryIndex(max_size=2, ttl=0.05)
+        self.assertFalse(index.seen("a"))
+        self.assertTrue(index.seen("a"))
+        self.assertEqual(index.get("a"), UNKNOWN_ID)
+        index.add("b", 2)
+        index.add("c", 3)
+        # "a" was used least recently
+        self.assertIsNone(index.get("a"))
+        self.assertEqual((index.get("b"), index.get("c"), len(index)), (2, 3, 2))
+        time.sleep(0.06)
+        self.assertIsNone(index.get("b"))
+        self.assertFalse(index.seen("c"))
+
+    def test_bloom_index(self):
+        index = BloomIndex(capacity=100, error_rate=0.01)
+        self.assertFalse(index.seen("a"))
+        self.assertTrue(index.seen("a"))
+        self.assertEqual(index.get("a"), UNKNOWN_ID)
+        for i in range(100):
+            index.add(str(i))
+        # still in the previous generation
+        self.assertEqual(index.get("a"), UNKNOWN_ID)
+        for i in range(100, 200):
+            index.add(str(i))
+        self.assertTrue(all(index.get(str(i)) == UNKNOWN_ID for i in range(100, 200)))
+        false_positives = sum(index.get("unknown {}".format(i)) is not None for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+    def test_sqlite_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dedup.db")
+            with SqliteIndex(path) as index, SqliteIndex(path) as other:
+                self.conn.dedup = index
+                job_id = self.conn.put("order 1", idempotency_key="order-1")
+                self.assertEqual(other.get("order-1"), job_id)
+                self.assertFalse(other.seen("order-2"))
+                self.assertTrue(index.seen("order-2"))
+                self.assertEqual(index.get("order-2"), UNKNOWN_ID)
+                self.assertIsNone(index.get("order-3"))
+
+            with SqliteIndex(path, ttl=0.05, max_size=2) as index:
+                index.PRUNE_EVERY = 1
+                time.sleep(0.06)
+                self.assertIsNone(index.get("order-1"))
+                self.assertFalse(index.seen("order-1"))
+                index.add("order-4", 4)
+                index.add("order-5", 5)
+                self.assertEqual(len(index), 2)
+
+
 if __name__ == '__main__':
     import sys
 
@@ -272,6 +1371,11 @@ if __name__ == '__main__':
     except IndexError:
         port_arg = Beanstalkd.DEFAULT_PORT
 
+    if host_arg == "embedded":
+        # no beanstalkd needed: the tests run against an in-process engine served on a free port
+        server = Engine().serve()
+        host_arg, port_arg = server.host, server.port
+
     suite = unittest.TestSuite()
     suite.addTest(TestBeanstalkd("test_steps", host_arg, port_arg))
     suite.addTest(TestBeanstalkd("test_wrong_connection", host_arg, port_arg))
@@ -283,4 +1387,30 @@ if __name__ == '__main__':
     suite.addTest(TestBeanstalkd("test_big", host_arg, port_arg))
     suite.addTest(TestBeanstalkd("test_big_bytes", host_arg, port_arg))
     suite.addTest(TestBeanstalkd("test_infinite_loop", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_body_with_crlf", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_pipeline", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_put_many", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_zero_copy", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_ack_many", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_job_metadata", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_lazy_body", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_send", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_tube_cache", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_codec", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_claim_check", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_metrics", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_async", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_pool", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_cluster", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_lease_keeper", host_arg, port_arg))
+    suite.addTest(TestBeanstalkd("test_prefetch", host_arg, port_arg))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestResponseParser))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestHashRing))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestEmbedded))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestFailover))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestTop))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestMigrate))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestBuried))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestProducer))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(TestDedup))
     unittest.TextTestRunner().run(suite)